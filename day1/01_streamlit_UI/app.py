@@ -10,7 +10,9 @@ from typing import Dict, Any
 
 from components.header import display_header
 from components.sidebar import display_sidebar
-from services.model_service import ModelService
+from services.model_service import ModelService, generation_retry
+from services.model_cache import model_cache
+from common.cache import get_default_cache
 
 # ページ設定
 st.set_page_config(
@@ -83,14 +85,17 @@ def display_generate_page():
     """
     テキスト生成ページを表示する
     """
-    # モデルサービスの初期化
+    # モデルサービスの初期化（モデルは最初の生成時に読み込まれ、以降の再描画では再利用される）
     model_service = ModelService(st.session_state.get("model", "gpt2"))
     
+    # 複数のプロンプトをまとめて生成するかどうか
+    batch_mode = st.checkbox("複数のプロンプトをまとめて生成する（1行に1つ）")
+    
     # 入力フォーム
     prompt = st.text_area(
         "プロンプト",
-        placeholder="テキストを入力してください...",
-        height=100
+        placeholder="テキストを入力してください..." if not batch_mode else "1行に1つずつプロンプトを入力してください...",
+        height=100 if not batch_mode else 200
     )
     
     # 生成ボタン
@@ -100,18 +105,34 @@ def display_generate_page():
             return
         
         try:
-            # プログレスバーの表示
-            with st.spinner("テキストを生成中..."):
-                # テキスト生成
-                generated_text = model_service.generate_text(
-                    prompt=prompt,
-                    max_length=st.session_state.get("max_length", 100),
-                    temperature=st.session_state.get("temperature", 0.7)
-                )
-            
-            # 結果の表示
-            st.markdown("### 生成結果")
-            st.text_area("", generated_text, height=200)
+            if batch_mode:
+                prompts = [line.strip() for line in prompt.splitlines() if line.strip()]
+                # プログレスバーの表示
+                with st.spinner(f"{len(prompts)}件のテキストを生成中..."):
+                    # まとめてテキスト生成
+                    generated_texts = model_service.generate_batch(
+                        prompts=prompts,
+                        max_length=st.session_state.get("max_length", 100),
+                        temperature=st.session_state.get("temperature", 0.7)
+                    )
+                
+                # 結果の表示
+                st.markdown("### 生成結果")
+                for i, generated_text in enumerate(generated_texts, start=1):
+                    st.text_area(f"#{i}", generated_text, height=150)
+            else:
+                # プログレスバーの表示
+                with st.spinner("テキストを生成中..."):
+                    # テキスト生成
+                    generated_text = model_service.generate_text(
+                        prompt=prompt,
+                        max_length=st.session_state.get("max_length", 100),
+                        temperature=st.session_state.get("temperature", 0.7)
+                    )
+                
+                # 結果の表示
+                st.markdown("### 生成結果")
+                st.text_area("", generated_text, height=200)
             
             # モデル情報の表示
             model_info = model_service.get_model_info()
@@ -128,13 +149,32 @@ def display_settings_page():
     st.markdown("## 設定")
     
     # モデル選択
+    model_options = ["gpt2", "gpt2-medium", "gpt2-large", "gpt2-xl"]
+    current_model = st.session_state.get("model", "gpt2")
     model = st.selectbox(
         "モデル",
-        ["gpt2", "gpt2-medium", "gpt2-large", "gpt2-xl"],
-        index=0
+        model_options,
+        index=model_options.index(current_model) if current_model in model_options else 0
     )
     st.session_state["model"] = model
     
+    # 読み込み済みのモデル（メモリ上限を超えると、最も長く使われていないモデルから解放される）
+    cache_stats = model_cache.stats()
+    st.caption(
+        f"読み込み済みのモデル: {', '.join(cache_stats['models']) or 'なし'} "
+        f"（{cache_stats['resident_bytes'] / 2**20:.0f}MB / {cache_stats['memory_budget_bytes'] / 2**20:.0f}MB）"
+    )
+    result_stats = get_default_cache().stats()
+    st.caption(
+        f"生成結果のキャッシュ: {result_stats.get('entries', result_stats['memory_entries'])}件, "
+        f"ヒット率 {result_stats['hit_rate']:.1%}（{result_stats['hits']}/{result_stats['hits'] + result_stats['misses']}）"
+    )
+    retry_stats = generation_retry.stats()
+    st.caption(
+        f"生成の呼び出し: {retry_stats['calls']}回（再試行 {retry_stats['retries']}回, 失敗 {retry_stats['failures']}回, "
+        f"平均 {retry_stats['mean_latency']:.2f}秒）"
+    )
+    
     # パラメータ設定
     st.markdown("### パラメータ")
     
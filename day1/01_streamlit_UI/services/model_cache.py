@@ -0,0 +1,178 @@
+"""
+モデルキャッシュ
+
+このモジュールは、読み込んだモデルとトークナイザーをプロセス全体で共有するキャッシュを提供します。
+Streamlitはページを再描画するたびにスクリプトを実行し直しますが、インポート済みのモジュールは
+プロセス内で保持されるため、ここに置いたモデルは再描画やセッションをまたいで再利用されます。
+モデルの合計サイズがメモリ上限を超えた場合は、最も長く使われていないモデルから解放します。
+"""
+
+import gc
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, Tuple
+
+import torch
+from transformers import AutoTokenizer, AutoModelForCausalLM
+
+from common.config import MODEL_MEMORY_BUDGET_MB
+from common.logger import get_logger
+
+logger = get_logger(__name__)
+
+def model_nbytes(model: torch.nn.Module) -> int:
+    """
+    モデルの重みとバッファが使用しているメモリ（バイト）を計算する
+
+    入力と出力で共有している重み（gpt2の埋め込み層など）は1回だけ数えます。
+
+    Args:
+        model (torch.nn.Module): 対象のモデル
+
+    Returns:
+        int: 使用しているメモリ（バイト）
+    """
+    total = 0
+    seen = set()
+    for tensor in list(model.parameters()) + list(model.buffers()):
+        if tensor.data_ptr() in seen:
+            continue
+        seen.add(tensor.data_ptr())
+        total += tensor.numel() * tensor.element_size()
+    return total
+
+class ModelCache:
+    """
+    モデル名をキーとして、トークナイザーとモデルを保持するLRUキャッシュ
+    """
+
+    def __init__(self, memory_budget_bytes: int):
+        """
+        初期化
+
+        Args:
+            memory_budget_bytes (int): 保持するモデルの合計サイズの上限（バイト）
+        """
+        self.memory_budget_bytes = memory_budget_bytes
+        self._models: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()  # 最も長く使われていない順
+        self._last_nbytes: Dict[str, int] = {}  # 解放したモデルのサイズ（再読み込み前に空ける容量の見積もり）
+        self._lock = threading.Lock()
+        self._load_lock = threading.Lock()  # 読み込みは1つずつ行う（同時に読み込むとメモリ使用量が倍増するため）
+
+    def get(self, model_name: str) -> Tuple[Any, Any]:
+        """
+        トークナイザーとモデルを取得する（読み込まれていなければ読み込む）
+
+        Args:
+            model_name (str): モデルの名前
+
+        Returns:
+            Tuple[Any, Any]: (トークナイザー, モデル)
+        """
+        entry = self._lookup(model_name)
+        if entry is not None:
+            return entry["tokenizer"], entry["model"]
+
+        with self._load_lock:
+            # 待っている間に他のセッションが読み込んだ場合はそれを使う
+            entry = self._lookup(model_name)
+            if entry is not None:
+                return entry["tokenizer"], entry["model"]
+
+            with self._lock:
+                evicted = self._evict_until(self.memory_budget_bytes - self._last_nbytes.get(model_name, 0))
+            if evicted:
+                self._release_memory()
+
+            logger.info(f"モデル {model_name} を読み込み中...")
+            tokenizer = AutoTokenizer.from_pretrained(model_name)
+            # デコーダのみのモデルでバッチ生成するときは、生成を続ける右端を揃えるため左側をパディングする
+            tokenizer.padding_side = "left"
+            if tokenizer.pad_token is None:
+                tokenizer.pad_token = tokenizer.eos_token
+            model = AutoModelForCausalLM.from_pretrained(model_name)
+            model.eval()
+            nbytes = model_nbytes(model)
+            logger.info(f"モデルの読み込みが完了しました（{nbytes / 2**20:.0f}MB）")
+
+            with self._lock:
+                self._models[model_name] = {"tokenizer": tokenizer, "model": model, "nbytes": nbytes}
+                self._last_nbytes[model_name] = nbytes
+                evicted = self._evict_until(self.memory_budget_bytes, keep=model_name)
+            if evicted:
+                self._release_memory()
+            return tokenizer, model
+
+    def is_loaded(self, model_name: str) -> bool:
+        """
+        モデルが読み込み済みかどうかを返す
+
+        Args:
+            model_name (str): モデルの名前
+
+        Returns:
+            bool: 読み込み済みならTrue
+        """
+        with self._lock:
+            return model_name in self._models
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        キャッシュの状態を取得する
+
+        Returns:
+            Dict[str, Any]: メモリ上限、使用量、読み込み済みのモデル（最も長く使われていない順）
+        """
+        with self._lock:
+            return {
+                "memory_budget_bytes": self.memory_budget_bytes,
+                "resident_bytes": self._resident_bytes(),
+                "models": {name: entry["nbytes"] for name, entry in self._models.items()},
+            }
+
+    def clear(self) -> None:
+        """
+        すべてのモデルを解放する
+        """
+        with self._lock:
+            self._models.clear()
+        self._release_memory()
+
+    def _lookup(self, model_name: str):
+        with self._lock:
+            entry = self._models.get(model_name)
+            if entry is not None:
+                self._models.move_to_end(model_name)
+            return entry
+
+    def _resident_bytes(self) -> int:
+        return sum(entry["nbytes"] for entry in self._models.values())
+
+    def _evict_until(self, budget: int, keep: str = None) -> bool:
+        """
+        合計サイズが budget 以下になるまで、最も長く使われていないモデルを手放す（ロック内で呼ぶ）
+
+        GCの間に他のセッションを待たせないよう、メモリの回収は呼び出し側がロックの外で _release_memory() で行う。
+
+        Returns:
+            bool: 1つ以上のモデルを手放した場合はTrue
+        """
+        evicted = False
+        for name in list(self._models):
+            if self._resident_bytes() <= budget:
+                break
+            if name == keep:
+                continue
+            entry = self._models.pop(name)
+            logger.info(f"メモリ上限のため、モデル {name} を解放しました（{entry['nbytes'] / 2**20:.0f}MB）")
+            evicted = True
+        return evicted
+
+    @staticmethod
+    def _release_memory() -> None:
+        gc.collect()
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+
+# プロセス全体で共有するキャッシュ
+model_cache = ModelCache(MODEL_MEMORY_BUDGET_MB * 1024 * 1024)
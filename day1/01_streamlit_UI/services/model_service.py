@@ -5,16 +5,51 @@
 モデルの読み込み、推論、キャッシュなどの機能を含みます。
 """
 
-from typing import Optional, Dict, Any
+from typing import Optional, Dict, Any, List, Tuple
 import torch
-from transformers import AutoTokenizer, AutoModelForCausalLM
 
-from common.config import DEFAULT_MODEL, SUPPORTED_MODELS
-from common.utils import cache_result, retry_on_error
+from common.config import DEFAULT_MODEL, SUPPORTED_MODELS, MAX_BATCH_TOKENS
+from common.cache import cache_result
+from common.retry import RetryPolicy
 from common.logger import get_logger
+from services.model_cache import model_cache
 
 logger = get_logger(__name__)
 
+# 生成のリトライポリシー（モデルのダウンロード時の接続エラーなど、一時的な失敗だけを再試行する。
+# メモリ不足や入力の誤りはやり直しても同じ結果になるため、すぐにエラーを返す）
+generation_retry = RetryPolicy(name="generate", max_attempts=3, base_delay=1.0, deadline=60.0)
+
+def split_by_token_budget(lengths: List[int], max_length: int, max_batch_tokens: int) -> List[List[int]]:
+    """
+    プロンプトを、1回の generate のトークン数が上限に収まるバッチに分ける
+
+    パディングを減らすため、長さの近いプロンプトが同じバッチになるよう長さ順に並べてから分けます。
+    バッチのトークン数は「件数 × (最長のプロンプト + 生成するトークン数)」で見積もります。
+    生成するトークン数は、最も短いプロンプトが max_length に達するまでの数（最低1）です。
+
+    Args:
+        lengths (List[int]): 各プロンプトのトークン数
+        max_length (int): 生成するテキストの最大長
+        max_batch_tokens (int): 1バッチのトークン数の上限（1件で超える場合はその1件だけのバッチにする）
+
+    Returns:
+        List[List[int]]: バッチごとのプロンプトの番号
+    """
+    batches = []
+    current = []
+    for index in sorted(range(len(lengths)), key=lambda i: lengths[i]):
+        # 長さ順に並べているため、バッチの最初が最も短く、今のプロンプトが最も長い
+        shortest = lengths[current[0]] if current else lengths[index]
+        width = lengths[index] + max(1, max_length - shortest)
+        if current and width * (len(current) + 1) > max_batch_tokens:
+            batches.append(current)
+            current = []
+        current.append(index)
+    if current:
+        batches.append(current)
+    return batches
+
 class ModelService:
     """
     AIモデルを操作するためのサービスクラス
@@ -24,29 +59,42 @@ class ModelService:
         """
         初期化
 
+        モデルはここでは読み込まず、最初にテキストを生成するときにプロセス全体のキャッシュから取得します。
+
         Args:
             model_name (str): 使用するモデルの名前
         """
         self.model_name = model_name
-        self.tokenizer = None
-        self.model = None
-        self._load_model()
-    
-    def _load_model(self) -> None:
+
+    @property
+    def tokenizer(self):
+        """
+        トークナイザー（未読み込みなら読み込む）
+        """
+        return self._load_model()[0]
+
+    @property
+    def model(self):
+        """
+        モデル（未読み込みなら読み込む）
+        """
+        return self._load_model()[1]
+
+    def _load_model(self) -> Tuple[Any, Any]:
         """
-        モデルを読み込む
+        モデルを読み込む（読み込み済みならキャッシュから返す）
+
+        Returns:
+            Tuple[Any, Any]: (トークナイザー, モデル)
         """
         try:
-            logger.info(f"モデル {self.model_name} を読み込み中...")
-            self.tokenizer = AutoTokenizer.from_pretrained(self.model_name)
-            self.model = AutoModelForCausalLM.from_pretrained(self.model_name)
-            logger.info("モデルの読み込みが完了しました")
+            return model_cache.get(self.model_name)
         except Exception as e:
             logger.error(f"モデルの読み込みに失敗しました: {e}")
             raise
     
-    @retry_on_error(max_retries=3)
-    @cache_result
+    @generation_retry
+    @cache_result(key_attrs=("model_name",))
     def generate_text(
         self,
         prompt: str,
@@ -67,12 +115,14 @@ class ModelService:
             str: 生成されたテキスト
         """
         try:
+            tokenizer, model = self._load_model()
+
             # 入力のトークン化
-            inputs = self.tokenizer(prompt, return_tensors="pt")
+            inputs = tokenizer(prompt, return_tensors="pt")
             
             # テキスト生成
             with torch.no_grad():
-                outputs = self.model.generate(
+                outputs = model.generate(
                     inputs.input_ids,
                     max_length=max_length,
                     temperature=temperature,
@@ -80,7 +130,7 @@ class ModelService:
                 )
             
             # 生成されたテキストのデコード
-            generated_text = self.tokenizer.decode(
+            generated_text = tokenizer.decode(
                 outputs[0],
                 skip_special_tokens=True
             )
@@ -91,6 +141,71 @@ class ModelService:
             logger.error(f"テキスト生成に失敗しました: {e}")
             raise
     
+    @generation_retry
+    def generate_batch(
+        self,
+        prompts: List[str],
+        max_length: int = 100,
+        temperature: float = 0.7,
+        max_batch_tokens: int = MAX_BATCH_TOKENS,
+        **kwargs
+    ) -> List[str]:
+        """
+        複数のプロンプトからまとめてテキストを生成する
+
+        プロンプトは左側をパディングして1回の generate で処理します。
+        各プロンプトの結果は generate_text と同じく、プロンプトを含めて max_length トークンまで
+        （プロンプトが max_length 以上なら1トークン）生成したものになります。
+        トークン数が max_batch_tokens を超える場合は、複数のバッチに分けて順に処理します。
+
+        Args:
+            prompts (List[str]): プロンプトのリスト
+            max_length (int): 生成するテキストの最大長
+            temperature (float): 生成の多様性を制御するパラメータ
+            max_batch_tokens (int): 1回の generate に含めるトークン数の上限
+            **kwargs: その他のパラメータ
+
+        Returns:
+            List[str]: 生成されたテキスト（prompts と同じ順序）
+        """
+        try:
+            tokenizer, model = self._load_model()
+            lengths = [len(ids) for ids in tokenizer(prompts)["input_ids"]]
+            results = [None] * len(prompts)
+
+            for batch in split_by_token_budget(lengths, max_length, max_batch_tokens):
+                # 入力のトークン化（左側をパディング）
+                inputs = tokenizer([prompts[i] for i in batch], return_tensors="pt", padding=True)
+
+                # パディングした幅ではなくプロンプトごとの長さで、生成するトークン数を決める
+                new_tokens = [max(1, max_length - lengths[i]) for i in batch]
+                width = inputs.input_ids.shape[1]
+
+                # テキスト生成（最も多く生成するプロンプトに合わせ、他は後で切り詰める）
+                with torch.no_grad():
+                    outputs = model.generate(
+                        inputs.input_ids,
+                        attention_mask=inputs.attention_mask,
+                        pad_token_id=tokenizer.pad_token_id,
+                        max_new_tokens=max(new_tokens),
+                        temperature=temperature,
+                        **kwargs
+                    )
+
+                # 生成されたテキストのデコード（パディングは特殊トークンとして除かれる）
+                generated_texts = tokenizer.batch_decode(
+                    [row[:width + n] for row, n in zip(outputs, new_tokens)],
+                    skip_special_tokens=True
+                )
+                for i, generated_text in zip(batch, generated_texts):
+                    results[i] = generated_text
+
+            return results
+
+        except Exception as e:
+            logger.error(f"バッチでのテキスト生成に失敗しました: {e}")
+            raise
+    
     def get_model_info(self) -> Dict[str, Any]:
         """
         モデルの情報を取得する
@@ -98,10 +213,14 @@ class ModelService:
         Returns:
             Dict[str, Any]: モデルの情報
         """
-        return {
+        info = {
             "name": self.model_name,
-            "parameters": sum(
-                p.numel() for p in self.model.parameters()
-            ),
+            "loaded": model_cache.is_loaded(self.model_name),
             "supported_models": list(SUPPORTED_MODELS.keys())
-        } 
+        }
+        # 情報を表示するためだけにモデルを読み込まないよう、読み込み済みの場合のみパラメータ数を数える
+        if info["loaded"]:
+            info["parameters"] = sum(
+                p.numel() for p in self.model.parameters()
+            )
+        return info
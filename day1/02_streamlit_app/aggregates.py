@@ -0,0 +1,232 @@
+# aggregates.py
+"""
+評価指標の集計テーブル
+
+chat_historyへの挿入・評価指標の更新と同じトランザクションで集計値を更新し、
+評価指標分析タブをテーブルの件数によらず一定時間で表示できるようにする。
+
+- chat_metrics_agg: 正確性レベル × 指標ごとの件数・合計・二乗和・最小値・最大値（平均・標準偏差用）
+- chat_metrics_sketch: 指標ごとの対数バケットのヒストグラム（パーセンタイルの近似用、相対誤差1%）
+
+使い方（集計テーブルを作り直す / 差分を確認する）:
+    python aggregates.py rebuild
+    python aggregates.py verify
+"""
+import math
+import sys
+import pandas as pd
+
+AGG_TABLE = "chat_metrics_agg"
+SKETCH_TABLE = "chat_metrics_sketch"
+AGG_SCHEMA = f'''
+CREATE TABLE IF NOT EXISTS {AGG_TABLE}
+(is_correct REAL NOT NULL,
+ metric TEXT NOT NULL,
+ count INTEGER NOT NULL,
+ total REAL NOT NULL,
+ total_sq REAL NOT NULL,
+ min_value REAL,
+ max_value REAL,
+ PRIMARY KEY (is_correct, metric))
+'''
+SKETCH_SCHEMA = f'''
+CREATE TABLE IF NOT EXISTS {SKETCH_TABLE}
+(metric TEXT NOT NULL,
+ bucket INTEGER NOT NULL,
+ count INTEGER NOT NULL,
+ PRIMARY KEY (metric, bucket))
+'''
+
+# 統計を集計する指標（評価指標分析タブのdescribe()・正確性レベル別平均の対象）
+STATS_COLUMNS = ("response_time", "bleu_score", "similarity_score", "word_count", "relevance_score", "ttft")
+# 正確性レベルごとの件数は is_correct 自体の集計値として保持する
+ROWS_METRIC = "is_correct"
+
+UPSERT_AGG_SQL = f'''
+INSERT INTO {AGG_TABLE} (is_correct, metric, count, total, total_sq, min_value, max_value)
+VALUES (?, ?, ?, ?, ?, ?, ?)
+ON CONFLICT(is_correct, metric) DO UPDATE SET
+ count = count + excluded.count,
+ total = total + excluded.total,
+ total_sq = total_sq + excluded.total_sq,
+ min_value = MIN(min_value, excluded.min_value),
+ max_value = MAX(max_value, excluded.max_value)
+'''
+UPSERT_SKETCH_SQL = f'''
+INSERT INTO {SKETCH_TABLE} (metric, bucket, count) VALUES (?, ?, ?)
+ON CONFLICT(metric, bucket) DO UPDATE SET count = count + excluded.count
+'''
+SELECT_AGG_SQL = f"SELECT is_correct, metric, count, total, total_sq, min_value, max_value FROM {AGG_TABLE}"
+SELECT_SKETCH_SQL = f"SELECT metric, bucket, count FROM {SKETCH_TABLE} ORDER BY metric, bucket"
+DELETE_AGG_SQL = f"DELETE FROM {AGG_TABLE}"
+DELETE_SKETCH_SQL = f"DELETE FROM {SKETCH_TABLE}"
+
+# --- 分位点スケッチ（DDSketchと同じ対数バケット） ---
+SKETCH_RELATIVE_ACCURACY = 0.01
+_GAMMA = (1 + SKETCH_RELATIVE_ACCURACY) / (1 - SKETCH_RELATIVE_ACCURACY)
+_LOG_GAMMA = math.log(_GAMMA)
+ZERO_BUCKET = -(2 ** 31)   # 0以下（および極小値）の値を入れるバケット
+MIN_POSITIVE = 1e-9
+
+def bucket_of(value):
+    """値が入るバケット番号を返す"""
+    if value < MIN_POSITIVE:
+        return ZERO_BUCKET
+    return math.ceil(math.log(value) / _LOG_GAMMA)
+
+def bucket_value(bucket):
+    """バケットの代表値（バケット内の値に対する相対誤差がSKETCH_RELATIVE_ACCURACY以下）"""
+    if bucket == ZERO_BUCKET:
+        return 0.0
+    return 2 * _GAMMA ** bucket / (_GAMMA + 1)
+
+
+class AggregateDelta:
+    """1回のトランザクションで集計テーブルに加算する差分"""
+
+    def __init__(self):
+        self.stats = {}    # (is_correct, metric) -> [count, total, total_sq, min, max]
+        self.sketch = {}   # (metric, bucket) -> count
+
+    def add(self, is_correct, metric, value):
+        """1つの値を加える（is_correctまたは値がNULLなら何もしない）"""
+        if is_correct is None or value is None or (isinstance(value, float) and math.isnan(value)):
+            return
+        value = float(value)
+        key = (float(is_correct), metric)
+        entry = self.stats.get(key)
+        if entry is None:
+            self.stats[key] = [1, value, value * value, value, value]
+        else:
+            entry[0] += 1
+            entry[1] += value
+            entry[2] += value * value
+            entry[3] = min(entry[3], value)
+            entry[4] = max(entry[4], value)
+        if metric != ROWS_METRIC:
+            sketch_key = (metric, bucket_of(value))
+            self.sketch[sketch_key] = self.sketch.get(sketch_key, 0) + 1
+
+    def add_row(self, is_correct, values):
+        """1レコード分の値（{指標名: 値}）を加える"""
+        for metric, value in values.items():
+            self.add(is_correct, metric, value)
+
+    def apply(self, conn):
+        """差分を集計テーブルに加算する（呼び出し側のトランザクション内で実行する）"""
+        if self.stats:
+            conn.executemany(UPSERT_AGG_SQL, [key + tuple(entry) for key, entry in self.stats.items()])
+        if self.sketch:
+            conn.executemany(UPSERT_SKETCH_SQL, [key + (count,) for key, count in self.sketch.items()])
+
+
+def create_tables(conn):
+    """集計テーブルを作成する"""
+    conn.execute(AGG_SCHEMA)
+    conn.execute(SKETCH_SCHEMA)
+
+def clear(conn):
+    """集計テーブルを空にする"""
+    conn.execute(DELETE_AGG_SQL)
+    conn.execute(DELETE_SKETCH_SQL)
+
+def is_empty(conn):
+    return conn.execute(f"SELECT 1 FROM {AGG_TABLE} LIMIT 1").fetchone() is None
+
+def delta_from_rows(rows):
+    """(is_correct, *STATS_COLUMNS) の行から差分を作る"""
+    delta = AggregateDelta()
+    for row in rows:
+        is_correct = row[0]
+        delta.add(is_correct, ROWS_METRIC, is_correct)
+        delta.add_row(is_correct, dict(zip(STATS_COLUMNS, row[1:])))
+    return delta
+
+def read_tables(conn):
+    """集計テーブルの内容を比較可能な形で返す（検証用）"""
+    stats = {(row[0], row[1]): row[2:] for row in conn.execute(SELECT_AGG_SQL)}
+    sketch = {(row[0], row[1]): row[2] for row in conn.execute(SELECT_SKETCH_SQL)}
+    return stats, sketch
+
+
+# --- 読み出し（評価指標分析タブ用） ---
+def load_summary(conn):
+    """集計テーブルから分析タブに必要な統計をまとめて読み込む
+
+    Returns:
+        dict:
+            accuracy_counts: {is_correct: 件数}
+            describe: DataFrame.describe() と同じ形式の統計（列は値のある指標のみ）
+            group_means: 正確性レベル（is_correct）ごとの指標の平均
+    """
+    overall = {}       # metric -> [count, total, total_sq, min, max]
+    group_means = {}   # is_correct -> {metric: mean}
+    accuracy_counts = {}
+    for is_correct, metric, count, total, total_sq, min_value, max_value in conn.execute(SELECT_AGG_SQL):
+        if count == 0:
+            continue
+        if metric == ROWS_METRIC:
+            accuracy_counts[is_correct] = count
+            continue
+        group_means.setdefault(is_correct, {})[metric] = total / count
+        entry = overall.get(metric)
+        if entry is None:
+            overall[metric] = [count, total, total_sq, min_value, max_value]
+        else:
+            entry[0] += count
+            entry[1] += total
+            entry[2] += total_sq
+            entry[3] = min(entry[3], min_value)
+            entry[4] = max(entry[4], max_value)
+
+    sketches = {}
+    for metric, bucket, count in conn.execute(SELECT_SKETCH_SQL):
+        sketches.setdefault(metric, []).append((bucket, count))
+
+    describe = {}
+    for metric in STATS_COLUMNS:
+        if metric not in overall:
+            continue
+        count, total, total_sq, min_value, max_value = overall[metric]
+        mean = total / count
+        # 標本標準偏差（pandasのdescribeと同じくddof=1）
+        std = math.sqrt(max(total_sq - total * total / count, 0.0) / (count - 1)) if count > 1 else float("nan")
+        quantiles = [
+            min(max(_sketch_quantile(sketches.get(metric, []), q), min_value), max_value)
+            for q in (0.25, 0.5, 0.75)
+        ]
+        describe[metric] = [count, mean, std, min_value, *quantiles, max_value]
+
+    return {
+        "accuracy_counts": accuracy_counts,
+        "describe": pd.DataFrame(describe, index=["count", "mean", "std", "min", "25%", "50%", "75%", "max"]),
+        "group_means": pd.DataFrame.from_dict(group_means, orient="index").reindex(
+            columns=[m for m in STATS_COLUMNS if m in overall]
+        ).sort_index(),
+    }
+
+def _sketch_quantile(buckets, q):
+    """昇順の (bucket, count) のリストから分位点の近似値を求める"""
+    total = sum(count for _, count in buckets)
+    if total == 0:
+        return float("nan")
+    rank = q * (total - 1)
+    cumulative = 0
+    for bucket, count in buckets:
+        cumulative += count
+        if cumulative > rank:
+            return bucket_value(bucket)
+    return bucket_value(buckets[-1][0])
+
+
+if __name__ == "__main__":
+    import database  # database.py がこのモジュールを読み込むため、ここで遅延インポートする
+
+    command = sys.argv[1] if len(sys.argv) > 1 else "rebuild"
+    if command == "rebuild":
+        database.rebuild_aggregates()
+    elif command == "verify":
+        sys.exit(0 if database.verify_aggregates() else 1)
+    else:
+        print(f"不明なコマンドです: {command}（rebuild または verify を指定してください）")
+        sys.exit(2)
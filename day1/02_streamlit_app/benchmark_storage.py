@@ -0,0 +1,118 @@
+# benchmark_storage.py
+"""
+SQLiteストレージのベンチマーク
+
+接続ごとにconnect/closeする従来の方式と、WALモードの接続プール方式で
+N個の同時書き込みスレッドによるINSERTと読み込みのスループットを比較する。
+
+使い方:
+    python benchmark_storage.py --writers 1 4 16 --rows 2000
+"""
+import argparse
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from datetime import datetime
+
+from database import SCHEMA, INSERT_SQL, SELECT_ALL_SQL, COUNT_SQL
+from storage import ConnectionPool
+
+# database.INSERT_SQL の列順: timestamp, question, answer, feedback, correct_answer, is_correct, response_time, ttft
+SAMPLE_ROW = ("質問のサンプル", "回答のサンプル" * 20, "正確", "正解のサンプル" * 20, 1.0, 1.2, 0.3)
+assert INSERT_SQL.count("?") == len(SAMPLE_ROW) + 1, "INSERT_SQL の列が変わったら SAMPLE_ROW も合わせる"
+
+
+def _row():
+    return (datetime.now().strftime("%Y-%m-%d %H:%M:%S"),) + SAMPLE_ROW
+
+
+def _legacy_insert(db_file):
+    """従来の方式: 操作ごとに接続を作成して閉じる"""
+    conn = sqlite3.connect(db_file)
+    try:
+        conn.execute(INSERT_SQL, _row())
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def _legacy_read(db_file):
+    conn = sqlite3.connect(db_file)
+    try:
+        conn.execute(SELECT_ALL_SQL + " LIMIT 50").fetchall()
+    finally:
+        conn.close()
+
+
+def _run_threads(n_threads, rows_per_thread, op):
+    """n_threads個のスレッドでopをrows_per_thread回ずつ実行し、(成功数, 失敗数, 経過秒)を返す"""
+    errors = [0]
+    lock = threading.Lock()
+
+    def worker():
+        for _ in range(rows_per_thread):
+            try:
+                op()
+            except sqlite3.OperationalError:  # database is locked など
+                with lock:
+                    errors[0] += 1
+
+    threads = [threading.Thread(target=worker) for _ in range(n_threads)]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - start
+    return n_threads * rows_per_thread - errors[0], errors[0], elapsed
+
+
+def _fresh_db(directory, name):
+    db_file = os.path.join(directory, name)
+    conn = sqlite3.connect(db_file)
+    conn.execute(SCHEMA)
+    conn.commit()
+    conn.close()
+    return db_file
+
+
+def run_benchmark(writers, rows):
+    print(f"{'mode':<8} {'writers':>7} {'insert/s':>10} {'read/s':>10} {'errors':>7}")
+    with tempfile.TemporaryDirectory() as tmp:
+        for n in writers:
+            per_thread = max(1, rows // n)
+
+            # 従来の方式
+            db_file = _fresh_db(tmp, f"legacy_{n}.db")
+            ok, err, elapsed = _run_threads(n, per_thread, lambda: _legacy_insert(db_file))
+            _, _, read_elapsed = _run_threads(n, per_thread, lambda: _legacy_read(db_file))
+            print(f"{'legacy':<8} {n:>7} {ok / elapsed:>10.0f} {n * per_thread / read_elapsed:>10.0f} {err:>7}")
+
+            # 接続プール + WAL
+            db_file = _fresh_db(tmp, f"pooled_{n}.db")
+            pool = ConnectionPool(db_file)
+
+            def pooled_insert():
+                with pool.write() as conn:
+                    conn.execute(INSERT_SQL, _row())
+
+            def pooled_read():
+                with pool.connection() as conn:
+                    conn.execute(SELECT_ALL_SQL + " LIMIT 50").fetchall()
+
+            ok, err, elapsed = _run_threads(n, per_thread, pooled_insert)
+            _, _, read_elapsed = _run_threads(n, per_thread, pooled_read)
+            with pool.connection() as conn:
+                assert conn.execute(COUNT_SQL).fetchone()[0] == ok
+            pool.close_all()
+            print(f"{'pooled':<8} {n:>7} {ok / elapsed:>10.0f} {n * per_thread / read_elapsed:>10.0f} {err:>7}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="SQLiteストレージのベンチマーク")
+    parser.add_argument("--writers", type=int, nargs="+", default=[1, 4, 16], help="同時書き込みスレッド数")
+    parser.add_argument("--rows", type=int, default=2000, help="各設定で書き込む合計行数")
+    args = parser.parse_args()
+    run_benchmark(args.writers, args.rows)
@@ -1,3 +1,20 @@
 # config.py
 DB_FILE = "chat_feedback.db"
-MODEL_NAME = "google/gemma-2-2b-jpn-it"
\ No newline at end of file
+MODEL_NAME = "google/gemma-2-2b-jpn-it"
+
+# --- SQLite接続プールの設定 ---
+DB_POOL_SIZE = 8             # プロセス全体で保持する接続数の上限
+DB_BUSY_TIMEOUT = 30.0       # ロック待ちのタイムアウト（秒）
+DB_CACHE_SIZE_KB = 64 * 1024 # ページキャッシュのサイズ（KiB、接続ごと）
+DB_MMAP_SIZE = 256 * 1024 * 1024 # メモリマップI/Oのサイズ（バイト）
+
+# --- 評価指標のバックグラウンド計算の設定 ---
+SCORING_WORKERS = 2          # 指標を計算するワーカースレッド数
+SCORING_BATCH_SIZE = 32      # 1回のUPDATEでまとめて処理する最大レコード数
+SCORING_BATCH_WAIT = 0.2     # バッチを集めるために待つ最大時間（秒）
+
+# --- CPUで推論するときの設定（cpu_inference.py を参照） ---
+CPU_QUANTIZE = True          # Linear層を動的int8量子化する
+CPU_THREADS = 0              # intra-opスレッド数（0なら既定値）
+CPU_INTEROP_THREADS = 0      # inter-opスレッド数（0なら既定値）
+CPU_COMPILE = False          # model.forward を torch.compile する（初回の生成が遅くなる）
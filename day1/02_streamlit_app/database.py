@@ -1,10 +1,15 @@
 # database.py
 import sqlite3
+import threading
 import pandas as pd
 from datetime import datetime
 import streamlit as st
 from config import DB_FILE
-from metrics import calculate_metrics # metricsを計算するために必要
+from metrics import calculate_metrics_batch, calculate_similarity_scores # metricsを計算するために必要
+from storage import get_pool # プロセス全体で共有する接続プール
+from scoring import ScoringQueue # 評価指標のバックグラウンド計算
+from similarity import SimilarityEngine # チャット履歴全体で共通のIDFを使う類似度計算
+import aggregates # 評価指標分析タブ用の集計テーブル
 
 # --- スキーマ定義 ---
 TABLE_NAME = "chat_history"
@@ -21,58 +26,299 @@ CREATE TABLE IF NOT EXISTS {TABLE_NAME}
  bleu_score REAL,
  similarity_score REAL,
  word_count INTEGER,
- relevance_score REAL)
+ relevance_score REAL,
+ ttft REAL)            -- 最初のトークンが表示されるまでの時間（秒）
+'''
+# 既存のデータベースに後から追加したカラム（init_dbでALTER TABLEする）
+ADDED_COLUMNS = {"ttft": "REAL"}
+# 効率性スコア: 正確性 / (応答時間 + 0.1)。式インデックスと同じ式で並び替えて上位だけを読む
+EFFICIENCY_EXPR = "is_correct / (COALESCE(response_time, 0) + 0.1)"
+# 履歴ページの絞り込み・並び替え・ページングをSQLite側で行うためのインデックス
+INDEXES = (
+    f"CREATE INDEX IF NOT EXISTS idx_{TABLE_NAME}_timestamp ON {TABLE_NAME} (timestamp, id)",
+    f"CREATE INDEX IF NOT EXISTS idx_{TABLE_NAME}_is_correct ON {TABLE_NAME} (is_correct, timestamp, id)",
+    f"CREATE INDEX IF NOT EXISTS idx_{TABLE_NAME}_efficiency ON {TABLE_NAME} ({EFFICIENCY_EXPR})",
+)
+
+# --- SQL定義（定数として使い回し、接続ごとのステートメントキャッシュに載せる） ---
+# 評価指標のカラムはNULLのまま保存し、ScoringQueueが後からUPDATEする
+INSERT_SQL = f'''
+INSERT INTO {TABLE_NAME} (timestamp, question, answer, feedback, correct_answer, is_correct, response_time, ttft)
+VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+'''
+# 同じレコードが二重に計算されても集計値を二重に加算しないよう、未計算の行だけを更新する
+UPDATE_METRICS_SQL = f'''
+UPDATE {TABLE_NAME} SET bleu_score = ?, similarity_score = ?, word_count = ?, relevance_score = ?
+WHERE id = ? AND word_count IS NULL
+'''
+# word_countは計算済みなら必ず整数が入るため、NULLのレコードを未計算とみなす
+SELECT_UNSCORED_SQL = f"SELECT id FROM {TABLE_NAME} WHERE word_count IS NULL ORDER BY id"
+SELECT_FOR_SCORING_SQL = f"SELECT id, answer, correct_answer, is_correct FROM {TABLE_NAME} WHERE id IN ({{placeholders}})"
+SELECT_SCORED_CORPUS_SQL = f"SELECT id, answer, correct_answer FROM {TABLE_NAME} WHERE word_count IS NOT NULL"
+# 一括再計算ではidの範囲でページングし、書き込みの間に読み込みのカーソルを開いたままにしない
+SELECT_SCORED_CORPUS_PAGE_SQL = f'''
+SELECT id, answer, correct_answer FROM {TABLE_NAME}
+WHERE word_count IS NOT NULL AND id > ? ORDER BY id LIMIT ?
+'''
+# 未計算の行はScoringQueueが類似度と集計値をまとめて書き込むため、再計算では更新しない
+UPDATE_SIMILARITY_SQL = f"UPDATE {TABLE_NAME} SET similarity_score = ? WHERE id = ? AND word_count IS NOT NULL"
+CORPUS_CHUNK_SIZE = 10000 # 類似度の一括再計算で一度に読み込む行数
+SELECT_ALL_SQL = f"SELECT * FROM {TABLE_NAME} ORDER BY timestamp DESC"
+COUNT_SQL = f"SELECT COUNT(*) FROM {TABLE_NAME}"
+# 履歴リストに表示するカラム
+HISTORY_LIST_COLUMNS = ("id", "timestamp", "question", "answer", "feedback", "correct_answer", "is_correct",
+                        "response_time", "bleu_score", "similarity_score", "word_count", "relevance_score",
+                        "ttft")
+SELECT_HISTORY_PAGE_SQL = f'''
+SELECT {", ".join(HISTORY_LIST_COLUMNS)} FROM {TABLE_NAME}
+ORDER BY timestamp DESC, id DESC LIMIT ? OFFSET ?
+'''
+SELECT_HISTORY_PAGE_FILTERED_SQL = f'''
+SELECT {", ".join(HISTORY_LIST_COLUMNS)} FROM {TABLE_NAME}
+WHERE is_correct = ?
+ORDER BY timestamp DESC, id DESC LIMIT ? OFFSET ?
+'''
+COUNT_FILTERED_SQL = f"SELECT COUNT(*) FROM {TABLE_NAME} WHERE is_correct = ?"
+DELETE_ALL_SQL = f"DELETE FROM {TABLE_NAME}"
+SELECT_AGGREGATE_SOURCE_SQL = f'''
+SELECT is_correct, {", ".join(aggregates.STATS_COLUMNS)} FROM {TABLE_NAME} WHERE is_correct IS NOT NULL
+'''
+SELECT_EFFICIENCY_TOP_SQL = f'''
+SELECT id, {EFFICIENCY_EXPR} AS efficiency_score FROM {TABLE_NAME}
+WHERE is_correct IS NOT NULL ORDER BY {EFFICIENCY_EXPR} DESC LIMIT ?
+'''
+SELECT_METRIC_SAMPLE_SQL = f'''
+SELECT response_time, {{metric}}, is_correct FROM {TABLE_NAME}
+WHERE is_correct IS NOT NULL AND response_time IS NOT NULL AND {{metric}} IS NOT NULL
+ORDER BY timestamp DESC, id DESC LIMIT ?
 '''
 
 # --- データベース初期化 ---
+_startup_done = False # 起動時の処理はプロセスごとに1回だけ行う（init_dbはStreamlitの再実行ごとに呼ばれる）
+_startup_lock = threading.Lock() # 複数のセッションから同時に起動時の処理を行わないためのロック
+
 def init_db():
     """データベースとテーブルを初期化する"""
+    global _startup_done
     try:
-        conn = sqlite3.connect(DB_FILE)
-        c = conn.cursor()
-        c.execute(SCHEMA)
-        conn.commit()
-        conn.close()
+        with get_pool(DB_FILE).write() as conn:
+            conn.execute(SCHEMA)
+            existing_columns = {row[1] for row in conn.execute(f"PRAGMA table_info({TABLE_NAME})")}
+            for column, column_type in ADDED_COLUMNS.items():
+                if column not in existing_columns:
+                    conn.execute(f"ALTER TABLE {TABLE_NAME} ADD COLUMN {column} {column_type}")
+            for index in INDEXES:
+                conn.execute(index)
+            aggregates.create_tables(conn)
+            needs_rebuild = aggregates.is_empty(conn) and conn.execute(COUNT_SQL).fetchone()[0] > 0
         print(f"Database '{DB_FILE}' initialized successfully.")
+        with _startup_lock:
+            if not _startup_done:
+                # 集計テーブル導入前のデータベースなら、既存のレコードから集計値を作る
+                if needs_rebuild:
+                    rebuild_aggregates()
+                # 前回の実行で計算されずに残ったレコードを再投入する
+                enqueue_unscored_rows()
+                # 失敗した場合は次の再実行でやり直すよう、成功してから記録する
+                _startup_done = True
     except Exception as e:
         st.error(f"データベースの初期化に失敗しました: {e}")
         raise e # エラーを再発生させてアプリの起動を止めるか、適切に処理する
 
+# --- 類似度エンジン ---
+# チャット履歴全体の文書頻度を保持する。初回利用時に計算済みの行から構築し、以降は新しく計算する行を逐次追加する
+similarity_engine = SimilarityEngine()
+_similarity_engine_ready = False
+_similarity_engine_lock = threading.Lock()
+
+def _iter_chunks(conn, sql):
+    """(id, answer, correct_answer) をCORPUS_CHUNK_SIZE行ずつ返す"""
+    cursor = conn.execute(sql)
+    while True:
+        rows = cursor.fetchmany(CORPUS_CHUNK_SIZE)
+        if not rows:
+            break
+        yield rows
+
+def _corpus_documents(rows):
+    """行の回答と正解を、類似度計算と同じく小文字化した文書のリストにする"""
+    return [(text or "").lower() for row in rows for text in (row[1], row[2])]
+
+def _fit_similarity_engine():
+    """評価指標が計算済みの全レコードから類似度エンジンの文書頻度を構築し直す"""
+    similarity_engine.reset()
+    with get_pool(DB_FILE).connection() as conn:
+        for rows in _iter_chunks(conn, SELECT_SCORED_CORPUS_SQL):
+            similarity_engine.partial_fit(_corpus_documents(rows))
+
+def add_to_similarity_corpus(rows):
+    """これから評価指標を計算する行を類似度エンジンのコーパスに追加し、エンジンを返す"""
+    global _similarity_engine_ready
+    with _similarity_engine_lock:
+        if not _similarity_engine_ready:
+            _fit_similarity_engine()
+            _similarity_engine_ready = True
+        similarity_engine.partial_fit(_corpus_documents(rows))
+    return similarity_engine
+
+def recompute_similarity_scores():
+    """評価指標が計算済みの全レコードの類似度スコアを、テーブル全体で構築し直したIDFで再計算する"""
+    global _similarity_engine_ready
+    with _similarity_engine_lock:
+        _fit_similarity_engine()
+        _similarity_engine_ready = True
+    pool = get_pool(DB_FILE)
+    updated = 0
+    last_id = 0
+    while True:
+        with pool.connection() as conn:
+            rows = conn.execute(SELECT_SCORED_CORPUS_PAGE_SQL, (last_id, CORPUS_CHUNK_SIZE)).fetchall()
+        if not rows:
+            break
+        scores = calculate_similarity_scores(
+            [row[1] for row in rows], [row[2] for row in rows], similarity_engine
+        )
+        with pool.write() as conn:
+            conn.executemany(
+                UPDATE_SIMILARITY_SQL, [(score, row[0]) for row, score in zip(rows, scores)]
+            )
+        updated += len(rows)
+        last_id = rows[-1][0]
+    print(f"{updated} 件の類似度スコアを再計算しました。")
+    # 類似度の集計値も新しいスコアで作り直す
+    rebuild_aggregates()
+    return updated
+
+# --- 集計テーブル ---
+def rebuild_aggregates():
+    """集計テーブルをchat_historyから作り直す"""
+    with get_pool(DB_FILE).write() as conn:
+        delta = aggregates.delta_from_rows(conn.execute(SELECT_AGGREGATE_SOURCE_SQL))
+        aggregates.clear(conn)
+        delta.apply(conn)
+    print(f"集計テーブルを再構築しました（{len(delta.stats)} 件の集計値）。")
+
+def verify_aggregates():
+    """chat_historyから集計し直した値と集計テーブルの内容が一致するか確認する"""
+    with get_pool(DB_FILE).write() as conn: # 確認中に集計値が更新されないよう書き込みロックを取る
+        delta = aggregates.delta_from_rows(conn.execute(SELECT_AGGREGATE_SOURCE_SQL))
+        stored_stats, stored_sketch = aggregates.read_tables(conn)
+    mismatches = []
+    for key in set(stored_stats) | set(delta.stats):
+        expected, actual = delta.stats.get(key), stored_stats.get(key)
+        if expected is None or actual is None or expected[0] != actual[0] or not all(
+            abs(e - a) <= 1e-6 * max(1.0, abs(e)) for e, a in zip(expected[1:], actual[1:])
+        ):
+            mismatches.append(f"{key}: expected={expected} stored={actual}")
+    for key in set(stored_sketch) | set(delta.sketch):
+        if stored_sketch.get(key, 0) != delta.sketch.get(key, 0):
+            mismatches.append(f"sketch {key}: expected={delta.sketch.get(key, 0)} stored={stored_sketch.get(key, 0)}")
+    for mismatch in mismatches:
+        print(mismatch)
+    print("集計テーブルは一致しています。" if not mismatches else f"{len(mismatches)} 件の不一致があります。")
+    return not mismatches
+
+def get_metrics_summary():
+    """集計テーブルから評価指標分析タブの統計を取得する（テーブルの件数によらず一定時間）"""
+    try:
+        with get_pool(DB_FILE).connection() as conn:
+            return aggregates.load_summary(conn)
+    except sqlite3.Error as e:
+        st.error(f"集計値の取得中にエラーが発生しました: {e}")
+        return None
+
+def get_efficiency_top(limit=10):
+    """効率性スコアの上位limit件を式インデックスを使って取得する"""
+    try:
+        with get_pool(DB_FILE).connection() as conn:
+            return pd.read_sql_query(SELECT_EFFICIENCY_TOP_SQL, conn, params=(limit,))
+    except sqlite3.Error as e:
+        st.error(f"効率性スコアの取得中にエラーが発生しました: {e}")
+        return pd.DataFrame(columns=["id", "efficiency_score"])
+
+def get_metric_sample(metric, limit=1000):
+    """応答時間と指定した指標の散布図用に、直近limit件の値を取得する"""
+    if metric not in aggregates.STATS_COLUMNS:
+        raise ValueError(f"不明な評価指標です: {metric}")
+    try:
+        with get_pool(DB_FILE).connection() as conn:
+            return pd.read_sql_query(SELECT_METRIC_SAMPLE_SQL.format(metric=metric), conn, params=(limit,))
+    except sqlite3.Error as e:
+        st.error(f"評価指標の取得中にエラーが発生しました: {e}")
+        return pd.DataFrame(columns=["response_time", metric, "is_correct"])
+
+# --- 評価指標のバックグラウンド計算 ---
+def score_rows(row_ids):
+    """指定されたレコードの評価指標を計算してまとめてUPDATEする（ワーカースレッドから呼ばれる）"""
+    pool = get_pool(DB_FILE)
+    with pool.connection() as conn:
+        rows = conn.execute(
+            SELECT_FOR_SCORING_SQL.format(placeholders=",".join("?" * len(row_ids))), row_ids
+        ).fetchall()
+
+    # 新しい行の文書頻度をIDFに加える
+    engine = add_to_similarity_corpus(rows)
+
+    # 指標の計算は書き込みロックの外で、バッチ単位でまとめて行う
+    metrics = calculate_metrics_batch([row[1] for row in rows], [row[2] for row in rows], engine)
+
+    # 指標の更新と集計値の加算を同じトランザクションで行う
+    with pool.write() as conn:
+        delta = aggregates.AggregateDelta()
+        for row, (bleu_score, similarity_score, word_count, relevance_score) in zip(rows, metrics):
+            cursor = conn.execute(UPDATE_METRICS_SQL,
+                                  (bleu_score, similarity_score, word_count, relevance_score, row[0]))
+            if cursor.rowcount:
+                delta.add_row(row[3], {"bleu_score": bleu_score, "similarity_score": similarity_score,
+                                       "word_count": word_count, "relevance_score": relevance_score})
+        delta.apply(conn)
+
+# プロセス全体で共有するキュー（Streamlitの再実行ではモジュールは再読み込みされない）
+scoring_queue = ScoringQueue(score_rows)
+
+def enqueue_unscored_rows():
+    """評価指標が未計算のレコードを計算待ちキューに投入する"""
+    with get_pool(DB_FILE).connection() as conn:
+        row_ids = [row[0] for row in conn.execute(SELECT_UNSCORED_SQL)]
+    if row_ids:
+        scoring_queue.submit_many(row_ids)
+        print(f"{len(row_ids)} 件の未計算レコードを評価指標の計算キューに投入しました。")
+
+def get_scoring_status():
+    """評価指標の計算待ち件数と遅延（秒）を返す"""
+    return {"depth": scoring_queue.depth(), "lag": scoring_queue.lag()}
+
+def flush_scoring(timeout=None):
+    """計算待ちの評価指標がすべて保存されるまで待つ（テストやサンプルデータ投入後の確認用）"""
+    return scoring_queue.flush(timeout)
+
 # --- データ操作関数 ---
-def save_to_db(question, answer, feedback, correct_answer, is_correct, response_time):
-    """チャット履歴と評価指標をデータベースに保存する"""
-    conn = None
+def save_to_db(question, answer, feedback, correct_answer, is_correct, response_time, ttft=None):
+    """チャット履歴をデータベースに保存する（評価指標はバックグラウンドで計算される）"""
     try:
-        conn = sqlite3.connect(DB_FILE)
-        c = conn.cursor()
         timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
 
-        # 追加の評価指標を計算
-        bleu_score, similarity_score, word_count, relevance_score = calculate_metrics(
-            answer, correct_answer
-        )
-
-        c.execute(f'''
-        INSERT INTO {TABLE_NAME} (timestamp, question, answer, feedback, correct_answer, is_correct,
-                                 response_time, bleu_score, similarity_score, word_count, relevance_score)
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-        ''', (timestamp, question, answer, feedback, correct_answer, is_correct,
-             response_time, bleu_score, similarity_score, word_count, relevance_score))
-        conn.commit()
+        with get_pool(DB_FILE).write() as conn:
+            cursor = conn.execute(INSERT_SQL, (timestamp, question, answer, feedback, correct_answer,
+                                               is_correct, response_time, ttft))
+            row_id = cursor.lastrowid
+            # 正確性と応答時間の集計値は挿入と同じトランザクションで加算する
+            delta = aggregates.AggregateDelta()
+            delta.add(is_correct, aggregates.ROWS_METRIC, is_correct)
+            delta.add(is_correct, "response_time", response_time)
+            delta.add(is_correct, "ttft", ttft)
+            delta.apply(conn)
+        scoring_queue.submit(row_id)
         print("Data saved to DB successfully.") # デバッグ用
     except sqlite3.Error as e:
         st.error(f"データベースへの保存中にエラーが発生しました: {e}")
-    finally:
-        if conn:
-            conn.close()
 
 def get_chat_history():
     """データベースから全てのチャット履歴を取得する"""
-    conn = None
     try:
-        conn = sqlite3.connect(DB_FILE)
-        # is_correctがREAL型なので、それに応じて読み込む
-        df = pd.read_sql_query(f"SELECT * FROM {TABLE_NAME} ORDER BY timestamp DESC", conn)
+        with get_pool(DB_FILE).connection() as conn:
+            # is_correctがREAL型なので、それに応じて読み込む
+            df = pd.read_sql_query(SELECT_ALL_SQL, conn)
         # is_correct カラムのデータ型を確認し、必要なら変換
         if 'is_correct' in df.columns:
              df['is_correct'] = pd.to_numeric(df['is_correct'], errors='coerce') # 数値に変換、失敗したらNaN
@@ -80,29 +326,55 @@ def get_chat_history():
     except sqlite3.Error as e:
         st.error(f"履歴の取得中にエラーが発生しました: {e}")
         return pd.DataFrame() # 空のDataFrameを返す
-    finally:
-        if conn:
-            conn.close()
+
+def get_chat_history_page(filter_value=None, page=1, page_size=5):
+    """絞り込み・並び替え・ページングをSQLite側で行い、表示する1ページ分の履歴だけを取得する
+
+    Args:
+        filter_value (float): is_correctの値で絞り込む（Noneなら絞り込まない）
+        page (int): 1始まりのページ番号
+        page_size (int): 1ページあたりの件数
+
+    Returns:
+        pd.DataFrame: 新しい順に並んだ最大page_size件の履歴
+    """
+    offset = (page - 1) * page_size
+    try:
+        with get_pool(DB_FILE).connection() as conn:
+            if filter_value is None:
+                df = pd.read_sql_query(SELECT_HISTORY_PAGE_SQL, conn, params=(page_size, offset))
+            else:
+                df = pd.read_sql_query(SELECT_HISTORY_PAGE_FILTERED_SQL, conn,
+                                       params=(filter_value, page_size, offset))
+        return df
+    except sqlite3.Error as e:
+        st.error(f"履歴の取得中にエラーが発生しました: {e}")
+        return pd.DataFrame(columns=HISTORY_LIST_COLUMNS)
+
+def get_chat_history_count(filter_value=None):
+    """is_correctの値で絞り込んだレコード数を取得する（Noneなら全件数）"""
+    if filter_value is None:
+        return get_db_count()
+    try:
+        with get_pool(DB_FILE).connection() as conn:
+            return conn.execute(COUNT_FILTERED_SQL, (filter_value,)).fetchone()[0]
+    except sqlite3.Error as e:
+        st.error(f"レコード数の取得中にエラーが発生しました: {e}")
+        return 0
 
 def get_db_count():
     """データベース内のレコード数を取得する"""
-    conn = None
     try:
-        conn = sqlite3.connect(DB_FILE)
-        c = conn.cursor()
-        c.execute(f"SELECT COUNT(*) FROM {TABLE_NAME}")
-        count = c.fetchone()[0]
+        with get_pool(DB_FILE).connection() as conn:
+            count = conn.execute(COUNT_SQL).fetchone()[0]
         return count
     except sqlite3.Error as e:
         st.error(f"レコード数の取得中にエラーが発生しました: {e}")
         return 0
-    finally:
-        if conn:
-            conn.close()
 
 def clear_db():
     """データベースの全レコードを削除する"""
-    conn = None
+    global _similarity_engine_ready
     confirmed = st.session_state.get("confirm_clear", False)
 
     if not confirmed:
@@ -111,17 +383,15 @@ def clear_db():
         return False # 削除は実行されなかった
 
     try:
-        conn = sqlite3.connect(DB_FILE)
-        c = conn.cursor()
-        c.execute(f"DELETE FROM {TABLE_NAME}")
-        conn.commit()
+        with get_pool(DB_FILE).write() as conn:
+            conn.execute(DELETE_ALL_SQL)
+            aggregates.clear(conn)
+        with _similarity_engine_lock:
+            _similarity_engine_ready = False # 次回の計算時に空のコーパスから構築し直す
         st.success("データベースが正常にクリアされました。")
         st.session_state.confirm_clear = False # 確認状態をリセット
         return True # 削除成功
     except sqlite3.Error as e:
         st.error(f"データベースのクリア中にエラーが発生しました: {e}")
         st.session_state.confirm_clear = False # エラー時もリセット
-        return False # 削除失敗
-    finally:
-        if conn:
-            conn.close()
\ No newline at end of file
+        return False # 削除失敗
\ No newline at end of file
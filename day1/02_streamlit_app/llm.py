@@ -1,10 +1,16 @@
 # llm.py
 import os
+import sys
 import torch
-from transformers import pipeline
+from transformers import pipeline, TextIteratorStreamer
 import streamlit as st
 import time
-from config import MODEL_NAME
+import threading
+import traceback
+from config import MODEL_NAME, CPU_QUANTIZE, CPU_THREADS, CPU_INTEROP_THREADS, CPU_COMPILE
+# day1/common のモジュールを読み込めるようにする（このディレクトリから実行するため）
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.cpu_inference import configure_threads, cpu_model_kwargs, optimize_for_cpu
 from huggingface_hub import login
 
 # モデルをキャッシュして再利用
@@ -18,12 +24,20 @@ def load_model():
         
         device = "cuda" if torch.cuda.is_available() else "cpu"
         st.info(f"Using device: {device}") # 使用デバイスを表示
+        if device == "cpu":
+            configure_threads(CPU_THREADS, CPU_INTEROP_THREADS)
+            model_kwargs = cpu_model_kwargs()
+        else:
+            model_kwargs = {"torch_dtype": torch.bfloat16}
         pipe = pipeline(
             "text-generation",
             model=MODEL_NAME,
-            model_kwargs={"torch_dtype": torch.bfloat16},
+            model_kwargs=model_kwargs,
             device=device
         )
+        if device == "cpu":
+            # CPUではint8量子化とスレッド数の設定で推論を高速化する
+            optimize_for_cpu(pipe, quantize=CPU_QUANTIZE, compile_model=CPU_COMPILE)
         st.success(f"モデル '{MODEL_NAME}' の読み込みに成功しました。")
         return pipe
     except Exception as e:
@@ -84,4 +98,49 @@ def generate_response(pipe, user_question):
         # エラーの詳細をログに出力
         import traceback
         traceback.print_exc()
-        return f"エラーが発生しました: {str(e)}", 0
\ No newline at end of file
+        return f"エラーが発生しました: {str(e)}", 0
+
+def generate_response_stream(pipe, user_question, stats):
+    """LLMの回答をトークンが生成されるたびに少しずつ返すジェネレータ
+
+    st.write_stream() にそのまま渡せる。生成が終わると stats に
+    "ttft"（最初のトークンまでの秒数）と "response_time"（全体の秒数）が記録される。
+    """
+    stats["ttft"] = None
+    stats["response_time"] = 0
+    if pipe is None:
+        yield "モデルがロードされていないため、回答を生成できません。"
+        return
+
+    start_time = time.time()
+    # skip_prompt=True でチャットテンプレートを含む入力部分を除き、生成されたテキストだけを受け取る
+    streamer = TextIteratorStreamer(pipe.tokenizer, skip_prompt=True, skip_special_tokens=True)
+    messages = [
+        {"role": "user", "content": user_question},
+    ]
+    errors = []
+
+    def run_generation():
+        try:
+            pipe(messages, max_new_tokens=512, do_sample=True, temperature=0.7, top_p=0.9, streamer=streamer)
+        except Exception as e:
+            errors.append(e)
+            traceback.print_exc()
+            streamer.end() # 生成が失敗しても読み出し側が止まらないように終了を通知する
+
+    # 生成は別スレッドで行い、このスレッドではストリーマーから届いたテキストを順に返す
+    thread = threading.Thread(target=run_generation, daemon=True)
+    thread.start()
+    for text in streamer:
+        if not text:
+            continue
+        if stats["ttft"] is None:
+            stats["ttft"] = time.time() - start_time
+        yield text
+    thread.join()
+    stats["response_time"] = time.time() - start_time
+
+    if errors:
+        st.error(f"回答生成中にエラーが発生しました: {errors[0]}")
+        yield f"\n\nエラーが発生しました: {str(errors[0])}"
+    print(f"Streamed response in {stats['response_time']:.2f}s (TTFT: {stats['ttft'] or 0:.2f}s)") # デバッグ用
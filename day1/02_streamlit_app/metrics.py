@@ -3,8 +3,8 @@ import streamlit as st
 import nltk
 from janome.tokenizer import Tokenizer
 import re
-from sklearn.metrics.pairwise import cosine_similarity
-from sklearn.feature_extraction.text import TfidfVectorizer
+import threading
+from similarity import SimilarityEngine
 
 # NLTKのヘルパー関数（エラー時フォールバック付き）
 try:
@@ -34,74 +34,111 @@ def initialize_nltk():
     except Exception as e:
         st.error(f"NLTKデータのダウンロードに失敗しました: {e}")
 
+# janomeのTokenizerは生成時に辞書を読み込むため、スレッドごとに1つだけ生成して使い回す
+_tokenizer_local = threading.local()
+
+def get_tokenizer():
+    """現在のスレッド用のjanome Tokenizerを返す（初回呼び出し時に生成）"""
+    tokenizer = getattr(_tokenizer_local, "tokenizer", None)
+    if tokenizer is None:
+        # 単語数しか使わないので、Tokenオブジェクトを作らない分かち書きモードにする
+        tokenizer = Tokenizer(wakati=True)
+        _tokenizer_local.tokenizer = tokenizer
+    return tokenizer
+
+def count_words(texts):
+    """複数のテキストの単語数を1つのTokenizerでまとめて数える"""
+    tokenizer = get_tokenizer()
+    return [sum(1 for _ in tokenizer.tokenize(text)) if text else 0 for text in texts]
+
 def calculate_metrics(answer, correct_answer):
     """回答と正解から評価指標を計算する"""
-    word_count = 0
-    bleu_score = 0.0
-    similarity_score = 0.0
-    relevance_score = 0.0
-
-    if not answer: # 回答がない場合は計算しない
-        return bleu_score, similarity_score, word_count, relevance_score
-
-    # 単語数のカウント
-    tokenizer = Tokenizer()
-    tokens = list(tokenizer.tokenize(answer))  # ← list() でイテレータをリストに変換
-    word_count = len(tokens)
-
-    # 正解がある場合のみBLEUと類似度を計算
-    if correct_answer:
-        answer_lower = answer.lower()
-        correct_answer_lower = correct_answer.lower()
-
-        # BLEU スコアの計算
-        try:
-            reference = [nltk_word_tokenize(correct_answer_lower)]
-            candidate = nltk_word_tokenize(answer_lower)
-            # ゼロ除算エラーを防ぐ
-            if candidate:
-                bleu_score = nltk_sentence_bleu(reference, candidate, weights=(0.25, 0.25, 0.25, 0.25)) # 4-gram BLEU
-            else:
-                bleu_score = 0.0
-        except Exception as e:
-            # st.warning(f"BLEUスコア計算エラー: {e}")
-            bleu_score = 0.0 # エラー時は0
-
-        # コサイン類似度の計算
-        try:
-            vectorizer = TfidfVectorizer()
-            # fit_transformはリストを期待するため、リストで渡す
-            if answer_lower.strip() and correct_answer_lower.strip(): # 空文字列でないことを確認
-                tfidf_matrix = vectorizer.fit_transform([answer_lower, correct_answer_lower])
-                similarity_score = cosine_similarity(tfidf_matrix[0:1], tfidf_matrix[1:2])[0][0]
-            else:
-                similarity_score = 0.0
-        except Exception as e:
-            # st.warning(f"類似度スコア計算エラー: {e}")
-            similarity_score = 0.0 # エラー時は0
-
-        # 関連性スコア（キーワードの一致率などで簡易的に計算）
-        try:
-            answer_words = set(re.findall(r'\w+', answer_lower))
-            correct_words = set(re.findall(r'\w+', correct_answer_lower))
-            if len(correct_words) > 0:
-                common_words = answer_words.intersection(correct_words)
-                relevance_score = len(common_words) / len(correct_words)
-            else:
-                relevance_score = 0.0
-        except Exception as e:
-            # st.warning(f"関連性スコア計算エラー: {e}")
-            relevance_score = 0.0 # エラー時は0
-
-    return bleu_score, similarity_score, word_count, relevance_score
+    return calculate_metrics_batch([answer], [correct_answer])[0]
+
+def calculate_metrics_batch(answers, correct_answers, similarity_engine=None):
+    """複数の回答と正解から評価指標をまとめて計算する
+
+    Args:
+        similarity_engine (SimilarityEngine): 類似度のIDFに使うエンジン。
+            未指定の場合はこのバッチ自体をコーパスとしてIDFを求める。
+
+    Returns:
+        list: (bleu_score, similarity_score, word_count, relevance_score) のリスト（入力と同じ順序）
+    """
+    # 単語数のカウント（全回答を1回でトークン化）
+    word_counts = count_words(answers)
+
+    # コサイン類似度の計算（全ペアを1回の疎行列演算で計算）
+    similarity_scores = calculate_similarity_scores(answers, correct_answers, similarity_engine)
+
+    results = []
+    for answer, correct_answer, word_count, similarity_score in zip(
+        answers, correct_answers, word_counts, similarity_scores
+    ):
+        bleu_score = 0.0
+        relevance_score = 0.0
+
+        # 回答がない場合は計算しない
+        # 正解がある場合のみBLEUと関連性を計算（類似度はどちらかが空なら0になる）
+        if answer and correct_answer:
+            bleu_score, relevance_score = _calculate_pair_scores(answer, correct_answer)
+
+        results.append((bleu_score, float(similarity_score), word_count, relevance_score))
+    return results
+
+def calculate_similarity_scores(answers, correct_answers, similarity_engine=None):
+    """全ペアのTF-IDFコサイン類似度を計算する（エラー時は全て0）"""
+    answers_lower = [answer.lower() if answer else "" for answer in answers]
+    correct_answers_lower = [correct.lower() if correct else "" for correct in correct_answers]
+    try:
+        if similarity_engine is None:
+            similarity_engine = SimilarityEngine().partial_fit(answers_lower + correct_answers_lower)
+        return similarity_engine.score_pairs(answers_lower, correct_answers_lower)
+    except Exception as e:
+        # st.warning(f"類似度スコア計算エラー: {e}")
+        return [0.0] * len(answers) # エラー時は0
+
+def _calculate_pair_scores(answer, correct_answer):
+    """回答と正解のペアからBLEU・関連性スコアを計算する"""
+    answer_lower = answer.lower()
+    correct_answer_lower = correct_answer.lower()
+
+    # BLEU スコアの計算
+    try:
+        reference = [nltk_word_tokenize(correct_answer_lower)]
+        candidate = nltk_word_tokenize(answer_lower)
+        # ゼロ除算エラーを防ぐ
+        if candidate:
+            bleu_score = nltk_sentence_bleu(reference, candidate, weights=(0.25, 0.25, 0.25, 0.25)) # 4-gram BLEU
+        else:
+            bleu_score = 0.0
+    except Exception as e:
+        # st.warning(f"BLEUスコア計算エラー: {e}")
+        bleu_score = 0.0 # エラー時は0
+
+    # 関連性スコア（キーワードの一致率などで簡易的に計算）
+    try:
+        answer_words = set(re.findall(r'\w+', answer_lower))
+        correct_words = set(re.findall(r'\w+', correct_answer_lower))
+        if len(correct_words) > 0:
+            common_words = answer_words.intersection(correct_words)
+            relevance_score = len(common_words) / len(correct_words)
+        else:
+            relevance_score = 0.0
+    except Exception as e:
+        # st.warning(f"関連性スコア計算エラー: {e}")
+        relevance_score = 0.0 # エラー時は0
+
+    return bleu_score, relevance_score
 
 def get_metrics_descriptions():
     """評価指標の説明を返す"""
     return {
         "正確性スコア (is_correct)": "回答の正確さを3段階で評価: 1.0 (正確), 0.5 (部分的に正確), 0.0 (不正確)",
         "応答時間 (response_time)": "質問を投げてから回答を得るまでの時間（秒）。モデルの効率性を表す",
+        "最初のトークンまでの時間 (ttft)": "質問を投げてから回答の最初のトークンが表示されるまでの時間（秒）。体感的な応答速度を表す",
         "BLEU スコア (bleu_score)": "機械翻訳評価指標で、正解と回答のn-gramの一致度を測定 (0〜1の値、高いほど類似)",
-        "類似度スコア (similarity_score)": "TF-IDFベクトルのコサイン類似度による、正解と回答の意味的な類似性 (0〜1の値)",
+        "類似度スコア (similarity_score)": "TF-IDFベクトル（IDFはチャット履歴全体から算出）のコサイン類似度による、正解と回答の意味的な類似性 (0〜1の値)",
         "単語数 (word_count)": "回答に含まれる単語の数。情報量や詳細さの指標",
         "関連性スコア (relevance_score)": "正解と回答の共通単語の割合。トピックの関連性を表す (0〜1の値)",
         "効率性スコア (efficiency_score)": "正確性を応答時間で割った値。高速で正確な回答ほど高スコア"
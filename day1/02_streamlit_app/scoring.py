@@ -0,0 +1,126 @@
+# scoring.py
+import threading
+import queue
+import time
+import traceback
+from config import SCORING_WORKERS, SCORING_BATCH_SIZE, SCORING_BATCH_WAIT
+
+
+class ScoringQueue:
+    """評価指標の計算をリクエストスレッドから切り離すためのバックグラウンドキュー
+
+    submit()されたレコードIDをワーカースレッドがまとめて取り出し、
+    process_batch(row_ids) を呼び出して指標を計算・保存する。
+    """
+
+    def __init__(self, process_batch, workers=SCORING_WORKERS,
+                 batch_size=SCORING_BATCH_SIZE, batch_wait=SCORING_BATCH_WAIT):
+        self.process_batch = process_batch
+        self.workers = workers
+        self.batch_size = batch_size
+        self.batch_wait = batch_wait
+        self._queue = queue.Queue()
+        self._pending = {}  # row_id -> 投入時刻（挿入順 = 古い順）
+        self._cond = threading.Condition()
+        self._threads = []
+        self._stopping = False
+        self.processed = 0
+        self.failed = 0
+
+    def start(self):
+        """ワーカースレッドを起動する（起動済みなら何もしない）"""
+        with self._cond:
+            if self._threads:
+                return
+            self._stopping = False
+            for i in range(self.workers):
+                t = threading.Thread(target=self._worker, name=f"scoring-worker-{i}", daemon=True)
+                t.start()
+                self._threads.append(t)
+
+    def submit(self, row_id):
+        """レコードIDを計算待ちキューに追加する"""
+        self.submit_many([row_id])
+
+    def submit_many(self, row_ids):
+        """複数のレコードIDを計算待ちキューに追加する"""
+        self.start()
+        now = time.monotonic()
+        with self._cond:
+            for row_id in row_ids:
+                if row_id in self._pending:
+                    continue
+                self._pending[row_id] = now
+                self._queue.put(row_id)
+
+    def depth(self):
+        """計算待ち（処理中を含む）のレコード数"""
+        with self._cond:
+            return len(self._pending)
+
+    def lag(self):
+        """最も古い計算待ちレコードが投入されてからの経過秒数（待ちがなければ0）"""
+        with self._cond:
+            if not self._pending:
+                return 0.0
+            oldest = next(iter(self._pending.values()))
+        return time.monotonic() - oldest
+
+    def flush(self, timeout=None):
+        """計算待ちがなくなるまで待つ。タイムアウトした場合はFalseを返す"""
+        with self._cond:
+            return self._cond.wait_for(lambda: not self._pending, timeout=timeout)
+
+    def stop(self, timeout=None):
+        """ワーカースレッドを停止する（テスト用）"""
+        with self._cond:
+            threads, self._threads = self._threads, []
+            self._stopping = True
+        for _ in threads:
+            self._queue.put(None)
+        for t in threads:
+            t.join(timeout)
+
+    def _next_batch(self):
+        """最初の1件をブロックして待ち、その後batch_wait秒以内に届いた分をまとめて返す"""
+        first = self._queue.get()
+        if first is None:
+            return None
+        batch = [first]
+        deadline = time.monotonic() + self.batch_wait
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                item = self._queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if item is None:
+                self._queue.put(None)  # 停止シグナルは次のループで処理する
+                break
+            batch.append(item)
+        return batch
+
+    def _worker(self):
+        while not self._stopping:
+            batch = self._next_batch()
+            if batch is None:
+                break
+            ok = False
+            try:
+                self.process_batch(batch)
+                ok = True
+            except Exception as e:
+                # 失敗したレコードは指標がNULLのまま残り、次回起動時に再投入される
+                print(f"評価指標の計算中にエラーが発生しました: {e}")
+                traceback.print_exc()
+            finally:
+                with self._cond:
+                    if ok:
+                        self.processed += len(batch)
+                    else:
+                        self.failed += len(batch)
+                    for row_id in batch:
+                        self._pending.pop(row_id, None)
+                    self._cond.notify_all()
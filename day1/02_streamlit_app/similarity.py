@@ -0,0 +1,77 @@
+# similarity.py
+import threading
+import numpy as np
+from sklearn.feature_extraction.text import HashingVectorizer
+from sklearn.preprocessing import normalize
+
+# ハッシュ空間の次元数（語彙を保持しないため、文書を追加してもモデルの再構築が不要）
+N_FEATURES = 2 ** 18
+
+
+class SimilarityEngine:
+    """コーパス全体で共通のIDFを使うTF-IDFコサイン類似度エンジン
+
+    ペアごとにTfidfVectorizerをfitすると、IDFがそのペアだけで決まるため
+    行間でスコアを比較できない。このエンジンは文書頻度（DF）を逐次的に集計し、
+    全ての (回答, 正解) ペアを同じIDFでまとめてスコアリングする。
+    IDFの式・トークナイズ・L2正規化は TfidfVectorizer のデフォルト設定と同じ。
+    """
+
+    def __init__(self, n_features=N_FEATURES):
+        self.n_features = n_features
+        # TfidfVectorizerのデフォルト（小文字化・token_pattern）に合わせ、正規化は自前で行う
+        self._vectorizer = HashingVectorizer(n_features=n_features, alternate_sign=False, norm=None)
+        self._df = np.zeros(n_features, dtype=np.int64)
+        self._n_docs = 0
+        self._lock = threading.Lock()
+
+    @property
+    def n_docs(self):
+        """IDFの計算に使われた文書数"""
+        return self._n_docs
+
+    def partial_fit(self, documents):
+        """文書をコーパスに追加し、文書頻度を更新する"""
+        documents = [doc or "" for doc in documents]
+        if not documents:
+            return self
+        counts = self._vectorizer.transform(documents)
+        # 各文書で出現した特徴を1回ずつ数える（CSRのindicesは文書内で重複しない）
+        df = np.bincount(counts.indices, minlength=self.n_features)
+        with self._lock:
+            self._df += df
+            self._n_docs += len(documents)
+        return self
+
+    def reset(self):
+        """集計済みの文書頻度を破棄する"""
+        with self._lock:
+            self._df[:] = 0
+            self._n_docs = 0
+
+    def _idf(self):
+        """smooth_idf=True のIDF: log((1 + n) / (1 + df)) + 1"""
+        with self._lock:
+            df = self._df.copy()
+            n_docs = self._n_docs
+        return np.log((1 + n_docs) / (1 + df)) + 1.0
+
+    def transform(self, documents, idf=None):
+        """文書をL2正規化済みのTF-IDF疎行列に変換する"""
+        if idf is None:
+            idf = self._idf()
+        tfidf = self._vectorizer.transform([doc or "" for doc in documents]).tocsr()
+        tfidf.data *= idf[tfidf.indices]
+        return normalize(tfidf, norm="l2", copy=False)
+
+    def score_pairs(self, answers, correct_answers):
+        """(回答, 正解) ペアごとのコサイン類似度を1回の疎行列演算で計算する
+
+        Returns:
+            numpy.ndarray: 入力と同じ順序の類似度（どちらかが空なら0）
+        """
+        idf = self._idf()
+        answer_matrix = self.transform(answers, idf)
+        correct_matrix = self.transform(correct_answers, idf)
+        # 行ごとのコサイン = 正規化済みベクトルの要素積の行和
+        return np.asarray(answer_matrix.multiply(correct_matrix).sum(axis=1)).ravel()
@@ -0,0 +1,145 @@
+# storage.py
+import sqlite3
+import threading
+import queue
+from contextlib import contextmanager
+from config import DB_FILE, DB_POOL_SIZE, DB_BUSY_TIMEOUT, DB_CACHE_SIZE_KB, DB_MMAP_SIZE
+
+# 接続ごとに適用するPRAGMA
+# - journal_mode=WAL: 読み込みが書き込みをブロックしない
+# - synchronous=NORMAL: WALモードではコミットごとのfsyncを省略しても破損しない
+# - cache_size: 負の値はKiB単位の指定
+# - mmap_size: 読み込みをメモリマップ経由で行い、read()システムコールを減らす
+PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    f"PRAGMA cache_size=-{DB_CACHE_SIZE_KB}",
+    f"PRAGMA mmap_size={DB_MMAP_SIZE}",
+    "PRAGMA temp_store=MEMORY",
+    f"PRAGMA busy_timeout={int(DB_BUSY_TIMEOUT * 1000)}",
+)
+
+# sqlite3は接続ごとにコンパイル済みステートメントをキャッシュする。
+# SQL文字列を定数として使い回すことで、プリペアドステートメントとして再利用される。
+STATEMENT_CACHE_SIZE = 128
+
+
+class ConnectionPool:
+    """SQLite接続を使い回すためのスレッドセーフな接続プール"""
+
+    def __init__(self, db_file=DB_FILE, size=DB_POOL_SIZE, timeout=DB_BUSY_TIMEOUT):
+        self.db_file = db_file
+        self.size = size
+        self.timeout = timeout
+        self._idle = queue.LifoQueue(maxsize=size)  # 直近に使った接続（キャッシュが温まっている）を優先
+        self._created = 0
+        self._lock = threading.Lock()
+        # SQLiteの書き込みは常に1つずつ。プロセス内の書き込みはここで順番待ちさせ、
+        # busy_timeoutによるスリープ＆リトライを避ける
+        self._write_lock = threading.Lock()
+        self._closed = False
+
+    def _connect(self):
+        """PRAGMAを適用した新しい接続を作成する"""
+        conn = sqlite3.connect(
+            self.db_file,
+            timeout=self.timeout,
+            check_same_thread=False,  # プール経由で別スレッドに貸し出すため
+            cached_statements=STATEMENT_CACHE_SIZE,
+        )
+        for pragma in PRAGMAS:
+            conn.execute(pragma)
+        return conn
+
+    def _acquire(self):
+        """アイドル接続を取得する。なければ上限まで新規作成し、上限に達していれば空くまで待つ"""
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            if self._closed:
+                raise sqlite3.ProgrammingError("Connection pool is closed.")
+            if self._created < self.size:
+                self._created += 1
+                create = True
+            else:
+                create = False
+        if create:
+            try:
+                return self._connect()
+            except Exception:
+                with self._lock:
+                    self._created -= 1
+                raise
+        try:
+            return self._idle.get(timeout=self.timeout)
+        except queue.Empty:
+            raise sqlite3.OperationalError(
+                f"接続プールから接続を取得できませんでした（{self.timeout}秒でタイムアウト）"
+            )
+
+    def _release(self, conn):
+        """接続をプールに戻す。プールが閉じられていれば接続を閉じる"""
+        if self._closed:
+            conn.close()
+            with self._lock:
+                self._created -= 1
+            return
+        self._idle.put_nowait(conn)
+
+    @contextmanager
+    def connection(self):
+        """読み込み用の接続を貸し出す。例外時はロールバックしてからプールに戻す"""
+        conn = self._acquire()
+        try:
+            yield conn
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            self._release(conn)
+
+    @contextmanager
+    def write(self):
+        """書き込み用の接続を貸し出し、正常終了時にコミットする"""
+        with self._write_lock:
+            with self.connection() as conn:
+                yield conn
+                conn.commit()
+
+    def close_all(self):
+        """アイドル状態の接続をすべて閉じる（貸出中の接続は返却時に閉じられる）"""
+        with self._lock:
+            self._closed = True
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            conn.close()
+            with self._lock:
+                self._created -= 1
+
+
+# --- プロセス全体で共有する接続プール ---
+_pools = {}
+_pools_lock = threading.Lock()
+
+def get_pool(db_file=DB_FILE):
+    """DBファイルごとの共有接続プールを取得する（Streamlitの全セッションで共有される）"""
+    pool = _pools.get(db_file)
+    if pool is None:
+        with _pools_lock:
+            pool = _pools.get(db_file)
+            if pool is None:
+                pool = ConnectionPool(db_file)
+                _pools[db_file] = pool
+    return pool
+
+def close_pool(db_file=DB_FILE):
+    """共有接続プールを破棄する（テストやベンチマークでDBファイルを差し替える場合など）"""
+    with _pools_lock:
+        pool = _pools.pop(db_file, None)
+    if pool is not None:
+        pool.close_all()
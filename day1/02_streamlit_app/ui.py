@@ -2,8 +2,10 @@
 import streamlit as st
 import pandas as pd
 import time
-from database import save_to_db, get_chat_history, get_db_count, clear_db
-from llm import generate_response
+from database import (save_to_db, get_chat_history_page, get_chat_history_count, get_db_count, clear_db,
+                      get_scoring_status, recompute_similarity_scores, get_metrics_summary,
+                      get_efficiency_top, get_metric_sample)
+from llm import generate_response_stream
 from data import create_sample_evaluation_data
 from metrics import get_metrics_descriptions
 
@@ -21,6 +23,8 @@ def display_chat_page(pipe):
         st.session_state.current_answer = ""
     if "response_time" not in st.session_state:
         st.session_state.response_time = 0.0
+    if "ttft" not in st.session_state:
+        st.session_state.ttft = None
     if "feedback_given" not in st.session_state:
         st.session_state.feedback_given = False
 
@@ -30,18 +34,24 @@ def display_chat_page(pipe):
         st.session_state.current_answer = "" # 回答をリセット
         st.session_state.feedback_given = False # フィードバック状態もリセット
 
-        with st.spinner("モデルが回答を生成中..."):
-            answer, response_time = generate_response(pipe, user_question)
-            st.session_state.current_answer = answer
-            st.session_state.response_time = response_time
-            # ここでrerunすると回答とフィードバックが一度に表示される
-            st.rerun()
+        # 生成されたトークンを順に表示する（最初のトークンまでの時間と全体の時間はstatsに記録される）
+        st.subheader("回答:")
+        stats = {}
+        answer = st.write_stream(generate_response_stream(pipe, user_question, stats))
+        st.session_state.current_answer = answer.strip()
+        st.session_state.response_time = stats.get("response_time", 0.0)
+        st.session_state.ttft = stats.get("ttft")
+        # ここでrerunすると回答とフィードバックが一度に表示される
+        st.rerun()
 
     # 回答が表示されるべきか判断 (質問があり、回答が生成済みで、まだフィードバックされていない)
     if st.session_state.current_question and st.session_state.current_answer:
         st.subheader("回答:")
         st.markdown(st.session_state.current_answer) # Markdownで表示
-        st.info(f"応答時間: {st.session_state.response_time:.2f}秒")
+        if st.session_state.ttft is not None:
+            st.info(f"応答時間: {st.session_state.response_time:.2f}秒（最初のトークンまで: {st.session_state.ttft:.2f}秒）")
+        else:
+            st.info(f"応答時間: {st.session_state.response_time:.2f}秒")
 
         # フィードバックフォームを表示 (まだフィードバックされていない場合)
         if not st.session_state.feedback_given:
@@ -53,6 +63,7 @@ def display_chat_page(pipe):
                   st.session_state.current_question = ""
                   st.session_state.current_answer = ""
                   st.session_state.response_time = 0.0
+                  st.session_state.ttft = None
                   st.session_state.feedback_given = False
                   st.rerun() # 画面をクリア
 
@@ -81,7 +92,8 @@ def display_feedback_form():
                 combined_feedback,
                 correct_answer,
                 is_correct,
-                st.session_state.response_time
+                st.session_state.response_time,
+                ttft=st.session_state.ttft
             )
             st.session_state.feedback_given = True
             st.success("フィードバックが保存されました！")
@@ -93,9 +105,8 @@ def display_feedback_form():
 def display_history_page():
     """履歴閲覧ページのUIを表示する"""
     st.subheader("チャット履歴と評価指標")
-    history_df = get_chat_history()
 
-    if history_df.empty:
+    if get_db_count() == 0:
         st.info("まだチャット履歴がありません。")
         return
 
@@ -103,13 +114,13 @@ def display_history_page():
     tab1, tab2 = st.tabs(["履歴閲覧", "評価指標分析"])
 
     with tab1:
-        display_history_list(history_df)
+        display_history_list()
 
     with tab2:
-        display_metrics_analysis(history_df)
+        display_metrics_analysis()
 
-def display_history_list(history_df):
-    """履歴リストを表示する"""
+def display_history_list():
+    """履歴リストを表示する（表示するページの行だけをデータベースから取得する）"""
     st.write("#### 履歴リスト")
     # 表示オプション
     filter_options = {
@@ -126,25 +137,21 @@ def display_history_list(history_df):
     )
 
     filter_value = filter_options[display_option]
-    if filter_value is not None:
-        # is_correctがNaNの場合を考慮
-        filtered_df = history_df[history_df["is_correct"].notna() & (history_df["is_correct"] == filter_value)]
-    else:
-        filtered_df = history_df
+    # 件数だけを数え、絞り込みはSQLite側で行う（is_correctがNULLの行は絞り込み時に一致しない）
+    total_items = get_chat_history_count(filter_value)
 
-    if filtered_df.empty:
+    if total_items == 0:
         st.info("選択した条件に一致する履歴はありません。")
         return
 
     # ページネーション
     items_per_page = 5
-    total_items = len(filtered_df)
     total_pages = (total_items + items_per_page - 1) // items_per_page
     current_page = st.number_input('ページ', min_value=1, max_value=total_pages, value=1, step=1)
 
     start_idx = (current_page - 1) * items_per_page
     end_idx = start_idx + items_per_page
-    paginated_df = filtered_df.iloc[start_idx:end_idx]
+    paginated_df = get_chat_history_page(filter_value, page=current_page, page_size=items_per_page)
 
 
     for i, row in paginated_df.iterrows():
@@ -160,33 +167,35 @@ def display_history_list(history_df):
             cols = st.columns(3)
             cols[0].metric("正確性スコア", f"{row['is_correct']:.1f}")
             cols[1].metric("応答時間(秒)", f"{row['response_time']:.2f}")
-            cols[2].metric("単語数", f"{row['word_count']}")
+            # 評価指標はバックグラウンドで計算されるため、未計算の間はNaNになる
+            cols[2].metric("単語数", f"{row['word_count']:.0f}" if pd.notna(row['word_count']) else "-")
 
             cols = st.columns(3)
             # NaNの場合はハイフン表示
             cols[0].metric("BLEU", f"{row['bleu_score']:.4f}" if pd.notna(row['bleu_score']) else "-")
             cols[1].metric("類似度", f"{row['similarity_score']:.4f}" if pd.notna(row['similarity_score']) else "-")
             cols[2].metric("関連性", f"{row['relevance_score']:.4f}" if pd.notna(row['relevance_score']) else "-")
+            if pd.notna(row['ttft']):
+                st.caption(f"最初のトークンまでの時間: {row['ttft']:.2f}秒")
 
     st.caption(f"{total_items} 件中 {start_idx+1} - {min(end_idx, total_items)} 件を表示")
 
 
-def display_metrics_analysis(history_df):
-    """評価指標の分析結果を表示する"""
+def display_metrics_analysis():
+    """評価指標の分析結果を表示する（集計テーブルと上位N件のクエリだけを使う）"""
     st.write("#### 評価指標の分析")
 
-    # is_correct が NaN のレコードを除外して分析
-    analysis_df = history_df.dropna(subset=['is_correct'])
-    if analysis_df.empty:
+    # is_correct が NULL のレコードは集計対象外
+    summary = get_metrics_summary()
+    if summary is None or not summary["accuracy_counts"]:
         st.warning("分析可能な評価データがありません。")
         return
 
     accuracy_labels = {1.0: '正確', 0.5: '部分的に正確', 0.0: '不正確'}
-    analysis_df['正確性'] = analysis_df['is_correct'].map(accuracy_labels)
 
     # 正確性の分布
     st.write("##### 正確性の分布")
-    accuracy_counts = analysis_df['正確性'].value_counts()
+    accuracy_counts = pd.Series(summary["accuracy_counts"]).rename(index=accuracy_labels)
     if not accuracy_counts.empty:
         st.bar_chart(accuracy_counts)
     else:
@@ -196,7 +205,7 @@ def display_metrics_analysis(history_df):
     st.write("##### 応答時間とその他の指標の関係")
     metric_options = ["bleu_score", "similarity_score", "relevance_score", "word_count"]
     # 利用可能な指標のみ選択肢に含める
-    valid_metric_options = [m for m in metric_options if m in analysis_df.columns and analysis_df[m].notna().any()]
+    valid_metric_options = [m for m in metric_options if m in summary["describe"].columns]
 
     if valid_metric_options:
         metric_option = st.selectbox(
@@ -205,14 +214,18 @@ def display_metrics_analysis(history_df):
             key="metric_select"
         )
 
-        chart_data = analysis_df[['response_time', metric_option, '正確性']].dropna() # NaNを除外
+        # 全件ではなく直近の一定件数だけをプロットする
+        sample_size = 1000
+        chart_data = get_metric_sample(metric_option, limit=sample_size)
         if not chart_data.empty:
+             chart_data['正確性'] = chart_data['is_correct'].map(accuracy_labels)
              st.scatter_chart(
                 chart_data,
                 x='response_time',
                 y=metric_option,
                 color='正確性',
             )
+             st.caption(f"直近 {len(chart_data)} 件を表示しています（最大 {sample_size} 件）")
         else:
             st.info(f"選択された指標 ({metric_option}) と応答時間の有効なデータがありません。")
 
@@ -220,46 +233,35 @@ def display_metrics_analysis(history_df):
         st.info("応答時間と比較できる指標データがありません。")
 
 
-    # 全体の評価指標の統計
+    # 全体の評価指標の統計（パーセンタイルは相対誤差1%の近似値）
     st.write("##### 評価指標の統計")
-    stats_cols = ['response_time', 'bleu_score', 'similarity_score', 'word_count', 'relevance_score']
-    valid_stats_cols = [c for c in stats_cols if c in analysis_df.columns and analysis_df[c].notna().any()]
-    if valid_stats_cols:
-        metrics_stats = analysis_df[valid_stats_cols].describe()
+    metrics_stats = summary["describe"]
+    if not metrics_stats.empty:
         st.dataframe(metrics_stats)
+        st.caption("25%/50%/75% は分位点スケッチによる近似値です（相対誤差1%以内）。")
     else:
         st.info("統計情報を計算できる評価指標データがありません。")
 
     # 正確性レベル別の平均スコア
     st.write("##### 正確性レベル別の平均スコア")
-    if valid_stats_cols and '正確性' in analysis_df.columns:
-        try:
-            accuracy_groups = analysis_df.groupby('正確性')[valid_stats_cols].mean()
-            st.dataframe(accuracy_groups)
-        except Exception as e:
-            st.warning(f"正確性別スコアの集計中にエラーが発生しました: {e}")
+    accuracy_groups = summary["group_means"]
+    if not accuracy_groups.empty:
+        accuracy_groups = accuracy_groups.rename(index=accuracy_labels)
+        accuracy_groups.index.name = '正確性'
+        st.dataframe(accuracy_groups)
     else:
          st.info("正確性レベル別の平均スコアを計算できるデータがありません。")
 
 
     # カスタム評価指標：効率性スコア
     st.write("##### 効率性スコア (正確性 / (応答時間 + 0.1))")
-    if 'response_time' in analysis_df.columns and analysis_df['response_time'].notna().any():
-        # ゼロ除算を避けるために0.1を追加
-        analysis_df['efficiency_score'] = analysis_df['is_correct'] / (analysis_df['response_time'].fillna(0) + 0.1)
-        # IDカラムが存在するか確認
-        if 'id' in analysis_df.columns:
-            # 上位10件を表示
-            top_efficiency = analysis_df.sort_values('efficiency_score', ascending=False).head(10)
-            # id をインデックスにする前に存在確認
-            if not top_efficiency.empty:
-                st.bar_chart(top_efficiency.set_index('id')['efficiency_score'])
-            else:
-                st.info("効率性スコアデータがありません。")
+    if 'response_time' in metrics_stats.columns:
+        # 上位10件だけを式インデックスから取得する
+        top_efficiency = get_efficiency_top(10)
+        if not top_efficiency.empty:
+            st.bar_chart(top_efficiency.set_index('id')['efficiency_score'])
         else:
-            # IDがない場合は単純にスコアを表示
-             st.bar_chart(analysis_df.sort_values('efficiency_score', ascending=False).head(10)['efficiency_score'])
-
+            st.info("効率性スコアデータがありません。")
     else:
         st.info("効率性スコアを計算するための応答時間データがありません。")
 
@@ -270,6 +272,9 @@ def display_data_page():
     st.subheader("サンプル評価データの管理")
     count = get_db_count()
     st.write(f"現在のデータベースには {count} 件のレコードがあります。")
+    scoring_status = get_scoring_status()
+    if scoring_status["depth"] > 0:
+        st.caption(f"評価指標の計算待ち: {scoring_status['depth']} 件（最大遅延 {scoring_status['lag']:.1f}秒）")
 
     col1, col2 = st.columns(2)
     with col1:
@@ -283,6 +288,12 @@ def display_data_page():
             if clear_db(): # clear_db内で確認と実行を行う
                 st.rerun() # クリア後に件数表示を更新
 
+    # IDFはチャット履歴全体から算出するため、データが増えた後に全件を同じIDFで揃え直せるようにする
+    if st.button("類似度スコアを再計算", key="recompute_similarity"):
+        with st.spinner("類似度スコアを再計算中..."):
+            updated = recompute_similarity_scores()
+        st.success(f"{updated} 件の類似度スコアを再計算しました。")
+
     # 評価指標に関する解説
     st.subheader("評価指標の説明")
     metrics_info = get_metrics_descriptions()
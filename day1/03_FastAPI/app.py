@@ -1,27 +1,98 @@
 import os
+import sys
 import torch
-from transformers import pipeline
+from transformers import pipeline, set_seed
 import time
 import traceback
 from fastapi import FastAPI, HTTPException, BackgroundTasks
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, Response, StreamingResponse
 from pydantic import BaseModel
 from typing import Optional, List, Dict, Any
 import uvicorn
 import nest_asyncio
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from pyngrok import ngrok
+from batching import BatchScheduler, generate_batch
+from streaming import AsyncTextStreamer, generate_stream, sse_event
+from response_cache import ResponseCache, cache_key, is_cacheable
+from prefix_cache import PrefixCache, supports_prefix_cache
+from generation import GenerationTimer, generate_text
+from model_registry import ModelRegistry, UnknownModelError
+# day1/common のモジュールを読み込めるようにする（このディレクトリから実行するため）
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.cpu_inference import configure_threads, cpu_model_kwargs, optimize_for_cpu
+import metrics
 
 # --- 設定 ---
 # モデル名を設定
 MODEL_NAME = "google/gemma-2-2b-jpn-it"  # お好みのモデルに変更可能です
 print(f"モデル名を設定: {MODEL_NAME}")
 
+# リクエストの model フィールドで指定できるモデル {モデル名: HuggingFaceのモデルID}
+# （common/config.py の SUPPORTED_MODELS と同じgpt2系列 + 既定のGemma）
+SUPPORTED_MODELS = {
+    "gemma-2-2b-jpn-it": MODEL_NAME,
+    "gpt2": "gpt2",
+    "gpt2-medium": "gpt2-medium",
+    "gpt2-large": "gpt2-large",
+    "gpt2-xl": "gpt2-xl",
+}
+
+def parse_models(value):
+    """環境変数 MODELS（"名前=モデルID,名前=モデルID"）を辞書にする"""
+    models = {}
+    for item in value.split(","):
+        if item.strip():
+            name, _, model_id = item.partition("=")
+            models[name.strip()] = (model_id or name).strip()
+    return models
+
 # --- モデル設定クラス ---
 class Config:
     def __init__(self, model_name=MODEL_NAME):
         self.MODEL_NAME = model_name
+        # 提供するモデルと、model を指定しないリクエストで使うモデル
+        self.MODELS = parse_models(os.environ["MODELS"]) if os.environ.get("MODELS") else dict(SUPPORTED_MODELS)
+        default_name = next((name for name, model_id in self.MODELS.items() if model_id == model_name), None)
+        self.DEFAULT_MODEL = os.environ.get("DEFAULT_MODEL", default_name or next(iter(self.MODELS)))
+        # 常駐させるモデルの合計サイズの上限（MB）。超えた分は最も長く使われていないモデルから解放する
+        self.MODEL_MEMORY_BUDGET_MB = int(os.environ.get("MODEL_MEMORY_BUDGET_MB", 8192))
+        # 同時に実行する推論の数（GPU/CPUを共有するため、既定では1つずつ実行する）
+        self.INFERENCE_CONCURRENCY = int(os.environ.get("INFERENCE_CONCURRENCY", 1))
+        # 実行待ちで受け付けるリクエスト数の上限。超えた分は429を返す
+        self.MAX_QUEUE_SIZE = int(os.environ.get("MAX_QUEUE_SIZE", 16))
+        # 動的バッチング（同時に届いたリクエストをまとめて1回で推論する）
+        self.BATCHING_ENABLED = os.environ.get("BATCHING_ENABLED", "0") == "1"
+        self.MAX_BATCH_SIZE = int(os.environ.get("MAX_BATCH_SIZE", 8))
+        self.BATCH_WAIT_MS = float(os.environ.get("BATCH_WAIT_MS", 10))
+        # 応答キャッシュ（do_sample=False またはseed指定のリクエストが対象。件数を0にすると無効）
+        self.RESPONSE_CACHE_SIZE = int(os.environ.get("RESPONSE_CACHE_SIZE", 256))
+        self.RESPONSE_CACHE_TTL = float(os.environ.get("RESPONSE_CACHE_TTL", 3600))
+        self.RESPONSE_CACHE_DISK = os.environ.get("RESPONSE_CACHE_DISK")  # SQLiteファイルのパス（未設定ならメモリのみ）
+        self.RESPONSE_CACHE_DISK_SIZE = int(os.environ.get("RESPONSE_CACHE_DISK_SIZE", 10000))
+        self.RESPONSE_CACHE_MAX_MB = float(os.environ.get("RESPONSE_CACHE_MAX_MB", 64))  # メモリに保持する応答の合計サイズ
+        self.RESPONSE_CACHE_DISK_MAX_MB = float(os.environ.get("RESPONSE_CACHE_DISK_MAX_MB", 1024))
+        # 会話履歴などの共通プレフィックスのKVキャッシュを再利用するためのメモリ上限（MB。0にすると無効）
+        self.PREFIX_CACHE_MB = int(os.environ.get("PREFIX_CACHE_MB", 1024))
+        # 読み込み後に短い生成を1回実行してから準備完了とする（初回リクエストの遅延を避ける）
+        self.WARMUP_ENABLED = os.environ.get("WARMUP", "1") == "1"
+        self.WARMUP_MAX_NEW_TOKENS = int(os.environ.get("WARMUP_MAX_NEW_TOKENS", 8))
+        # 推論に使うデバイス（auto: GPUがあればGPU、なければCPU）
+        self.DEVICE = os.environ.get("DEVICE", "auto")
+        # CPUで推論するときの設定（cpu_inference.py を参照）
+        self.CPU_QUANTIZE = os.environ.get("CPU_QUANTIZE", "1") == "1"        # Linear層の動的int8量子化
+        self.CPU_THREADS = int(os.environ.get("CPU_THREADS", 0))              # intra-opスレッド数（0なら既定値）
+        self.CPU_INTEROP_THREADS = int(os.environ.get("CPU_INTEROP_THREADS", 0))  # inter-opスレッド数（0なら既定値）
+        self.CPU_COMPILE = os.environ.get("CPU_COMPILE", "0") == "1"          # model.forward を torch.compile する
 
 config = Config(MODEL_NAME)
+device = ("cuda" if torch.cuda.is_available() else "cpu") if config.DEVICE == "auto" else config.DEVICE
+if device == "cpu":
+    # inter-opスレッド数はモデルの読み込み（最初の並列処理）より前に設定する必要がある
+    configure_threads(config.CPU_THREADS, config.CPU_INTEROP_THREADS)
 
 # --- FastAPIアプリケーション定義 ---
 app = FastAPI(
@@ -39,6 +110,34 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# --- メトリクス（/metrics でPrometheus形式で公開） ---
+REQUESTS = metrics.Counter("llm_requests_total", "HTTPリクエスト数", ["endpoint", "status"])
+REQUEST_ERRORS = metrics.Counter("llm_request_errors_total", "サーバー側のエラー（5xx、ストリーミング中のエラー）の数", ["endpoint"])
+REQUEST_DURATION = metrics.Histogram("llm_request_duration_seconds", "リクエスト全体の所要時間（秒）", ["endpoint"])
+REQUESTS_IN_FLIGHT = metrics.Gauge("llm_requests_in_flight", "処理中のリクエスト数", ["endpoint"])
+STAGE_DURATION = metrics.Histogram("llm_stage_duration_seconds", "推論の段階ごとの所要時間（秒）", ["stage"])
+QUEUE_WAIT = STAGE_DURATION.labels(stage="queue")          # 推論の実行待ち（リクエストごと）
+TOKENIZE_TIME = STAGE_DURATION.labels(stage="tokenize")    # 以下の3つはmodel.generateの呼び出しごと
+PREFILL_TIME = STAGE_DURATION.labels(stage="prefill")
+DECODE_TIME = STAGE_DURATION.labels(stage="decode")
+EXTRACT_TIME = STAGE_DURATION.labels(stage="extract")      # 応答の抽出（リクエストごと）
+PROMPT_TOKENS = metrics.Counter("llm_prompt_tokens_total", "モデルに入力したトークン数")
+GENERATED_TOKENS = metrics.Counter("llm_generated_tokens_total", "生成したトークン数")
+MODEL_LOADS = metrics.Counter("llm_model_loads_total", "モデルの読み込み回数", ["model", "result"])
+MODEL_EVICTIONS = metrics.Counter("llm_model_evictions_total", "メモリ上限のためにモデルを解放した回数", ["model"])
+MODEL_RESIDENT_BYTES = metrics.Gauge("llm_model_resident_bytes", "常駐しているモデルのサイズ（バイト）", ["model"])
+MODEL_READY = metrics.Gauge("llm_model_ready", "既定のモデルのウォームアップまで終わり、リクエストを受け付けられる状態なら1")
+INFERENCE_RUNNING = metrics.Gauge("llm_inference_running", "実行中の推論の数")
+INFERENCE_WAITING = metrics.Gauge("llm_inference_waiting", "推論の実行待ちのリクエスト数")
+
+app.add_middleware(
+    metrics.RequestMetricsMiddleware,
+    requests=REQUESTS,
+    errors=REQUEST_ERRORS,
+    duration=REQUEST_DURATION,
+    in_flight=REQUESTS_IN_FLIGHT,
+)
+
 # --- データモデル定義 ---
 class Message(BaseModel):
     role: str
@@ -51,35 +150,242 @@ class SimpleGenerationRequest(BaseModel):
     do_sample: Optional[bool] = True
     temperature: Optional[float] = 0.7
     top_p: Optional[float] = 0.9
+    seed: Optional[int] = None  # 指定するとサンプリングの結果を再現でき、応答キャッシュの対象になる
+    model: Optional[str] = None  # 使用するモデル名（/models で一覧を確認できる。省略時は既定のモデル）
 
 class GenerationResponse(BaseModel):
     generated_text: str
+    model: Optional[str] = None             # 生成に使用したモデル名
     response_time: float
+    queue_time: Optional[float] = None      # 推論の実行待ちにかかった時間（秒）
+    inference_time: Optional[float] = None  # モデル推論そのものにかかった時間（秒）
+    batch_size: Optional[int] = None        # 一緒に推論したリクエスト数（動的バッチング有効時）
+    cached: bool = False                    # 応答キャッシュから返した場合はTrue
+
+# --- 推論の実行キュー ---
+class QueueFullError(Exception):
+    """実行待ちのリクエストが上限に達している"""
+
+class InferenceQueue:
+    """推論をイベントループ外のスレッドで実行し、同時実行数と待ち行列の長さを制限する"""
+
+    def __init__(self, max_concurrency, max_queue_size):
+        self.max_concurrency = max_concurrency
+        self.max_queue_size = max_queue_size
+        self._executor = ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix="inference")
+        self._admitted = 0  # 実行中 + 実行待ち（イベントループのスレッドからのみ更新する）
+        self._running = 0
+
+    @property
+    def running(self):
+        """実行中の推論の数"""
+        return self._running
+
+    @property
+    def waiting(self):
+        """実行待ちのリクエスト数"""
+        return self._admitted - self._running
+
+    def _release(self, _future):
+        self._admitted -= 1
+
+    async def run(self, func, *args, **kwargs):
+        """funcをスレッドプールで実行し、(結果, 待ち時間, 実行時間) を返す
+
+        Raises:
+            QueueFullError: 実行中と実行待ちの合計が上限に達している場合
+        """
+        return await self.submit(func, *args, **kwargs)
+
+    def submit(self, func, *args, **kwargs):
+        """funcをスレッドプールに投入し、(結果, 待ち時間, 実行時間) を返すFutureを返す
+
+        受け付けの可否はこの呼び出しの時点で決まるため、レスポンスを返し始める前に429を判断できる。
+
+        Raises:
+            QueueFullError: 実行中と実行待ちの合計が上限に達している場合
+        """
+        if self._admitted >= self.max_concurrency + self.max_queue_size:
+            raise QueueFullError()
+        loop = asyncio.get_running_loop()
+        enqueued_at = time.time()
+        self._admitted += 1
+
+        def job():
+            started_at = time.time()
+            loop.call_soon_threadsafe(self._change_running, 1)
+            try:
+                return func(*args, **kwargs), started_at - enqueued_at, time.time() - started_at
+            finally:
+                loop.call_soon_threadsafe(self._change_running, -1)
+
+        future = self._executor.submit(job)
+        # クライアントが切断して待機がキャンセルされても、枠は推論が実際に終わった時点で返却する
+        future.add_done_callback(lambda f: loop.call_soon_threadsafe(self._release, f))
+        return asyncio.wrap_future(future)
+
+    def _change_running(self, delta):
+        self._running += delta
+
+inference_queue = InferenceQueue(config.INFERENCE_CONCURRENCY, config.MAX_QUEUE_SIZE)
+INFERENCE_RUNNING.set_function(lambda: inference_queue.running)
+INFERENCE_WAITING.set_function(lambda: inference_queue.waiting)
+
+def record_generation(timer):
+    """model.generate 1回分の段階ごとの時間とトークン数をメトリクスに記録する"""
+    TOKENIZE_TIME.observe(timer.tokenize)
+    PREFILL_TIME.observe(timer.prefill)
+    DECODE_TIME.observe(timer.decode)
+    PROMPT_TOKENS.inc(timer.prompt_tokens)
+    GENERATED_TOKENS.inc(timer.generated_tokens)
+
+def run_generation(pipe, model_name, prompt, seed=None, **generate_kwargs):
+    """読み込み済みのモデルで生成する（推論用スレッドで実行される）
+
+    seedを指定すると乱数を固定して生成する（INFERENCE_CONCURRENCY=1 のとき同じ結果が再現される）。
+    プレフィックスキャッシュが有効なら、前回までの会話と先頭が一致する部分はKVキャッシュを再利用し、
+    新しいトークンだけをprefillする。
+    """
+    if seed is not None:
+        set_seed(seed)
+    timer = GenerationTimer()
+    outputs, reused_tokens = generate_text(pipe, prompt, timer, prefix_cache=prefix_cache, cache_namespace=model_name,
+                                           **generate_kwargs)
+    record_generation(timer)
+    if prefix_cache is not None and supports_prefix_cache(pipe.model):
+        print(f"プレフィックスキャッシュ: {reused_tokens}トークンを再利用 (prefill: {timer.prefill:.2f}秒)")
+    return outputs
+
+def run_generation_batch(pipe, prompts, max_new_tokens_list, **sampling_kwargs):
+    """読み込み済みのモデルで複数のプロンプトをまとめて生成する（推論用スレッドで実行される）
+
+    バッチはモデル（パイプライン）ごとにまとめられるため、pipe はバッチ内のすべてのリクエストで共通。
+    """
+    timer = GenerationTimer()
+    outputs = generate_batch(pipe, prompts, max_new_tokens_list, timer=timer, **sampling_kwargs)
+    record_generation(timer)
+    return outputs
+
+def run_generation_stream(pipe, prompt, streamer, cancel_event, **generate_kwargs):
+    """読み込み済みのモデルで生成し、テキストをstreamerに流す（推論用スレッドで実行される）"""
+    timer = generate_stream(pipe, prompt, streamer, cancel_event, **generate_kwargs)
+    record_generation(timer)
+    return timer
+
+batch_scheduler = BatchScheduler(
+    run_generation_batch,
+    inference_queue.run,
+    max_batch_size=config.MAX_BATCH_SIZE,
+    max_wait_ms=config.BATCH_WAIT_MS,
+)
 
-# --- モデル関連の関数 ---
-# モデルのグローバル変数
-model = None
+response_cache = None
+if config.RESPONSE_CACHE_SIZE > 0:
+    response_cache = ResponseCache(
+        max_entries=config.RESPONSE_CACHE_SIZE,
+        ttl=config.RESPONSE_CACHE_TTL,
+        disk_path=config.RESPONSE_CACHE_DISK,
+        max_disk_entries=config.RESPONSE_CACHE_DISK_SIZE,
+        max_bytes=int(config.RESPONSE_CACHE_MAX_MB * 1024 * 1024),
+        max_disk_bytes=int(config.RESPONSE_CACHE_DISK_MAX_MB * 1024 * 1024),
+    )
+
+prefix_cache = PrefixCache(config.PREFIX_CACHE_MB * 1024 * 1024) if config.PREFIX_CACHE_MB > 0 else None
 
-def load_model():
-    """推論用のLLMモデルを読み込む"""
-    global model  # グローバル変数を更新するために必要
+# --- モデル関連の関数 ---
+def load_model(model_id):
+    """推論用のLLMモデルを読み込む（失敗した場合は例外を送出する）"""
     try:
-        device = "cuda" if torch.cuda.is_available() else "cpu"
         print(f"使用デバイス: {device}")
+        if device == "cpu":
+            model_kwargs = cpu_model_kwargs()
+        else:
+            model_kwargs = {"torch_dtype": torch.bfloat16}
         pipe = pipeline(
             "text-generation",
-            model=config.MODEL_NAME,
-            model_kwargs={"torch_dtype": torch.bfloat16},
+            model=model_id,
+            model_kwargs=model_kwargs,
             device=device
         )
-        print(f"モデル '{config.MODEL_NAME}' の読み込みに成功しました")
-        model = pipe  # グローバル変数を更新
+        # バッチ推論（batching.generate_batch）用に、生成位置を揃えるための左パディングを設定しておく
+        # （推論中に共有のトークナイザーを書き換えないよう、読み込み時に1回だけ行う）
+        pipe.tokenizer.padding_side = "left"
+        if pipe.tokenizer.pad_token is None:
+            pipe.tokenizer.pad_token = pipe.tokenizer.eos_token
+        if device == "cpu":
+            optimize_for_cpu(pipe, quantize=config.CPU_QUANTIZE, compile_model=config.CPU_COMPILE)
+            print(f"CPU推論モード: 量子化={'int8' if config.CPU_QUANTIZE else 'なし'}, torch.compile={config.CPU_COMPILE}")
+        print(f"モデル '{model_id}' の読み込みに成功しました")
         return pipe
     except Exception as e:
-        error_msg = f"モデル '{config.MODEL_NAME}' の読み込みに失敗: {e}"
+        error_msg = f"モデル '{model_id}' の読み込みに失敗: {e}"
         print(error_msg)
         traceback.print_exc()  # 詳細なエラー情報を出力
-        return None
+        raise
+
+def warm_up(pipe):
+    """短い生成を1回実行し、初回だけかかる処理（カーネルの初期化やメモリの確保など）を済ませておく"""
+    start_time = time.time()
+    try:
+        generate_text(pipe, "こんにちは", GenerationTimer(), max_new_tokens=config.WARMUP_MAX_NEW_TOKENS, do_sample=False)
+        print(f"ウォームアップが完了しました。({time.time() - start_time:.2f}秒)")
+    except Exception as e:
+        # ウォームアップの失敗は致命的ではないため、そのまま受け付けを開始する
+        print(f"ウォームアップ中にエラーが発生しました: {e}")
+        traceback.print_exc()
+
+def on_model_event(event):
+    """モデルの読み込み・解放をログとメトリクスに記録する"""
+    name = event["model"]
+    if event["event"] == "load":
+        print(f"モデル '{name}' を常駐させました。({event['bytes'] / 2**20:.0f}MB, 読み込み: {event['seconds']:.1f}秒)")
+        MODEL_LOADS.labels(model=name, result="success").inc()
+        MODEL_RESIDENT_BYTES.labels(model=name).set(event["bytes"])
+    elif event["event"] == "evict":
+        print(f"メモリ上限のため、モデル '{name}' を解放しました。({event['bytes'] / 2**20:.0f}MB)")
+        MODEL_EVICTIONS.labels(model=name).inc()
+        MODEL_RESIDENT_BYTES.labels(model=name).set(0)
+        if prefix_cache is not None:
+            prefix_cache.discard(name)
+    elif event["event"] == "load_failed":
+        print(f"モデル '{name}' の読み込みに失敗しました: {event['error']}")
+        MODEL_LOADS.labels(model=name, result="failure").inc()
+
+# モデルは必要になった時点で専用のスレッドで読み込み、メモリ上限の範囲で常駐させる
+registry = ModelRegistry(
+    config.MODELS,
+    config.MODEL_MEMORY_BUDGET_MB * 1024 * 1024,
+    load_fn=load_model,
+    warm_up_fn=warm_up if config.WARMUP_ENABLED else None,
+    on_event=on_model_event,
+)
+MODEL_READY.set_function(lambda: 1 if registry.state(config.DEFAULT_MODEL) == "ready" else 0)
+
+def require_ready_model(endpoint_name, model_name):
+    """指定されたモデル（省略時は既定のモデル）の名前とパイプラインを返す
+
+    準備ができていなければ読み込みを開始して503を返す（イベントループを塞がないよう、読み込みは待たない）。
+
+    Returns:
+        tuple: (モデル名, パイプライン)
+    """
+    name = model_name or config.DEFAULT_MODEL
+    try:
+        pipe = registry.get(name)
+    except UnknownModelError:
+        raise HTTPException(
+            status_code=400,
+            detail=f"モデル '{name}' は利用できません。利用できるモデル: {', '.join(registry.names)}",
+        )
+    if pipe is not None:
+        return name, pipe
+    registry.ensure_loaded(name)  # 読み込み中なら同じ読み込みを待つ。失敗・解放されていた場合はやり直す
+    print(f"{endpoint_name}エンドポイント: モデル '{name}' の準備ができていません。(状態: {registry.state(name)})")
+    raise HTTPException(
+        status_code=503,
+        detail=f"モデル '{name}' を読み込み中です。しばらくしてから再度お試しください。",
+        headers={"Retry-After": "10"},
+    )
 
 def extract_assistant_response(outputs, user_prompt):
     """モデルの出力からアシスタントの応答を抽出する"""
@@ -133,12 +439,8 @@ def extract_assistant_response(outputs, user_prompt):
 # --- FastAPIエンドポイント定義 ---
 @app.on_event("startup")
 async def startup_event():
-    """起動時にモデルを初期化"""
-    load_model_task()  # バックグラウンドではなく同期的に読み込む
-    if model is None:
-        print("警告: 起動時にモデルの初期化に失敗しました")
-    else:
-        print("起動時にモデルの初期化が完了しました。")
+    """起動時に既定のモデルの読み込みをバックグラウンドで開始する（完了は /health/ready で確認できる）"""
+    registry.ensure_loaded(config.DEFAULT_MODEL)
 
 @app.get("/")
 async def root():
@@ -148,43 +450,122 @@ async def root():
 @app.get("/health")
 async def health_check():
     """ヘルスチェックエンドポイント"""
-    global model
-    if model is None:
-        return {"status": "error", "message": "No model loaded"}
-
-    return {"status": "ok", "model": config.MODEL_NAME}
+    model_state = registry.state(config.DEFAULT_MODEL)
+    if model_state != "ready":
+        return {"status": "error", "message": "No model loaded", "model_state": model_state}
+
+    return {
+        "status": "ok",
+        "model": config.DEFAULT_MODEL,
+        "model_id": registry.model_id(config.DEFAULT_MODEL),
+        "inference_running": inference_queue.running,
+        "inference_waiting": inference_queue.waiting,
+        "batching_enabled": config.BATCHING_ENABLED,
+        "average_batch_size": batch_scheduler.average_batch_size,
+    }
+
+@app.get("/health/live")
+async def liveness():
+    """プロセスが応答できるか（モデルの読み込み中でもOK）"""
+    return {"status": "ok"}
+
+@app.get("/health/ready")
+async def readiness():
+    """リクエストを受け付けられるか（モデルの読み込みとウォームアップが終わるまでは503）"""
+    model_state = registry.state(config.DEFAULT_MODEL)
+    if model_state != "ready":
+        return JSONResponse(status_code=503, content={"status": "not_ready", "model_state": model_state})
+    return {"status": "ready", "model": config.DEFAULT_MODEL, "model_id": registry.model_id(config.DEFAULT_MODEL)}
+
+@app.get("/models")
+async def list_models():
+    """提供しているモデルごとの状態・常駐サイズと、最近の読み込み・解放のイベント"""
+    return {
+        "default_model": config.DEFAULT_MODEL,
+        **registry.residency(),
+        "events": list(registry.events),
+    }
+
+@app.get("/stats")
+async def stats():
+    """応答キャッシュ・プレフィックスキャッシュのヒット率などの統計"""
+    return {
+        # ディスクキャッシュがある場合はSQLiteを読むため、イベントループの外で集計する
+        "response_cache": await asyncio.to_thread(response_cache.stats) if response_cache is not None else None,
+        "prefix_cache": prefix_cache.stats() if prefix_cache is not None else None,
+    }
+
+@app.get("/metrics")
+async def prometheus_metrics():
+    """Prometheus形式のメトリクス"""
+    return Response(content=metrics.REGISTRY.render(), media_type=metrics.CONTENT_TYPE)
 
 # 簡略化されたエンドポイント
 @app.post("/generate", response_model=GenerationResponse)
 async def generate_simple(request: SimpleGenerationRequest):
     """単純なプロンプト入力に基づいてテキストを生成"""
-    global model
-
-    if model is None:
-        print("generateエンドポイント: モデルが読み込まれていません。読み込みを試みます...")
-        load_model_task()  # 再度読み込みを試みる
-        if model is None:
-            print("generateエンドポイント: モデルの読み込みに失敗しました。")
-            raise HTTPException(status_code=503, detail="モデルが利用できません。後でもう一度お試しください。")
+    model_name, pipe = require_ready_model("generate", request.model)
 
     try:
         start_time = time.time()
-        print(f"シンプルなリクエストを受信: prompt={request.prompt[:100]}..., max_new_tokens={request.max_new_tokens}")  # 長いプロンプトは切り捨て
+        print(f"シンプルなリクエストを受信: model={model_name}, prompt={request.prompt[:100]}..., max_new_tokens={request.max_new_tokens}")  # 長いプロンプトは切り捨て
+
+        # 結果が入力だけで決まるリクエストは、同じ入力の生成結果をキャッシュから返す
+        key = None
+        if response_cache is not None:
+            if is_cacheable(request.do_sample, request.seed):
+                key = cache_key(registry.model_id(model_name), request.prompt, request.max_new_tokens,
+                                request.do_sample, request.temperature, request.top_p, request.seed)
+                # ディスクキャッシュを引く場合は別スレッドで読み込む（イベントループを塞がない）
+                cached = await response_cache.aget(key)
+                if cached is not None:
+                    response_time = time.time() - start_time
+                    print(f"応答キャッシュにヒットしました。(応答生成時間: {response_time:.4f}秒)")
+                    return GenerationResponse(
+                        generated_text=cached["generated_text"],
+                        model=model_name,
+                        response_time=response_time,
+                        cached=True
+                    )
+            else:
+                response_cache.record_bypass()
 
-        # プロンプトテキストで直接応答を生成
+        # プロンプトテキストで直接応答を生成（イベントループを塞がないよう推論用スレッドで実行）
         print("モデル推論を開始...")
-        outputs = model(
-            request.prompt,
-            max_new_tokens=request.max_new_tokens,
-            do_sample=request.do_sample,
-            temperature=request.temperature,
-            top_p=request.top_p,
-        )
-        print("モデル推論が完了しました。")
+        batch_size = None
+        # seedを指定したサンプリングはバッチ内で乱数を共有できないため、1件ずつ推論する
+        if config.BATCHING_ENABLED and not (request.do_sample and request.seed is not None):
+            # 同時に届いた他のリクエストとまとめて推論する
+            outputs, queue_time, inference_time, batch_size = await batch_scheduler.submit(
+                request.prompt,
+                request.max_new_tokens,
+                do_sample=request.do_sample,
+                temperature=request.temperature,
+                top_p=request.top_p,
+                group=pipe,
+            )
+        else:
+            outputs, queue_time, inference_time = await inference_queue.run(
+                run_generation,
+                pipe,
+                model_name,
+                request.prompt,
+                seed=request.seed,
+                max_new_tokens=request.max_new_tokens,
+                do_sample=request.do_sample,
+                temperature=request.temperature,
+                top_p=request.top_p,
+            )
+        print(f"モデル推論が完了しました。(待ち時間: {queue_time:.2f}秒, 推論時間: {inference_time:.2f}秒)")
+        QUEUE_WAIT.observe(queue_time)
 
         # アシスタント応答を抽出
+        extract_started_at = time.perf_counter()
         assistant_response = extract_assistant_response(outputs, request.prompt)
+        EXTRACT_TIME.observe(time.perf_counter() - extract_started_at)
         print(f"抽出されたアシスタント応答: {assistant_response[:100]}...")  # 長い場合は切り捨て
+        if key is not None:
+            response_cache.put(key, {"generated_text": assistant_response})  # ディスクへの書き込みは待たない
 
         end_time = time.time()
         response_time = end_time - start_time
@@ -192,25 +573,109 @@ async def generate_simple(request: SimpleGenerationRequest):
 
         return GenerationResponse(
             generated_text=assistant_response,
-            response_time=response_time
+            model=model_name,
+            response_time=response_time,
+            queue_time=queue_time,
+            inference_time=inference_time,
+            batch_size=batch_size
         )
 
+    except QueueFullError:
+        print("generateエンドポイント: 実行待ちのリクエストが上限に達しています。")
+        raise queue_full_exception()
     except Exception as e:
         print(f"シンプル応答生成中にエラーが発生しました: {e}")
         traceback.print_exc()
         raise HTTPException(status_code=500, detail=f"応答の生成中にエラーが発生しました: {str(e)}")
 
-def load_model_task():
-    """モデルを読み込むバックグラウンドタスク"""
-    global model
-    print("load_model_task: モデルの読み込みを開始...")
-    # load_model関数を呼び出し、結果をグローバル変数に設定
-    loaded_pipe = load_model()
-    if loaded_pipe:
-        model = loaded_pipe  # グローバル変数を更新
-        print("load_model_task: モデルの読み込みが完了しました。")
-    else:
-        print("load_model_task: モデルの読み込みに失敗しました。")
+@app.post("/generate/stream")
+async def generate_stream_endpoint(request: SimpleGenerationRequest):
+    """生成されたテキストをServer-Sent Events（text/event-stream）で順次返す
+
+    各イベントのdataはJSONで、生成中は {"text": "..."}、最後に
+    {"done": true, "response_time", "ttft", "queue_time", "inference_time", "prompt_tokens", "completion_tokens"}
+    を送る。生成中にエラーが起きた場合は {"error": "..."} を送って終了する。
+    """
+    model_name, pipe = require_ready_model("generate/stream", request.model)
+
+    start_time = time.time()
+    print(f"ストリーミングリクエストを受信: model={model_name}, prompt={request.prompt[:100]}..., max_new_tokens={request.max_new_tokens}")
+    streamer = AsyncTextStreamer(pipe.tokenizer, asyncio.get_running_loop())
+    cancel_event = threading.Event()
+    try:
+        # 受け付けの可否はここで決まるため、混雑時はストリームを開始する前に429を返せる
+        generation = inference_queue.submit(
+            run_generation_stream,
+            pipe,
+            request.prompt,
+            streamer,
+            cancel_event,
+            max_new_tokens=request.max_new_tokens,
+            do_sample=request.do_sample,
+            temperature=request.temperature,
+            top_p=request.top_p,
+            seed=request.seed,
+        )
+    except QueueFullError:
+        print("generate/streamエンドポイント: 実行待ちのリクエストが上限に達しています。")
+        raise queue_full_exception()
+
+    return StreamingResponse(
+        stream_events(generation, streamer, cancel_event, start_time),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},  # プロキシでバッファリングさせない
+    )
+
+async def stream_events(generation, streamer, cancel_event, start_time):
+    """ストリーマーに届いたテキストをSSEイベントとして返し、最後に計測結果を送る"""
+    ttft = None
+    finished = False
+    try:
+        while True:
+            text = await streamer.next_text(generation)
+            if text is None:
+                break
+            if ttft is None:
+                ttft = time.time() - start_time
+            yield sse_event({"text": text})
+
+        try:
+            timer, queue_time, inference_time = await generation
+        except Exception as e:
+            print(f"ストリーミング生成中にエラーが発生しました: {e}")
+            traceback.print_exc()
+            # ステータスは200で送信済みのため、エラーの数はここで記録する
+            REQUEST_ERRORS.labels(endpoint="/generate/stream").inc()
+            yield sse_event({"error": f"応答の生成中にエラーが発生しました: {str(e)}"})
+            return
+
+        QUEUE_WAIT.observe(queue_time)
+        prompt_tokens, completion_tokens = timer.prompt_tokens, timer.generated_tokens
+        response_time = time.time() - start_time
+        print(f"ストリーミング応答が完了しました。(TTFT: {ttft or 0:.2f}秒, 応答生成時間: {response_time:.2f}秒, "
+              f"生成トークン数: {completion_tokens})")
+        yield sse_event({
+            "done": True,
+            "response_time": response_time,
+            "ttft": ttft,
+            "queue_time": queue_time,
+            "inference_time": inference_time,
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+        })
+        finished = True
+    finally:
+        if not finished:
+            # クライアントが切断した場合は、残りの生成を打ち切って推論の枠を早く空ける
+            cancel_event.set()
+
+def queue_full_exception():
+    """実行待ちが上限に達しているときに返す429エラー"""
+    return HTTPException(
+        status_code=429,
+        detail="リクエストが混み合っています。しばらくしてから再度お試しください。",
+        headers={"Retry-After": "1"},
+    )
 
 print("FastAPIエンドポイントを定義しました。")
 
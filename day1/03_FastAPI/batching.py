@@ -0,0 +1,149 @@
+"""
+動的バッチング
+
+同時に届いた複数の /generate リクエストを最大 max_wait_ms ミリ秒、または max_batch_size 件まで集め、
+左パディングした1回の model.generate でまとめて推論してから、結果を各リクエストに返す。
+CPUでは1件ずつ推論すると行列演算の並列性を使い切れないため、まとめることでスループットが上がる。
+
+使用するモデル（group）やサンプリング設定（do_sample, temperature, top_p）が異なるリクエストは
+1回のgenerateで扱えないため、それぞれ別のバッチにまとめる。max_new_tokens が異なるリクエストも別のバッチにする
+（短いリクエストが長いリクエストの生成の終わりを待たないように）。
+"""
+
+import asyncio
+import time
+import torch
+
+
+def sampling_key(do_sample, temperature, top_p):
+    """同じバッチにまとめられるかを判定するキー（サンプリングしない場合はtemperature/top_pは無関係）"""
+    if not do_sample:
+        return (False,)
+    return (True, float(temperature), float(top_p))
+
+
+def generate_batch(pipe, prompts, max_new_tokens_list, do_sample=True, temperature=0.7, top_p=0.9, timer=None):
+    """複数のプロンプトを1回のgenerateで生成する
+
+    timer（generation.GenerationTimer）を渡すと、バッチ全体の段階ごとの時間とトークン数を記録する。
+
+    Returns:
+        list: パイプラインと同じ形式の出力 [[{"generated_text": プロンプト + 生成テキスト}], ...]
+    """
+    tokenizer = pipe.tokenizer  # 左パディングとpad_tokenはモデルの読み込み時に設定済み
+    lm = pipe.model
+
+    tokenize_started_at = time.perf_counter()
+    inputs = tokenizer(prompts, return_tensors="pt", padding=True).to(lm.device)
+    generate_kwargs = {"max_new_tokens": max(max_new_tokens_list), "do_sample": do_sample,
+                       "pad_token_id": tokenizer.pad_token_id}
+    if do_sample:
+        generate_kwargs.update(temperature=temperature, top_p=top_p)
+    if timer is not None:
+        timer.tokenize = time.perf_counter() - tokenize_started_at
+        timer.prompt_tokens = int(inputs["attention_mask"].sum())
+        generate_kwargs["streamer"] = timer
+        timer.start()
+    with torch.inference_mode():
+        output_ids = lm.generate(**inputs, **generate_kwargs)
+
+    new_tokens = output_ids[:, inputs["input_ids"].shape[1]:]
+    outputs = []
+    generated_tokens = 0
+    for prompt, tokens, max_new_tokens in zip(prompts, new_tokens, max_new_tokens_list):
+        tokens = tokens[:max_new_tokens]
+        generated_tokens += int((tokens != tokenizer.pad_token_id).sum())
+        text = tokenizer.decode(tokens, skip_special_tokens=True)
+        outputs.append([{"generated_text": prompt + text}])
+    if timer is not None:
+        timer.generated_tokens = generated_tokens  # ステップ数ではなく、各リクエストに返したトークン数
+    return outputs
+
+
+class _PendingRequest:
+    def __init__(self, prompt, max_new_tokens, future):
+        self.prompt = prompt
+        self.max_new_tokens = max_new_tokens
+        self.future = future
+        self.enqueued_at = time.time()
+
+
+class BatchScheduler:
+    """リクエストを集めてバッチ推論し、結果を各リクエストに振り分けるスケジューラ
+
+    Args:
+        run_batch: (group, prompts, max_new_tokens_list, do_sample, temperature, top_p) を受け取り、
+            プロンプトごとの出力のリストを返す同期関数（groupはsubmitに渡したモデル名など）
+        execute: 同期関数をイベントループ外で実行し、(結果, 待ち時間, 実行時間) を返すコルーチン関数
+            （InferenceQueue.run を想定）
+    """
+
+    def __init__(self, run_batch, execute, max_batch_size=8, max_wait_ms=10):
+        self.run_batch = run_batch
+        self.execute = execute
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self._pending = {}  # (group, max_new_tokens, sampling_key) -> [_PendingRequest]
+        self._timers = {}   # (group, max_new_tokens, sampling_key) -> TimerHandle
+        self.batches = 0
+        self.batched_requests = 0
+
+    async def submit(self, prompt, max_new_tokens, do_sample=True, temperature=0.7, top_p=0.9, group=None):
+        """リクエストをバッチに加え、推論が終わるまで待つ（同じgroup・max_new_tokensのリクエストだけをまとめる）
+
+        Returns:
+            tuple: (パイプライン形式の出力, 待ち時間, 推論時間, バッチサイズ)
+        """
+        loop = asyncio.get_running_loop()
+        key = (group, max_new_tokens, sampling_key(do_sample, temperature, top_p))
+        request = _PendingRequest(prompt, max_new_tokens, loop.create_future())
+        batch = self._pending.setdefault(key, [])
+        batch.append(request)
+        if len(batch) >= self.max_batch_size:
+            self._flush(key)
+        elif len(batch) == 1:
+            self._timers[key] = loop.call_later(self.max_wait, self._flush, key)
+        return await request.future
+
+    def _flush(self, key):
+        """キーに対応するバッチを推論に回す"""
+        timer = self._timers.pop(key, None)
+        if timer is not None:
+            timer.cancel()
+        batch = self._pending.pop(key, [])
+        if batch:
+            asyncio.get_running_loop().create_task(self._run(key, batch))
+
+    async def _run(self, key, batch):
+        group, _, sampling = key
+        do_sample = sampling[0]
+        temperature, top_p = (sampling[1], sampling[2]) if do_sample else (None, None)
+        self.batches += 1
+        self.batched_requests += len(batch)
+        try:
+            outputs, _, inference_time = await self.execute(
+                self.run_batch,
+                group,
+                [request.prompt for request in batch],
+                [request.max_new_tokens for request in batch],
+                do_sample=do_sample,
+                temperature=temperature,
+                top_p=top_p,
+            )
+        except Exception as e:
+            for request in batch:
+                if not request.future.done():
+                    request.future.set_exception(e)
+            return
+
+        finished_at = time.time()
+        for request, output in zip(batch, outputs):
+            if request.future.done():  # クライアントが切断済み
+                continue
+            # 待ち時間 = 到着から推論開始まで（バッチを集める時間と実行待ちの時間を含む）
+            queue_time = finished_at - inference_time - request.enqueued_at
+            request.future.set_result((output, queue_time, inference_time, len(batch)))
+
+    @property
+    def average_batch_size(self):
+        return self.batched_requests / self.batches if self.batches else 0.0
@@ -0,0 +1,127 @@
+# benchmark_cpu_inference.py
+"""
+CPU推論モードのベンチマーク
+
+同じプロンプトから同じ数のトークンを生成し、モードごとに
+- トークン/秒（decodeのみ、およびprefillを含む全体）
+- 読み込み後のメモリ使用量（RSS）と最大RSS
+を比較する。メモリを正しく測るため、各モードは別のプロセスで実行する。
+
+モード:
+    bf16          : bfloat16のまま（GPU向けの既定の読み込み方）
+    fp32          : float32
+    int8          : float32で読み込み、Linear層を動的int8量子化（app.py のCPU既定）
+    int8-compile  : int8 に加えて model.forward を torch.compile
+
+使い方:
+    python benchmark_cpu_inference.py --threads 4 --max-new-tokens 64
+    python benchmark_cpu_inference.py --model gpt2 --modes fp32 int8
+"""
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+
+# day1/common のモジュールを読み込めるようにする（このディレクトリから実行するため）
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+MODEL_NAME = "google/gemma-2-2b-jpn-it"  # app.py と同じモデル
+MODES = ["bf16", "fp32", "int8", "int8-compile"]
+PROMPT = "機械学習の代表的な手法を三つ挙げ、それぞれの特徴を説明してください。"
+
+
+def current_rss_bytes():
+    """現在のRSS（Linuxの /proc/self/statm から読む）"""
+    with open("/proc/self/statm") as f:
+        resident_pages = int(f.read().split()[1])
+    return resident_pages * resource.getpagesize()
+
+
+def peak_rss_bytes():
+    """プロセス開始からの最大RSS（Linuxでは ru_maxrss はKiB単位）"""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def run_mode(mode, model_name, max_new_tokens, repeats, threads, interop_threads):
+    """1つのモードを計測して結果の辞書を返す（子プロセスで実行する）"""
+    import torch
+    from transformers import pipeline
+
+    from common.cpu_inference import configure_threads, cpu_model_kwargs, optimize_for_cpu
+    from generation import GenerationTimer, generate_text
+
+    configure_threads(threads, interop_threads)
+    quantize = mode.startswith("int8")
+    if mode == "bf16":
+        model_kwargs = {"torch_dtype": torch.bfloat16, "low_cpu_mem_usage": True}
+    else:
+        model_kwargs = cpu_model_kwargs()
+
+    load_started_at = time.perf_counter()
+    pipe = pipeline("text-generation", model=model_name, model_kwargs=model_kwargs, device="cpu")
+    optimize_for_cpu(pipe, quantize=quantize, compile_model=mode.endswith("compile"))
+    load_time = time.perf_counter() - load_started_at
+    rss_after_load = current_rss_bytes()
+
+    # 初回の生成（torch.compileのコンパイルなど）は計測から除く
+    generate_text(pipe, PROMPT, GenerationTimer(), max_new_tokens=8, do_sample=False)
+
+    decode_rates, total_rates = [], []
+    for _ in range(repeats):
+        timer = GenerationTimer()
+        # 途中でEOSが出ても同じトークン数を生成させ、モード間で比較できるようにする
+        generate_text(pipe, PROMPT, timer, max_new_tokens=max_new_tokens, min_new_tokens=max_new_tokens,
+                      do_sample=False)
+        if timer.generated_tokens > 1 and timer.decode > 0:
+            decode_rates.append((timer.generated_tokens - 1) / timer.decode)
+        total_rates.append(timer.generated_tokens / (timer.prefill + timer.decode))
+
+    return {
+        "mode": mode,
+        "threads": torch.get_num_threads(),
+        "load_time": load_time,
+        "decode_tokens_per_sec": max(decode_rates) if decode_rates else 0.0,
+        "tokens_per_sec": max(total_rates),
+        "rss_mb": rss_after_load / 2**20,
+        "peak_rss_mb": peak_rss_bytes() / 2**20,
+    }
+
+
+def run_benchmark(args):
+    print(f"{'mode':<14} {'threads':>7} {'load':>7} {'decode tok/s':>13} {'total tok/s':>12} "
+          f"{'RSS':>9} {'peak RSS':>9}")
+    for mode in args.modes:
+        command = [sys.executable, __file__, "--run-mode", mode, "--model", args.model,
+                   "--max-new-tokens", str(args.max_new_tokens), "--repeats", str(args.repeats),
+                   "--threads", str(args.threads), "--interop-threads", str(args.interop_threads)]
+        completed = subprocess.run(command, capture_output=True, text=True)
+        if completed.returncode != 0:
+            print(f"{mode:<14} 失敗しました:\n{completed.stderr.strip()[-2000:]}")
+            continue
+        # 子プロセスは最後の行に結果のJSONを出力する
+        result = json.loads(completed.stdout.strip().splitlines()[-1])
+        print(f"{mode:<14} {result['threads']:>7} {result['load_time']:>6.1f}s "
+              f"{result['decode_tokens_per_sec']:>13.2f} {result['tokens_per_sec']:>12.2f} "
+              f"{result['rss_mb']:>7.0f}MB {result['peak_rss_mb']:>7.0f}MB")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="CPU推論モードのベンチマーク")
+    parser.add_argument("--model", default=MODEL_NAME, help="使用するモデル")
+    parser.add_argument("--modes", nargs="+", choices=MODES, default=MODES, help="比較するモード")
+    parser.add_argument("--max-new-tokens", type=int, default=64, help="1回に生成するトークン数")
+    parser.add_argument("--repeats", type=int, default=3, help="各モードの計測回数（最良値を表示）")
+    parser.add_argument("--threads", type=int, default=0, help="intra-opスレッド数（0なら既定値）")
+    parser.add_argument("--interop-threads", type=int, default=0, help="inter-opスレッド数（0なら既定値）")
+    parser.add_argument("--run-mode", choices=MODES, help=argparse.SUPPRESS)  # 子プロセス用
+    args = parser.parse_args()
+
+    if args.run_mode:
+        result = run_mode(args.run_mode, args.model, args.max_new_tokens, args.repeats,
+                          args.threads, args.interop_threads)
+        print(json.dumps(result))
+    else:
+        run_benchmark(args)
@@ -0,0 +1,80 @@
+# benchmark_prefix_cache.py
+"""
+KVキャッシュのプレフィックス再利用のベンチマーク
+
+会話のターン数（履歴の長さ）を変えながら、新しいメッセージを追加したプロンプトのprefill時間
+（最初のトークンが生成されるまでの時間）を
+- 再利用なし: 毎回プロンプト全体をエンコードする
+- 再利用あり: 直前までの履歴のKVキャッシュを使い、新しいトークンだけをエンコードする
+で比較する。
+
+使い方:
+    python benchmark_prefix_cache.py --turns 1 2 4 8 16
+"""
+import argparse
+
+import torch
+from transformers import pipeline
+
+from generation import GenerationTimer, generate_text
+from prefix_cache import PrefixCache, supports_prefix_cache
+
+TURNS = [
+    ("機械学習とは何ですか？", "機械学習は、データからパターンを学習し、予測や判断を行うAIの一分野です。"),
+    ("教師あり学習について教えてください。", "教師あり学習は、正解ラベル付きのデータを使ってモデルを訓練する方法です。"),
+    ("過学習を防ぐには？", "正則化、ドロップアウト、データ拡張、早期終了などの手法が有効です。"),
+    ("Transformerの特徴は？", "自己注意機構により、系列内の離れた位置同士の関係を並列に学習できます。"),
+]
+MODEL_NAME = "google/gemma-2-2b-jpn-it"  # app.py と同じモデル
+NEW_MESSAGE = "ここまでの内容を一文でまとめてください。"
+
+
+def build_prompt(turns):
+    """簡易的な会話形式のプロンプト（Lambda関数が送るプロンプトと同様に履歴を先頭に並べる）"""
+    lines = []
+    for i in range(turns):
+        question, answer = TURNS[i % len(TURNS)]
+        lines.append(f"ユーザー: {question}\nアシスタント: {answer}\n")
+    return "".join(lines)
+
+
+def measure(pipe, prefix_cache, prompt):
+    timer = GenerationTimer()
+    _, reused = generate_text(pipe, prompt, timer, prefix_cache=prefix_cache, max_new_tokens=1, do_sample=False)
+    return reused, timer.prefill
+
+
+def run_benchmark(model_name, turns_list, repeats):
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    pipe = pipeline("text-generation", model=model_name, model_kwargs={"torch_dtype": torch.bfloat16}, device=device)
+    if not supports_prefix_cache(pipe.model):
+        # Gemma2 などは既定で DynamicCache 以外のキャッシュを使うため、generate_text はKVキャッシュを再利用しない
+        print(f"'{model_name}' の既定のKVキャッシュは DynamicCache ではないため、プレフィックスキャッシュは使われません。"
+              "--model で別のモデルを指定してください。")
+        return
+    measure(pipe, PrefixCache(1024 ** 3), "ウォームアップ")
+
+    print(f"{'turns':>5} {'tokens':>7} {'no reuse':>10} {'reuse':>10} {'reused tokens':>14}")
+    for turns in turns_list:
+        history = build_prompt(turns)
+        prompt = history + f"ユーザー: {NEW_MESSAGE}\nアシスタント: "
+        tokens = len(pipe.tokenizer(prompt)["input_ids"])
+
+        without_reuse = min(measure(pipe, PrefixCache(1024 ** 3), prompt)[1] for _ in range(repeats))
+
+        with_reuse = []
+        for _ in range(repeats):
+            cache = PrefixCache(1024 ** 3)
+            measure(pipe, cache, history)  # 直前のターンまでの履歴でキャッシュを作る
+            reused, prefill_time = measure(pipe, cache, prompt)
+            with_reuse.append(prefill_time)
+        print(f"{turns:>5} {tokens:>7} {without_reuse:>9.3f}s {min(with_reuse):>9.3f}s {reused:>14}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="KVキャッシュのプレフィックス再利用のベンチマーク")
+    parser.add_argument("--model", default=MODEL_NAME, help="使用するモデル")
+    parser.add_argument("--turns", type=int, nargs="+", default=[1, 2, 4, 8, 16], help="履歴のターン数")
+    parser.add_argument("--repeats", type=int, default=3, help="各条件の計測回数（最小値を表示）")
+    args = parser.parse_args()
+    run_benchmark(args.model, args.turns, args.repeats)
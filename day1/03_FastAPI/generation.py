@@ -0,0 +1,108 @@
+"""
+1件のプロンプトの生成と段階ごとの計測
+
+トークン化・prefill（最初のトークンまで）・decode（残りのトークン）の時間と、
+入力・生成トークン数を GenerationTimer に記録しながら model.generate を実行する。
+/generate（プレフィックスキャッシュの有無によらず）と /generate/stream の両方がこの関数を使う。
+"""
+
+import time
+import torch
+from transformers import DynamicCache
+
+from prefix_cache import supports_prefix_cache
+
+
+class GenerationTimer:
+    """generate の streamer として渡し、段階ごとの時間と生成トークン数を記録する
+
+    Args:
+        inner: テキストを受け取る実際のストリーマー（ストリーミング時のみ）。put/end をそのまま転送する
+    """
+
+    def __init__(self, inner=None):
+        self.inner = inner
+        self.tokenize = 0.0
+        self.prefill = None
+        self.decode = None
+        self.prompt_tokens = 0
+        self.generated_tokens = 0
+        self._started_at = None
+        self._first_token_at = None
+        self._prompt_seen = False
+
+    def start(self):
+        """model.generate を呼ぶ直前に呼ぶ"""
+        self._started_at = time.perf_counter()
+
+    def put(self, value):
+        # generate は最初にプロンプト、その後は1ステップごとに生成トークンを put する
+        if not self._prompt_seen:
+            self._prompt_seen = True
+        else:
+            if self._first_token_at is None:
+                self._first_token_at = time.perf_counter()
+                self.prefill = self._first_token_at - self._started_at
+            self.generated_tokens += 1
+        if self.inner is not None:
+            self.inner.put(value)
+
+    def end(self):
+        now = time.perf_counter()
+        if self._first_token_at is None:
+            self.prefill = now - (self._started_at or now)
+            self.decode = 0.0
+        else:
+            self.decode = now - self._first_token_at
+        if self.inner is not None:
+            self.inner.end()
+
+
+def generate_text(pipe, prompt, timer, prefix_cache=None, cache_namespace=None, **generate_kwargs):
+    """プロンプトから生成する（推論用スレッドで実行する）
+
+    prefix_cache を渡すと、先頭が一致するKVキャッシュを再利用し、生成後のKVキャッシュを保存する
+    （既定のキャッシュが DynamicCache 以外のモデルでは使わない）。
+    複数のモデルでキャッシュを共有する場合は、cache_namespace にモデル名を渡して区別する。
+    生成に失敗した場合も timer.end() を呼ぶため、ストリーミングの読み出し側は止まらない。
+
+    Returns:
+        tuple: (パイプラインと同じ形式の出力, 再利用したトークン数)
+    """
+    tokenizer = pipe.tokenizer
+    lm = pipe.model
+    if prefix_cache is not None and not supports_prefix_cache(lm):
+        prefix_cache = None
+    # トークン化やKVキャッシュの複製で失敗した場合も、読み出し側が終了を待ち続けないようにする
+    try:
+        tokenize_started_at = time.perf_counter()
+        inputs = tokenizer(prompt, return_tensors="pt").to(lm.device)
+        token_ids = inputs["input_ids"][0].tolist()
+        timer.tokenize = time.perf_counter() - tokenize_started_at
+        timer.prompt_tokens = len(token_ids)
+
+        reused = 0
+        if prefix_cache is not None:
+            past_key_values, reused = prefix_cache.lookup(token_ids, namespace=cache_namespace)
+            if past_key_values is None:
+                # 生成後に保存して切り詰められるよう、モデル既定と同じ DynamicCache を明示して渡す
+                past_key_values = DynamicCache()
+            generate_kwargs["past_key_values"] = past_key_values
+        generate_kwargs.setdefault("pad_token_id", tokenizer.pad_token_id if tokenizer.pad_token_id is not None
+                                   else tokenizer.eos_token_id)
+
+        timer.start()
+        with torch.inference_mode():
+            output = lm.generate(**inputs, **generate_kwargs, streamer=timer, return_dict_in_generate=True)
+    except Exception:
+        timer.end()
+        raise
+
+    sequence = output.sequences[0]
+    if prefix_cache is not None:
+        # 最後に生成されたトークンはまだモデルに入力されていないため、キャッシュの長さは1つ短い
+        cached_length = output.past_key_values.get_seq_length()
+        prefix_cache.store(sequence[:cached_length].tolist(), output.past_key_values, namespace=cache_namespace)
+
+    text = tokenizer.decode(sequence[len(token_ids):], skip_special_tokens=True)
+    return [{"generated_text": prompt + text}], reused
@@ -0,0 +1,128 @@
+# load_test.py
+# /generate エンドポイントに同時リクエストを送り、スループットとレイテンシ（p50/p95/p99）を計測する負荷テスト
+#
+# 使い方:
+#   # 起動済みのサーバーを計測する
+#   python load_test.py --url http://localhost:8000 --concurrency 8 --requests 64
+#
+#   # 動的バッチングの有効/無効でサーバーを起動し直して比較する
+#   python load_test.py --compare-batching --concurrency 8 --requests 64
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+# day1/common のモジュールを読み込めるようにする（このディレクトリから実行するため）
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.latency import percentile
+
+PROMPTS = [
+    "AIについて100文字で教えてください",
+    "機械学習とは何ですか？",
+    "Pythonの特徴を3つ挙げてください",
+    "クラウドコンピューティングの利点は？",
+]
+
+
+def run_load(url, concurrency, total_requests, max_new_tokens, do_sample):
+    """同時実行数concurrencyでtotal_requests件のリクエストを送り、結果を集計する"""
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=concurrency, pool_maxsize=concurrency)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+
+    def one_request(i):
+        payload = {
+            "prompt": PROMPTS[i % len(PROMPTS)],
+            "max_new_tokens": max_new_tokens,
+            "do_sample": do_sample,
+            "temperature": 0.7,
+            "top_p": 0.9,
+        }
+        start = time.perf_counter()
+        response = session.post(f"{url}/generate", json=payload, timeout=600)
+        latency = time.perf_counter() - start
+        body = response.json() if response.status_code == 200 else {}
+        return response.status_code, latency, body.get("batch_size")
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(one_request, range(total_requests)))
+    elapsed = time.perf_counter() - start
+
+    latencies = [latency for status, latency, _ in results if status == 200]
+    batch_sizes = [batch_size for status, _, batch_size in results if status == 200 and batch_size]
+    return {
+        "ok": len(latencies),
+        "errors": total_requests - len(latencies),
+        "throughput": len(latencies) / elapsed,
+        "p50": percentile(latencies, 50),
+        "p95": percentile(latencies, 95),
+        "p99": percentile(latencies, 99),
+        "mean_batch_size": statistics.mean(batch_sizes) if batch_sizes else 1.0,
+    }
+
+
+def print_result(label, result):
+    print(f"{label:<14} ok={result['ok']:<5} errors={result['errors']:<4} "
+          f"throughput={result['throughput']:.2f} req/s  "
+          f"p50={result['p50']:.2f}s p95={result['p95']:.2f}s p99={result['p99']:.2f}s  "
+          f"batch={result['mean_batch_size']:.1f}")
+
+
+def wait_until_ready(url, timeout):
+    """サーバーがモデルの読み込みとウォームアップを終えるまで /health/ready をポーリングする"""
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            if requests.get(f"{url}/health/ready", timeout=5).status_code == 200:
+                return True
+        except requests.RequestException:
+            pass
+        time.sleep(2)
+    return False
+
+
+def run_server_and_load(batching, port, args):
+    """BATCHING_ENABLEDを切り替えてサーバーを起動し、負荷をかけて結果を返す"""
+    env = dict(os.environ, BATCHING_ENABLED="1" if batching else "0")
+    server = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "app:app", "--host", "127.0.0.1", "--port", str(port)],
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        env=env,
+    )
+    url = f"http://127.0.0.1:{port}"
+    try:
+        if not wait_until_ready(url, args.startup_timeout):
+            raise RuntimeError("サーバーの起動がタイムアウトしました")
+        run_load(url, args.concurrency, args.concurrency, args.max_new_tokens, args.do_sample)  # ウォームアップ
+        return run_load(url, args.concurrency, args.requests, args.max_new_tokens, args.do_sample)
+    finally:
+        server.terminate()
+        server.wait()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="/generate エンドポイントの負荷テスト")
+    parser.add_argument("--url", default="http://localhost:8000", help="計測するサーバーのURL")
+    parser.add_argument("--concurrency", type=int, default=8, help="同時リクエスト数")
+    parser.add_argument("--requests", type=int, default=64, help="送信するリクエストの総数")
+    parser.add_argument("--max-new-tokens", type=int, default=64, help="1リクエストあたりの生成トークン数")
+    parser.add_argument("--do-sample", action="store_true", help="サンプリングを有効にする")
+    parser.add_argument("--compare-batching", action="store_true",
+                        help="動的バッチングの有効/無効でサーバーを起動して比較する")
+    parser.add_argument("--port", type=int, default=8765, help="--compare-batching で起動するサーバーのポート")
+    parser.add_argument("--startup-timeout", type=float, default=900, help="モデル読み込みの待ち時間（秒）")
+    args = parser.parse_args()
+
+    if args.compare_batching:
+        for batching in (False, True):
+            print_result("batching=on" if batching else "batching=off", run_server_and_load(batching, args.port, args))
+    else:
+        print_result("result", run_load(args.url, args.concurrency, args.requests, args.max_new_tokens, args.do_sample))
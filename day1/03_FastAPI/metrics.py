@@ -0,0 +1,254 @@
+"""
+Prometheus形式のメトリクス
+
+/metrics で公開するカウンター・ゲージ・ヒストグラムを、外部ライブラリを使わずに実装する。
+記録（inc / observe）はロック1回と数値の加算だけなので、本番環境で有効にしたままでも負荷は小さい。
+ラベル付きのメトリクスは、よく使うラベルの組み合わせを labels() で一度取り出して使い回すと、
+記録のたびに子メトリクスを探す処理も省ける。
+リクエスト単位の件数・所要時間は RequestMetricsMiddleware がまとめて記録する。
+"""
+
+import threading
+import time
+from bisect import bisect_left
+
+# 推論の各段階やリクエスト全体のレイテンシ（秒）向けのバケット
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+
+def _format_labels(labelnames, values, extra=()):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(labelnames, values)]
+    pairs.extend(f'{name}="{value}"' for name, value in extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    """メトリクスの共通部分（ラベルごとの子メトリクスを管理する）"""
+
+    type_name = None
+
+    def __init__(self, name, documentation, labelnames=(), registry=None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children = {}
+        self._lock = threading.Lock()
+        (registry if registry is not None else REGISTRY).register(self)
+        if not self.labelnames:
+            self.labels()  # ラベルなしのメトリクスは記録がなくても0として出力する
+
+    def labels(self, **labels):
+        """ラベルの値に対応する子メトリクスを返す"""
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        child = self._children.get(key)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(key, self._new_child())
+        return child
+
+    def _unlabeled(self):
+        return self.labels() if not self.labelnames else None
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type_name}"]
+        for key, child in sorted(self._children.items()):
+            lines.extend(child.render(self.name, self.labelnames, key))
+        return lines
+
+
+class _CounterChild:
+    def __init__(self):
+        self._value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self._value += amount
+
+    @property
+    def value(self):
+        return self._value
+
+    def render(self, name, labelnames, key):
+        return [f"{name}{_format_labels(labelnames, key)} {_format_value(self._value)}"]
+
+
+class Counter(_Metric):
+    """増加するだけの値（リクエスト数、トークン数など）"""
+
+    type_name = "counter"
+
+    def _new_child(self):
+        return _CounterChild()
+
+    def inc(self, amount=1):
+        self._unlabeled().inc(amount)
+
+
+class _GaugeChild:
+    def __init__(self):
+        self._value = 0
+        self._function = None
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self._value += amount
+
+    def dec(self, amount=1):
+        with self._lock:
+            self._value -= amount
+
+    def set(self, value):
+        self._value = value
+
+    def set_function(self, function):
+        """出力のたびに function() の値を読む（記録側の処理が不要になる）"""
+        self._function = function
+
+    @property
+    def value(self):
+        return self._function() if self._function is not None else self._value
+
+    def render(self, name, labelnames, key):
+        return [f"{name}{_format_labels(labelnames, key)} {_format_value(self.value)}"]
+
+
+class Gauge(_Metric):
+    """増減する値（実行中のリクエスト数など）"""
+
+    type_name = "gauge"
+
+    def _new_child(self):
+        return _GaugeChild()
+
+    def inc(self, amount=1):
+        self._unlabeled().inc(amount)
+
+    def dec(self, amount=1):
+        self._unlabeled().dec(amount)
+
+    def set(self, value):
+        self._unlabeled().set(value)
+
+    def set_function(self, function):
+        self._unlabeled().set_function(function)
+
+
+class _HistogramChild:
+    def __init__(self, buckets):
+        self._buckets = buckets
+        self._counts = [0] * (len(buckets) + 1)  # 最後の要素は +Inf バケット
+        self._sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect_left(self._buckets, value)
+        with self._lock:
+            self._counts[index] += 1
+            self._sum += value
+
+    def render(self, name, labelnames, key):
+        with self._lock:
+            counts = list(self._counts)
+            total_sum = self._sum
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self._buckets + (float("inf"),), counts):
+            cumulative += count
+            labels = _format_labels(labelnames, key, extra=(("le", _format_value(float(bound))),))
+            lines.append(f"{name}_bucket{labels} {cumulative}")
+        labels = _format_labels(labelnames, key)
+        lines.append(f"{name}_sum{labels} {_format_value(total_sum)}")
+        lines.append(f"{name}_count{labels} {cumulative}")
+        return lines
+
+
+class Histogram(_Metric):
+    """値の分布（レイテンシなど）。バケットごとの件数と合計を保持する"""
+
+    type_name = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS, registry=None):
+        self.buckets = tuple(float(b) for b in buckets)
+        super().__init__(name, documentation, labelnames, registry)
+
+    def _new_child(self):
+        return _HistogramChild(self.buckets)
+
+    def observe(self, value):
+        self._unlabeled().observe(value)
+
+
+class Registry:
+    """メトリクスの一覧をPrometheusのテキスト形式で出力する"""
+
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+class RequestMetricsMiddleware:
+    """HTTPリクエストの件数・ステータス・所要時間・実行中の数を記録するASGIミドルウェア
+
+    レスポンスの送信が終わるまでを計測するため、ストリーミングのレスポンスも最後まで含まれる。
+    ラベルの種類が増えすぎないよう、アプリに定義されていないパスは "other" にまとめる。
+    """
+
+    def __init__(self, app, requests, errors, duration, in_flight, exclude_paths=("/metrics",)):
+        self.app = app
+        self.requests = requests
+        self.errors = errors
+        self.duration = duration
+        self.in_flight = in_flight
+        self.exclude_paths = set(exclude_paths)
+        self._paths = None
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"] in self.exclude_paths:
+            await self.app(scope, receive, send)
+            return
+        if self._paths is None:
+            self._paths = {route.path for route in scope["app"].routes}
+        endpoint = scope["path"] if scope["path"] in self._paths else "other"
+        status = 500  # レスポンスを返す前に例外で終わった場合
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        in_flight = self.in_flight.labels(endpoint=endpoint)
+        in_flight.inc()
+        started_at = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            in_flight.dec()
+            self.duration.labels(endpoint=endpoint).observe(time.perf_counter() - started_at)
+            self.requests.labels(endpoint=endpoint, status=status).inc()
+            if status >= 500:
+                self.errors.labels(endpoint=endpoint).inc()
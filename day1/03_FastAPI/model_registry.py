@@ -0,0 +1,203 @@
+"""
+モデルレジストリ
+
+1つのプロセスで複数のモデルを提供するため、リクエストで指定されたモデルを必要になった時点で読み込み、
+メモリ上限（memory_budget_bytes）の範囲で常駐させる。上限を超えた場合は、最も長く使われていないモデルから
+メモリを解放する。
+
+- 読み込みは専用のスレッドで1つずつ行う（同時に読み込むとメモリ使用量が一時的に倍増するため）
+- 同じモデルの読み込み中に再度要求されても、実行中の読み込みのFutureを返す
+- 読み込み・解放・失敗のイベントは events に記録し、on_event でも通知する
+- 解放はレジストリからの参照を外すだけなので、実行中の推論が使っているモデルは推論が終わるまで残る
+"""
+
+import gc
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+
+import torch
+
+
+class UnknownModelError(Exception):
+    """レジストリに登録されていないモデルが指定された"""
+
+
+def release_memory():
+    """手放したモデルのメモリを回収する（GPUではキャッシュしているメモリも返却する）"""
+    gc.collect()
+    if torch.cuda.is_available():
+        torch.cuda.empty_cache()
+
+
+def model_nbytes(pipe):
+    """モデルの重みとバッファが使用しているメモリ（バイト）
+
+    動的int8量子化した層の重みは parameters() に含まれないため、state_dict から数える。
+    入力と出力で共有している重みは1回だけ数える。
+    """
+    total = 0
+    seen = set()
+    for value in pipe.model.state_dict().values():
+        # 量子化した Linear 層の重みは (weight, bias) のタプルで格納されている
+        for tensor in value if isinstance(value, tuple) else (value,):
+            if not isinstance(tensor, torch.Tensor) or tensor.data_ptr() in seen:
+                continue
+            seen.add(tensor.data_ptr())
+            total += tensor.numel() * tensor.element_size()
+    return total
+
+
+class _ModelEntry:
+    def __init__(self, name, model_id):
+        self.name = name
+        self.model_id = model_id
+        self.state = "not_loaded"  # not_loaded → loading → warming_up → ready（失敗したら failed）
+        self.pipe = None
+        self.nbytes = 0
+        self.last_nbytes = 0       # 前回読み込んだときのサイズ（再読み込み前に空ける容量の見積もり）
+        self.load_time = None
+        self.last_used = 0.0
+        self.future = None
+
+
+class ModelRegistry:
+    """モデルを必要に応じて読み込み、メモリ上限の範囲でLRUで常駐させるレジストリ
+
+    Args:
+        models: {モデル名: HuggingFaceのモデルID}
+        memory_budget_bytes: 常駐させるモデルの合計サイズの上限
+        load_fn: モデルIDを受け取り、text-generationパイプラインを返す関数（失敗時は例外）
+        warm_up_fn: 読み込み後、準備完了にする前にパイプラインを受け取って実行する関数（任意）
+        on_event: イベント（dict）を受け取るコールバック（任意）
+    """
+
+    def __init__(self, models, memory_budget_bytes, load_fn, warm_up_fn=None, on_event=None):
+        self.memory_budget_bytes = memory_budget_bytes
+        self.load_fn = load_fn
+        self.warm_up_fn = warm_up_fn
+        self.on_event = on_event
+        self._entries = {name: _ModelEntry(name, model_id) for name, model_id in models.items()}
+        self._resident = OrderedDict()  # 常駐しているモデル名（LRU順）
+        self._lock = threading.Lock()
+        self._loader = ThreadPoolExecutor(max_workers=1, thread_name_prefix="model-loader")
+        self.events = deque(maxlen=100)
+
+    @property
+    def names(self):
+        return list(self._entries)
+
+    def state(self, name):
+        return self._entry(name).state
+
+    def model_id(self, name):
+        return self._entry(name).model_id
+
+    def get(self, name):
+        """準備ができているモデルのパイプラインを返す（なければNone）。使用したモデルとして記録する"""
+        entry = self._entry(name)
+        with self._lock:
+            if entry.state != "ready":
+                return None
+            entry.last_used = time.time()
+            self._resident.move_to_end(name)
+            return entry.pipe
+
+    def ensure_loaded(self, name):
+        """モデルの読み込みを開始し、完了（パイプラインまたはNone）を表すFutureを返す
+
+        読み込み中・読み込み済みなら既存のFutureを返す。失敗または解放された後は読み込みをやり直す。
+        """
+        entry = self._entry(name)
+        with self._lock:
+            if entry.future is None or (entry.future.done() and entry.state in ("failed", "not_loaded")):
+                entry.state = "loading"
+                entry.future = self._loader.submit(self._load, entry)
+            return entry.future
+
+    def residency(self):
+        """モデルごとの状態と常駐サイズ"""
+        with self._lock:
+            return {
+                "memory_budget_bytes": self.memory_budget_bytes,
+                "resident_bytes": sum(self._entries[name].nbytes for name in self._resident),
+                "models": [
+                    {
+                        "name": entry.name,
+                        "model_id": entry.model_id,
+                        "state": entry.state,
+                        "resident": entry.name in self._resident,
+                        "bytes": entry.nbytes,
+                        "load_time": entry.load_time,
+                        "last_used": entry.last_used or None,
+                    }
+                    for entry in self._entries.values()
+                ],
+            }
+
+    def _entry(self, name):
+        entry = self._entries.get(name)
+        if entry is None:
+            raise UnknownModelError(name)
+        return entry
+
+    def _load(self, entry):
+        """モデルを読み込んで常駐させる（読み込み用スレッドで実行される）"""
+        # 前回のサイズが分かっていれば、読み込む前に容量を空けておく
+        with self._lock:
+            evicted = self._evict_until(self.memory_budget_bytes - entry.last_nbytes, keep=entry.name)
+        if evicted:
+            release_memory()
+
+        start_time = time.time()
+        try:
+            pipe = self.load_fn(entry.model_id)
+            if self.warm_up_fn is not None:
+                entry.state = "warming_up"
+                self.warm_up_fn(pipe)
+        except Exception as e:
+            entry.state = "failed"
+            self._emit("load_failed", entry, error=str(e))
+            return None
+
+        nbytes = model_nbytes(pipe)
+        with self._lock:
+            entry.pipe = pipe
+            entry.nbytes = entry.last_nbytes = nbytes
+            entry.load_time = time.time() - start_time
+            entry.last_used = time.time()
+            entry.state = "ready"
+            self._resident[entry.name] = True
+            self._emit("load", entry, seconds=entry.load_time)
+            evicted = self._evict_until(self.memory_budget_bytes, keep=entry.name)
+        if evicted:
+            release_memory()
+        return pipe
+
+    def _evict_until(self, budget, keep):
+        """常駐サイズの合計が budget 以下になるまで、最も長く使われていないモデルを手放す（ロック内で呼ぶ）
+
+        GCはリクエストごとに取るロックを長く塞ぐため、ここでは行わない。
+        1つ以上手放した場合はTrueを返すので、呼び出し側がロックの外で release_memory() を呼ぶ。
+        """
+        evicted = False
+        for name in list(self._resident):
+            if sum(self._entries[n].nbytes for n in self._resident) <= budget:
+                break
+            if name == keep:
+                continue
+            entry = self._entries[name]
+            del self._resident[name]
+            self._emit("evict", entry)
+            entry.pipe = None
+            entry.nbytes = 0
+            entry.state = "not_loaded"
+            evicted = True
+        return evicted
+
+    def _emit(self, event, entry, **details):
+        record = {"time": time.time(), "event": event, "model": entry.name, "bytes": entry.nbytes, **details}
+        self.events.append(record)
+        if self.on_event is not None:
+            self.on_event(record)
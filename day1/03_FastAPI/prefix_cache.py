@@ -0,0 +1,193 @@
+"""
+KVキャッシュのプレフィックス再利用
+
+チャットでは毎ターン、これまでの会話履歴をすべて含んだプロンプトが送られてくるため、
+そのままでは履歴全体を毎回最初からエンコード（prefill）し直すことになる。
+生成後のKVキャッシュ（past_key_values）をトークン列のプレフィックスのハッシュで保存しておき、
+次のリクエストの先頭が一致すればそのキャッシュから続きを計算して、新しいトークンだけをprefillする。
+
+- プレフィックスは BLOCK_SIZE トークンごとの連鎖ハッシュで索引付けし、最も長く一致するブロック境界を探す
+  （ハッシュは衝突しうるため、トークン列そのものが一致することも確かめる。
+  見つかったキャッシュは、境界から先もトークンが一致する限り再利用する）
+- 保存したキャッシュは使うたびに複製して渡す（generate がキャッシュを書き換えるため）
+- 合計のメモリ使用量が memory_budget_bytes を超えたら、最も長く使われていないものから削除する
+- トークンIDの意味はモデルごとに異なるため、キャッシュはモデル名（namespace）ごとに分けて扱う
+- 既定のキャッシュが DynamicCache 以外のモデル（Gemma2のスライディングウィンドウ用 HybridCache など）には使わない
+  （DynamicCache に置き換えると、モデル本来の注意の範囲と結果が変わりうるため。supports_prefix_cache で判定する）
+
+キャッシュの参照と保存は generation.generate_text が行う。
+"""
+
+import copy
+import threading
+from collections import OrderedDict
+
+BLOCK_SIZE = 16
+
+
+def prefix_hashes(token_ids, block_size=BLOCK_SIZE, namespace=None):
+    """ブロック境界ごとのプレフィックスのハッシュ [(長さ, ハッシュ), ...] を返す
+
+    各ハッシュは直前のハッシュとブロックのトークンから作るため、長さ n のハッシュが一致すれば
+    （衝突を除き）先頭 n トークンがすべて一致している。最初のハッシュには namespace を含める。
+    """
+    hashes = []
+    h = namespace
+    for end in range(block_size, len(token_ids) + 1, block_size):
+        h = hash((h, tuple(token_ids[end - block_size:end])))
+        hashes.append((end, h))
+    return hashes
+
+
+def supports_prefix_cache(model):
+    """モデルの既定のKVキャッシュが DynamicCache か（プレフィックスキャッシュを使ってよいか）
+
+    Gemma2 などは config / generation_config の cache_implementation に "hybrid" などを指定しており、
+    既定で DynamicCache 以外のキャッシュを使う。
+    """
+    for config in (getattr(model, "generation_config", None), getattr(model, "config", None)):
+        if getattr(config, "cache_implementation", None) not in (None, "dynamic"):
+            return False
+    return True
+
+
+def _kv_tensors(past_key_values):
+    """KVキャッシュに含まれるテンソルを列挙する（DynamicCacheと従来のタプル形式に対応）"""
+    if hasattr(past_key_values, "layers"):
+        for layer in past_key_values.layers:
+            yield layer.keys
+            yield layer.values
+    elif hasattr(past_key_values, "key_cache"):
+        yield from past_key_values.key_cache
+        yield from past_key_values.value_cache
+    else:
+        for layer in past_key_values:
+            yield from layer
+
+
+def kv_nbytes(past_key_values):
+    """KVキャッシュが使用しているメモリ（バイト）"""
+    return sum(t.numel() * t.element_size() for t in _kv_tensors(past_key_values) if t is not None)
+
+
+class _Entry:
+    def __init__(self, token_ids, past_key_values, nbytes, namespace):
+        self.token_ids = token_ids
+        self.past_key_values = past_key_values
+        self.nbytes = nbytes
+        self.namespace = namespace
+        self.block_hashes = [h for _, h in prefix_hashes(token_ids, namespace=namespace)]
+
+
+class PrefixCache:
+    """トークン列のプレフィックスをキーにKVキャッシュを保持するプール
+
+    Args:
+        memory_budget_bytes: 保持するKVキャッシュの合計サイズの上限
+    """
+
+    def __init__(self, memory_budget_bytes):
+        self.memory_budget_bytes = memory_budget_bytes
+        self._entries = OrderedDict()  # 全トークン列のハッシュ -> _Entry（LRU順）
+        self._index = {}               # ブロック境界のハッシュ -> 全トークン列のハッシュ
+        self._lock = threading.Lock()
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.reused_tokens = 0
+        self.evictions = 0
+
+    def lookup(self, token_ids, namespace=None):
+        """token_ids の先頭と一致する最長のキャッシュを namespace の中から探す
+
+        生成には少なくとも1トークンの入力が必要なため、一致する長さは len(token_ids) - 1 までに抑える。
+
+        Returns:
+            tuple: (複製したKVキャッシュ, 再利用するトークン数)。見つからなければ (None, 0)
+        """
+        with self._lock:
+            entry, length = None, 0
+            for end, h in reversed(prefix_hashes(token_ids, namespace=namespace)):
+                key = self._index.get(h)
+                # ハッシュが衝突した別のトークン列のキャッシュは使わず、次に短い境界を試す
+                if key is not None and self._entries[key].token_ids[:end] == token_ids[:end]:
+                    entry, length = self._entries[key], end
+                    break
+            if entry is None:
+                self.misses += 1
+                return None, 0
+            self._entries.move_to_end(key)
+            # ブロック境界から先も、トークンが一致する限り再利用する
+            cached_ids = entry.token_ids
+            while length < len(cached_ids) and length < len(token_ids) and cached_ids[length] == token_ids[length]:
+                length += 1
+            length = min(length, len(token_ids) - 1)
+            self.hits += 1
+            self.reused_tokens += length
+            source = entry.past_key_values
+
+        # 複製は時間がかかるためロックの外で行う（削除されてもこの参照は有効なまま）
+        past_key_values = copy.deepcopy(source)
+        past_key_values.crop(length)  # 一致した長さより後ろのキャッシュは捨てる
+        return past_key_values, length
+
+    def store(self, token_ids, past_key_values, namespace=None):
+        """token_ids（KVキャッシュが計算済みのトークン列）のKVキャッシュを namespace に保存する"""
+        if len(token_ids) < BLOCK_SIZE:
+            return
+        nbytes = kv_nbytes(past_key_values)
+        if nbytes > self.memory_budget_bytes:
+            return
+        token_ids = list(token_ids)
+        key = hash((namespace, tuple(token_ids)))
+        with self._lock:
+            if key in self._entries:
+                if self._entries[key].token_ids == token_ids:
+                    self._entries.move_to_end(key)
+                    return
+                # ハッシュが衝突した別のトークン列のキャッシュは置き換える
+                self._remove(key)
+            entry = _Entry(token_ids, past_key_values, nbytes, namespace)
+            self._entries[key] = entry
+            self.total_bytes += nbytes
+            # 同じプレフィックスを持つ古いキャッシュがあっても、新しいもの（より長く会話が続いている方）を指す
+            for h in entry.block_hashes:
+                self._index[h] = key
+            while self.total_bytes > self.memory_budget_bytes:
+                self._evict_oldest()
+
+    def discard(self, namespace):
+        """namespace のキャッシュをすべて削除する（モデルをメモリから解放したときなど）"""
+        with self._lock:
+            for key in [k for k, e in self._entries.items() if e.namespace == namespace]:
+                self._remove(key)
+
+    def _evict_oldest(self):
+        self._remove(next(iter(self._entries)))
+        self.evictions += 1
+
+    def _remove(self, key):
+        entry = self._entries.pop(key)
+        self.total_bytes -= entry.nbytes
+        for h in entry.block_hashes:
+            if self._index.get(h) == key:
+                # 他のキャッシュも同じプレフィックスを持っていれば、そちらを指すように付け替える
+                replacement = next((k for k, e in reversed(self._entries.items()) if h in e.block_hashes), None)
+                if replacement is None:
+                    del self._index[h]
+                else:
+                    self._index[h] = replacement
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "total_bytes": self.total_bytes,
+                "memory_budget_bytes": self.memory_budget_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "reused_tokens": self.reused_tokens,
+                "evictions": self.evictions,
+            }
@@ -1,10 +1,20 @@
 # python_client.py
 # このコードは、ngrokで公開されたAPIにアクセスするPythonクライアントの例です
 
-import requests
+import asyncio
 import json
+import os
+import sys
 import time
 
+import httpx
+import requests
+
+# day1/common のモジュールを読み込めるようにする（このディレクトリから実行するため）
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.latency import percentile
+from common.retry import RetryPolicy
+
 class LLMClient:
     """LLM API クライアントクラス"""
     
@@ -28,7 +38,7 @@ class LLMClient:
         response = self.session.get(f"{self.api_url}/health")
         return response.json()
     
-    def generate(self, prompt, max_new_tokens=512, temperature=0.7, top_p=0.9, do_sample=True):
+    def generate(self, prompt, max_new_tokens=512, temperature=0.7, top_p=0.9, do_sample=True, seed=None, model=None):
         """
         テキスト生成
         
@@ -38,6 +48,8 @@ class LLMClient:
             temperature (float, optional): 温度パラメータ
             top_p (float, optional): top-p サンプリングのパラメータ
             do_sample (bool, optional): サンプリングを行うかどうか
+            seed (int, optional): 乱数シード（指定すると結果を再現でき、サーバー側でキャッシュされる）
+            model (str, optional): 使用するモデル名（省略時はサーバーの既定のモデル）
         
         Returns:
             dict: 生成結果
@@ -47,7 +59,9 @@ class LLMClient:
             "max_new_tokens": max_new_tokens,
             "temperature": temperature,
             "top_p": top_p,
-            "do_sample": do_sample
+            "do_sample": do_sample,
+            "seed": seed,
+            "model": model
         }
         
         start_time = time.time()
@@ -63,6 +77,197 @@ class LLMClient:
             return result
         else:
             raise Exception(f"API error: {response.status_code} - {response.text}")
+    
+    def generate_stream(self, prompt, max_new_tokens=512, temperature=0.7, top_p=0.9, do_sample=True, seed=None, model=None):
+        """
+        テキスト生成（ストリーミング）
+        
+        /generate/stream から届いたイベントを順に返すイテレータ。
+        生成中は {"text": ...}、最後に {"done": True, "response_time": ..., "completion_tokens": ..., ...} を返す。
+        最後のイベントにはクライアント側で計測した first_token_time（最初のテキストが届くまでの秒数）と
+        total_request_time も追加される。
+        
+        Args:
+            prompt (str): プロンプト文字列
+            max_new_tokens (int, optional): 生成する最大トークン数
+            temperature (float, optional): 温度パラメータ
+            top_p (float, optional): top-p サンプリングのパラメータ
+            do_sample (bool, optional): サンプリングを行うかどうか
+            seed (int, optional): 乱数シード（指定すると結果を再現でき、サーバー側でキャッシュされる）
+            model (str, optional): 使用するモデル名（省略時はサーバーの既定のモデル）
+        
+        Yields:
+            dict: 生成イベント
+        """
+        payload = {
+            "prompt": prompt,
+            "max_new_tokens": max_new_tokens,
+            "temperature": temperature,
+            "top_p": top_p,
+            "do_sample": do_sample,
+            "seed": seed,
+            "model": model
+        }
+        
+        start_time = time.time()
+        first_token_time = None
+        with self.session.post(f"{self.api_url}/generate/stream", json=payload, stream=True) as response:
+            if response.status_code != 200:
+                raise Exception(f"API error: {response.status_code} - {response.text}")
+            response.encoding = "utf-8"
+            # chunk_size=None で届いた分をすぐに読み出す（既定ではバッファが埋まるまで待ってしまう）
+            for line in response.iter_lines(chunk_size=None, decode_unicode=True):
+                if not line or not line.startswith("data:"):
+                    continue
+                event = json.loads(line[len("data:"):])
+                if "error" in event:
+                    raise Exception(f"API error: {event['error']}")
+                if "text" in event and first_token_time is None:
+                    first_token_time = time.time() - start_time
+                if event.get("done"):
+                    event["first_token_time"] = first_token_time
+                    event["total_request_time"] = time.time() - start_time
+                yield event
+
+
+class AsyncLLMClient:
+    """
+    LLM API の非同期クライアントクラス（大量のプロンプトの評価用）
+
+    httpx.AsyncClient のコネクションプールを使い回し、最大 concurrency 件のリクエストを同時に送る。
+    接続エラー・タイムアウトと一時的なHTTPステータス（429、5xxなど）は common.retry.RetryPolicy で再試行する
+    （判定はサーバー側のモデル呼び出しと同じ is_transient_error。Retry-After にも従う）。
+
+    使用例:
+        async with AsyncLLMClient(url, concurrency=8) as client:
+            results, summary = await client.generate_many(prompts, max_new_tokens=128)
+    """
+
+    def __init__(self, api_url, concurrency=8, timeout=600.0, connect_timeout=10.0,
+                 max_attempts=3, base_delay=0.5, max_delay=8.0):
+        """
+        初期化
+
+        Args:
+            api_url (str): API のベース URL（ngrok URL）
+            concurrency (int, optional): 同時に送るリクエスト数の既定値（コネクションプールの上限も兼ねる）
+            timeout (float, optional): 1回のリクエストのタイムアウト秒数（生成を待つ時間を含む）
+            connect_timeout (float, optional): 接続のタイムアウト秒数
+            max_attempts (int, optional): 1件あたりの最大試行回数（初回を含む）
+            base_delay (float, optional): 再試行の待ち時間の初期値（秒）
+            max_delay (float, optional): 再試行の待ち時間の上限（秒）
+        """
+        self.api_url = api_url.rstrip('/')
+        self.concurrency = concurrency
+        self.retry_policy = RetryPolicy(
+            name="llm-client", max_attempts=max_attempts, base_delay=base_delay, max_delay=max_delay
+        )
+        self.client = httpx.AsyncClient(
+            limits=httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency),
+            timeout=httpx.Timeout(timeout, connect=connect_timeout),
+        )
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def close(self):
+        """コネクションプールを閉じる"""
+        await self.client.aclose()
+
+    async def generate(self, prompt, max_new_tokens=512, temperature=0.7, top_p=0.9, do_sample=True, seed=None, model=None):
+        """
+        テキスト生成（一時的な失敗は再試行する）
+
+        Args:
+            prompt (str): プロンプト文字列
+            max_new_tokens (int, optional): 生成する最大トークン数
+            temperature (float, optional): 温度パラメータ
+            top_p (float, optional): top-p サンプリングのパラメータ
+            do_sample (bool, optional): サンプリングを行うかどうか
+            seed (int, optional): 乱数シード（指定すると結果を再現でき、サーバー側でキャッシュされる）
+            model (str, optional): 使用するモデル名（省略時はサーバーの既定のモデル）
+
+        Returns:
+            dict: 生成結果（total_request_time は再試行の待ち時間を含む全体の秒数、attempts は試行回数）
+        """
+        payload = {
+            "prompt": prompt,
+            "max_new_tokens": max_new_tokens,
+            "temperature": temperature,
+            "top_p": top_p,
+            "do_sample": do_sample,
+            "seed": seed,
+            "model": model
+        }
+
+        attempts = 0
+
+        async def post():
+            nonlocal attempts
+            attempts += 1
+            response = await self.client.post(f"{self.api_url}/generate", json=payload)
+            # ステータスを例外にすると、RetryPolicy がステータスで再試行するか判定する
+            response.raise_for_status()
+            return response.json()
+
+        start_time = time.perf_counter()
+        try:
+            result = await self.retry_policy.acall(post)
+        except httpx.HTTPStatusError as e:
+            raise Exception(f"API error: {e.response.status_code} - {e.response.text}") from e
+        except httpx.TransportError as e:
+            raise Exception(f"API error: {type(e).__name__} - {e}") from e
+        result["total_request_time"] = time.perf_counter() - start_time
+        result["attempts"] = attempts
+        return result
+
+    async def generate_many(self, prompts, concurrency=None, **kwargs):
+        """
+        複数のプロンプトを同時実行数を制限して生成する
+
+        結果は prompts と同じ順番で返す。再試行しても失敗したプロンプトは例外を送出せず、
+        {"prompt": ..., "error": ..., "total_request_time": ...} を結果に入れる。
+
+        Args:
+            prompts (list[str]): プロンプトのリスト
+            concurrency (int, optional): 同時に送るリクエスト数（省略時は初期化時の値。プールの上限を超えた分は接続待ちになる）
+            **kwargs: generate に渡す生成パラメータ
+
+        Returns:
+            tuple[list[dict], dict]: プロンプトごとの結果と、全体の集計
+                （ok, errors, retries, elapsed, throughput, レイテンシの mean/p50/p95/p99/max）
+        """
+        semaphore = asyncio.Semaphore(concurrency or self.concurrency)
+
+        async def one_request(prompt):
+            async with semaphore:
+                start_time = time.perf_counter()
+                try:
+                    return await self.generate(prompt, **kwargs)
+                except Exception as e:
+                    return {"prompt": prompt, "error": str(e), "total_request_time": time.perf_counter() - start_time}
+
+        start_time = time.perf_counter()
+        results = await asyncio.gather(*(one_request(prompt) for prompt in prompts))
+        elapsed = time.perf_counter() - start_time
+
+        latencies = [r["total_request_time"] for r in results if "error" not in r]
+        summary = {
+            "ok": len(latencies),
+            "errors": len(results) - len(latencies),
+            "retries": sum(r["attempts"] - 1 for r in results if "error" not in r),
+            "elapsed": elapsed,
+            "throughput": len(latencies) / elapsed if elapsed > 0 else 0.0,
+            "mean": sum(latencies) / len(latencies) if latencies else float("nan"),
+            "p50": percentile(latencies, 50),
+            "p95": percentile(latencies, 95),
+            "p99": percentile(latencies, 99),
+            "max": max(latencies, default=float("nan")),
+        }
+        return results, summary
 
 # 使用例
 if __name__ == "__main__":
@@ -79,9 +284,45 @@ if __name__ == "__main__":
     
     # 単一の質問
     print("Simple question:")
-    result = client.generate([
-        {"prompt": "AIについて100文字で教えてください"}
-    ])
+    result = client.generate("AIについて100文字で教えてください")
     print(f"Response: {result['generated_text']}")
     print(f"Model processing time: {result['response_time']:.2f}s")
-    print(f"Total request time: {result['total_request_time']:.2f}s")    
\ No newline at end of file
+    print(f"Total request time: {result['total_request_time']:.2f}s")
+    print()
+    
+    # ストリーミングで生成（最初のトークンから順に表示）
+    print("Streaming question:")
+    for event in client.generate_stream("AIについて100文字で教えてください"):
+        if "text" in event:
+            print(event["text"], end="", flush=True)
+        elif event.get("done"):
+            print()
+            # テキストが1つも届かずに終わった場合、first_token_time は None になる
+            if event["first_token_time"] is not None:
+                print(f"First token time: {event['first_token_time']:.2f}s")
+            print(f"Completion tokens: {event['completion_tokens']}")
+            print(f"Total request time: {event['total_request_time']:.2f}s")
+    print()
+
+    # 複数のプロンプトをまとめて生成（同時に最大4件、結果は入力と同じ順番）
+    print("Batch questions:")
+    prompts = [
+        "AIについて100文字で教えてください",
+        "機械学習とは何ですか？",
+        "Pythonの特徴を3つ挙げてください",
+        "クラウドコンピューティングの利点は？",
+    ]
+
+    async def run_batch():
+        async with AsyncLLMClient(NGROK_URL, concurrency=4) as async_client:
+            return await async_client.generate_many(prompts, max_new_tokens=128)
+
+    results, summary = asyncio.run(run_batch())
+    for prompt, result in zip(prompts, results):
+        if "error" in result:
+            print(f"{prompt}: ERROR {result['error']}")
+        else:
+            print(f"{prompt}: {result['total_request_time']:.2f}s ({result['attempts']} attempt(s))")
+    print(f"ok={summary['ok']} errors={summary['errors']} retries={summary['retries']} "
+          f"throughput={summary['throughput']:.2f} req/s")
+    print(f"Latency p50={summary['p50']:.2f}s p95={summary['p95']:.2f}s p99={summary['p99']:.2f}s max={summary['max']:.2f}s")
@@ -0,0 +1,257 @@
+"""
+応答キャッシュ
+
+同じプロンプト・同じ生成パラメータで結果が決まるリクエスト（do_sample=False、またはseed指定あり）の
+生成結果を保存し、2回目以降はモデルを実行せずに返す。
+
+- メモリ上のLRU（件数・バイト数の上限とTTLで削除）
+- 任意でSQLiteのディスクキャッシュ（プロセスを再起動しても残る。メモリから外れた結果もここから戻す）
+  ディスクへの書き込みは専用のスレッドで行い、読み込みは aget で別スレッドから行うため、イベントループを塞がない
+
+サンプリングありでseedを指定しないリクエストは、毎回異なる結果を返すべきなのでキャッシュしない。
+"""
+
+import asyncio
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+
+def is_cacheable(do_sample, seed):
+    """結果が入力だけで決まる（キャッシュしてよい）リクエストか"""
+    return not do_sample or seed is not None
+
+
+def cache_key(model_name, prompt, max_new_tokens, do_sample, temperature, top_p, seed):
+    """プロンプトと生成パラメータを正規化したハッシュ
+
+    - プロンプトはUnicode正規化（NFC）と改行コードの統一を行う
+    - サンプリングしない場合、結果に影響しない temperature / top_p / seed はキーに含めない
+    - 数値は型を揃え、JSONのキー順を固定して同じ内容が必ず同じ文字列になるようにする
+    """
+    prompt = unicodedata.normalize("NFC", prompt).replace("\r\n", "\n")
+    params = {"model": model_name, "max_new_tokens": int(max_new_tokens), "do_sample": bool(do_sample)}
+    if do_sample:
+        params.update(temperature=round(float(temperature), 6), top_p=round(float(top_p), 6), seed=int(seed))
+    payload = json.dumps({"prompt": prompt, "params": params}, ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+DISK_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS response_cache
+(key TEXT PRIMARY KEY,
+ value TEXT NOT NULL,
+ expires_at REAL NOT NULL,
+ accessed_at REAL NOT NULL)
+'''
+DISK_INDEXES = (
+    "CREATE INDEX IF NOT EXISTS idx_response_cache_expires_at ON response_cache (expires_at)",
+    "CREATE INDEX IF NOT EXISTS idx_response_cache_accessed_at ON response_cache (accessed_at)",
+)
+
+
+class ResponseCache:
+    """メモリ上のLRUと任意のディスクキャッシュからなる2段の応答キャッシュ
+
+    Args:
+        max_entries: メモリに保持する件数の上限（超えた分は最も長く使われていないものから削除）
+        ttl: 有効期限（秒）
+        disk_path: ディスクキャッシュのSQLiteファイル（Noneならメモリのみ）
+        max_disk_entries: ディスクに保持する件数の上限
+        max_bytes: メモリに保持する値（JSON）の合計バイト数の上限
+        max_disk_bytes: ディスクに保持する値（JSON）の合計バイト数の上限
+    """
+
+    def __init__(self, max_entries=256, ttl=3600, disk_path=None, max_disk_entries=10000,
+                 max_bytes=64 * 1024 * 1024, max_disk_bytes=1024 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_disk_entries = max_disk_entries
+        self.max_bytes = max_bytes
+        self.max_disk_bytes = max_disk_bytes
+        self._entries = OrderedDict()  # key -> (value, expires_at, size)
+        self._bytes = 0
+        self._lock = threading.Lock()  # メモリ上のLRUと統計用（ディスクの操作中は持たない）
+        self._disk = None
+        self._disk_lock = threading.Lock()  # SQLiteの接続を複数のスレッドで同時に使わないためのロック
+        self._disk_writer = None
+        if disk_path:
+            self._disk = sqlite3.connect(disk_path, check_same_thread=False)
+            self._disk.execute("PRAGMA journal_mode=WAL")
+            self._disk.execute(DISK_SCHEMA)
+            for statement in DISK_INDEXES:
+                self._disk.execute(statement)
+            self._disk.commit()
+            # 書き込みは1つのスレッドで順番に行う（呼び出し側はコミットを待たない）
+            self._disk_writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="response-cache-disk")
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.bypassed = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key):
+        """キャッシュされた値を返す（なければNone）"""
+        now = time.time()
+        value = self._memory_get(key, now)
+        if value is not None:
+            return value
+        return self._get_from_disk(key, now)
+
+    async def aget(self, key):
+        """get のイベントループ用。メモリになくディスクを引く場合だけ別スレッドで実行する"""
+        now = time.time()
+        value = self._memory_get(key, now)
+        if value is not None or self._disk is None:
+            return value if value is not None else self._get_from_disk(key, now)
+        return await asyncio.to_thread(self._get_from_disk, key, now)
+
+    def put(self, key, value):
+        """値を保存する（valueはJSONにできるもの。ディスクへの書き込みは専用のスレッドで行い、完了を待たない）"""
+        expires_at = time.time() + self.ttl
+        serialized = json.dumps(value, ensure_ascii=False)
+        with self._lock:
+            self._store(key, value, expires_at, len(serialized.encode("utf-8")))
+        if self._disk_writer is not None:
+            self._disk_writer.submit(self._disk_put, key, serialized, expires_at)
+
+    def record_bypass(self):
+        """キャッシュ対象外のリクエストを数える"""
+        with self._lock:
+            self.bypassed += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+        if self._disk_writer is not None:
+            # 書き込み待ちの値より後に削除されるよう、書き込み用のスレッドで実行して完了を待つ
+            self._disk_writer.submit(self._disk_clear).result()
+
+    def stats(self):
+        """ヒット率などの統計（ディスクキャッシュがある場合はSQLiteを読むため、イベントループからは別スレッドで呼ぶ）"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            stats = {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "ttl": self.ttl,
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "bypassed": self.bypassed,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
+        if self._disk is not None:
+            with self._disk_lock:
+                count, size = self._disk.execute(
+                    "SELECT COUNT(*), COALESCE(SUM(length(CAST(value AS BLOB))), 0) FROM response_cache"
+                ).fetchone()
+            stats.update(disk_entries=count, disk_bytes=size, max_disk_bytes=self.max_disk_bytes)
+        return stats
+
+    def _memory_get(self, key, now):
+        """メモリ上の値を返す（なければNone。ミスは数えない）"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            value, expires_at, size = entry
+            if expires_at > now:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return value
+            del self._entries[key]
+            self._bytes -= size
+            self.expirations += 1
+            return None
+
+    def _get_from_disk(self, key, now):
+        """ディスクキャッシュから値を返し、メモリに戻す（なければミスとして数えてNone）"""
+        found = None
+        if self._disk is not None:
+            with self._disk_lock:
+                found = self._disk_get(key, now)
+        with self._lock:
+            if found is None:
+                self.misses += 1
+                return None
+            # ディスクで見つかった値はメモリに戻す（有効期限はディスクのものを引き継ぐ）
+            value, expires_at, size = found
+            self._store(key, value, expires_at, size)
+            self.hits += 1
+            self.disk_hits += 1
+            return value
+
+    def _store(self, key, value, expires_at, size):
+        previous = self._entries.pop(key, None)
+        if previous is not None:
+            self._bytes -= previous[2]
+        if size > self.max_bytes:
+            # 上限より大きい値はメモリに置かない（他の値をすべて追い出さないように）
+            return
+        self._entries[key] = (value, expires_at, size)
+        self._bytes += size
+        while self._entries and (len(self._entries) > self.max_entries or self._bytes > self.max_bytes):
+            _, (_, _, evicted_size) = self._entries.popitem(last=False)
+            self._bytes -= evicted_size
+            self.evictions += 1
+
+    def _disk_get(self, key, now):
+        """ディスクキャッシュから (値, 有効期限, バイト数) を返す（期限切れは削除してNone）"""
+        row = self._disk.execute("SELECT value, expires_at FROM response_cache WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        if row[1] <= now:
+            self._disk.execute("DELETE FROM response_cache WHERE key = ?", (key,))
+            self._disk.commit()
+            with self._lock:
+                self.expirations += 1
+            return None
+        self._disk.execute("UPDATE response_cache SET accessed_at = ? WHERE key = ?", (now, key))
+        self._disk.commit()
+        return json.loads(row[0]), row[1], len(row[0].encode("utf-8"))
+
+    def _disk_put(self, key, serialized, expires_at):
+        """ディスクに値を書き込む（書き込み用のスレッドで実行される）"""
+        try:
+            with self._disk_lock:
+                self._disk.execute(
+                    "INSERT OR REPLACE INTO response_cache (key, value, expires_at, accessed_at) VALUES (?, ?, ?, ?)",
+                    (key, serialized, expires_at, time.time()),
+                )
+                self._trim_disk()
+                self._disk.commit()
+        except sqlite3.Error as e:
+            # 呼び出し側は完了を待たないため、ここで記録する（メモリには保存済み）
+            print(f"応答キャッシュのディスクへの書き込みに失敗しました: {e}")
+
+    def _disk_clear(self):
+        with self._disk_lock:
+            self._disk.execute("DELETE FROM response_cache")
+            self._disk.commit()
+
+    def _trim_disk(self):
+        """期限切れの値と、件数・バイト数の上限を超えた分（最後に使われたのが古い順）を削除する"""
+        self._disk.execute("DELETE FROM response_cache WHERE expires_at <= ?", (time.time(),))
+        self._disk.execute(
+            "DELETE FROM response_cache WHERE key IN ("
+            " SELECT key FROM response_cache ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)",
+            (self.max_disk_entries,),
+        )
+        self._disk.execute(
+            "DELETE FROM response_cache WHERE key IN ("
+            " SELECT key FROM (SELECT key, SUM(length(CAST(value AS BLOB))) OVER (ORDER BY accessed_at DESC, key)"
+            " AS total FROM response_cache) WHERE total > ?)",
+            (self.max_disk_bytes,),
+        )
@@ -0,0 +1,87 @@
+"""
+ストリーミング生成
+
+/generate/stream 用に、推論用スレッドでの model.generate とイベントループ上のレスポンスをつなぐ。
+デコードされたテキストは AsyncTextStreamer がイベントループの asyncio.Queue に直接渡すため、
+読み出し側でスレッドを待機させる必要がない（同時に多数のストリームがあってもスレッドを消費しない）。
+クライアントが切断した場合は cancel_event をセットすると、次のトークンで生成を打ち切る。
+"""
+
+import asyncio
+import json
+from transformers import StoppingCriteria, StoppingCriteriaList, TextStreamer, set_seed
+
+from generation import GenerationTimer, generate_text
+
+
+class AsyncTextStreamer(TextStreamer):
+    """デコードしたテキストをイベントループの asyncio.Queue に渡すストリーマー（終了時は None を入れる）"""
+
+    def __init__(self, tokenizer, loop):
+        # skip_prompt=True で入力プロンプトを除き、生成されたテキストだけを流す
+        super().__init__(tokenizer, skip_prompt=True, skip_special_tokens=True)
+        self.loop = loop
+        self.queue = asyncio.Queue()
+
+    def on_finalized_text(self, text, stream_end=False):
+        # 推論用スレッドから呼ばれるため、キューへの追加はイベントループのスレッドで行う
+        if text:
+            self.loop.call_soon_threadsafe(self.queue.put_nowait, text)
+        if stream_end:
+            self.loop.call_soon_threadsafe(self.queue.put_nowait, None)
+
+    async def next_text(self, generation):
+        """次のテキストを待って返す（終了時は None）
+
+        generation（推論のFuture）が例外で終わった場合は、終了の None が届いていなくても待つのをやめて None を返す。
+        """
+        if not self.queue.empty():
+            return self.queue.get_nowait()
+        getter = asyncio.ensure_future(self.queue.get())
+        try:
+            await asyncio.wait({getter, generation}, return_when=asyncio.FIRST_COMPLETED)
+            if getter.done():
+                return getter.result()
+            if generation.cancelled() or generation.exception() is not None:
+                return None
+            # 正常に終わった場合、残りのテキストと終了の None はFutureの完了より先にキューに入っている
+            return await getter
+        finally:
+            getter.cancel()
+
+
+class CancelOnEvent(StoppingCriteria):
+    """イベントがセットされたら生成を止める"""
+
+    def __init__(self, event):
+        self.event = event
+
+    def __call__(self, input_ids, scores, **kwargs):
+        return self.event.is_set()
+
+
+def generate_stream(pipe, prompt, streamer, cancel_event, max_new_tokens=512, do_sample=True,
+                    temperature=0.7, top_p=0.9, seed=None):
+    """プロンプトから生成し、デコードしたテキストを streamer に流す（推論用スレッドで実行する）
+
+    Returns:
+        GenerationTimer: 段階ごとの時間とトークン数
+    """
+    generate_kwargs = {
+        "max_new_tokens": max_new_tokens,
+        "do_sample": do_sample,
+        "stopping_criteria": StoppingCriteriaList([CancelOnEvent(cancel_event)]),
+    }
+    if do_sample:
+        generate_kwargs.update(temperature=temperature, top_p=top_p)
+    if seed is not None:
+        set_seed(seed)
+    # 失敗した場合も generate_text が timer.end() から streamer.end() を呼ぶため、読み出し側は止まらない
+    timer = GenerationTimer(inner=streamer)
+    generate_text(pipe, prompt, timer, **generate_kwargs)
+    return timer
+
+
+def sse_event(data):
+    """Server-Sent Events の1イベント（dataはJSON）"""
+    return f"data: {json.dumps(data, ensure_ascii=False)}\n\n"
@@ -0,0 +1,307 @@
+"""
+結果キャッシュ
+
+このモジュールは、関数の結果（生成されたテキストなど）を保存するキャッシュを提供します。
+
+- キーは関数名・インスタンスの識別用属性（model_name など）・引数の値から作り、self 自体は含めません
+  （インスタンスが作り直されても同じ入力なら同じキーになります）
+- メモリ上のLRUを前段に置き、後段のSQLiteファイルに保存します（書き込みはトランザクションで行われるため、
+  途中で終了してもファイルが壊れません）
+- 件数と合計サイズの上限を超えた場合は、最後に使われたのが古いものから削除します
+- ヒット率などの統計は stats() で取得できます
+"""
+
+import hashlib
+import inspect
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterable, Optional
+
+from .config import (
+    MODEL_CACHE_DIR,
+    RESULT_CACHE_MAX_BYTES,
+    RESULT_CACHE_MAX_ENTRIES,
+    RESULT_CACHE_MEMORY_ENTRIES,
+)
+from .logger import get_logger
+
+logger = get_logger(__name__)
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS result_cache
+(key TEXT PRIMARY KEY,
+ value TEXT NOT NULL,
+ size INTEGER NOT NULL,
+ accessed_at REAL NOT NULL)
+'''
+INDEXES = (
+    "CREATE INDEX IF NOT EXISTS idx_result_cache_accessed_at ON result_cache (accessed_at)",
+)
+
+def make_key(namespace: str, params: Dict[str, Any]) -> str:
+    """
+    名前空間とパラメータから安定したキャッシュキーを作る
+
+    JSONのキー順を固定し、同じ内容が必ず同じ文字列になるようにしてからハッシュを取ります。
+
+    Args:
+        namespace (str): 関数名などの名前空間
+        params (Dict[str, Any]): キーに含めるパラメータ（JSONにできない値は repr で表します）
+
+    Returns:
+        str: キャッシュキー
+    """
+    payload = json.dumps(
+        {"namespace": namespace, "params": params},
+        ensure_ascii=False,
+        sort_keys=True,
+        default=repr
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+class ResultCache:
+    """
+    メモリ上のLRUとSQLiteファイルからなる2段のキャッシュ
+    """
+
+    def __init__(
+        self,
+        path: Optional[Path],
+        max_entries: int = RESULT_CACHE_MAX_ENTRIES,
+        max_bytes: int = RESULT_CACHE_MAX_BYTES,
+        memory_entries: int = RESULT_CACHE_MEMORY_ENTRIES
+    ):
+        """
+        初期化
+
+        Args:
+            path (Optional[Path]): SQLiteファイルのパス（Noneならメモリのみ）
+            max_entries (int): ファイルに保存する件数の上限
+            max_bytes (int): ファイルに保存する値の合計サイズの上限（バイト）
+            memory_entries (int): メモリに保持する件数の上限
+        """
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.memory_entries = memory_entries
+        self._memory: "OrderedDict[str, Any]" = OrderedDict()
+        # メモリでヒットしたキーの最終利用時刻（次の書き込みでまとめてファイルの accessed_at に反映する）
+        self._touched: Dict[str, float] = {}
+        self._lock = threading.Lock()
+        self._db = None
+        if path is not None:
+            self._db = sqlite3.connect(str(path), check_same_thread=False)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(SCHEMA)
+            for statement in INDEXES:
+                self._db.execute(statement)
+            self._db.commit()
+        self.hits = 0
+        self.memory_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key: str, default: Any = None) -> Any:
+        """
+        キャッシュされた値を取得する
+
+        Args:
+            key (str): キャッシュキー
+            default (Any): 見つからなかった場合に返す値
+
+        Returns:
+            Any: キャッシュされた値（なければ default）
+        """
+        with self._lock:
+            if key in self._memory:
+                self._memory.move_to_end(key)
+                self._touched[key] = time.time()
+                self.hits += 1
+                self.memory_hits += 1
+                return self._memory[key]
+
+            row = None
+            if self._db is not None:
+                row = self._db.execute("SELECT value FROM result_cache WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return default
+            self._db.execute("UPDATE result_cache SET accessed_at = ? WHERE key = ?", (time.time(), key))
+            self._db.commit()
+            value = json.loads(row[0])
+            self._remember(key, value)
+            self.hits += 1
+            return value
+
+    def put(self, key: str, value: Any) -> None:
+        """
+        値を保存する
+
+        Args:
+            key (str): キャッシュキー
+            value (Any): 保存する値（JSONにできるもの）
+        """
+        serialized = json.dumps(value, ensure_ascii=False, separators=(",", ":"))
+        with self._lock:
+            self._remember(key, value)
+            if self._db is None:
+                return
+            with self._db:
+                self._flush_touched()
+                self._db.execute(
+                    "INSERT OR REPLACE INTO result_cache (key, value, size, accessed_at) VALUES (?, ?, ?, ?)",
+                    (key, serialized, len(serialized.encode("utf-8")), time.time())
+                )
+                self._trim()
+
+    def clear(self) -> None:
+        """
+        すべての値を削除する
+        """
+        with self._lock:
+            self._memory.clear()
+            self._touched.clear()
+            if self._db is not None:
+                with self._db:
+                    self._db.execute("DELETE FROM result_cache")
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        ヒット率などの統計を取得する
+
+        Returns:
+            Dict[str, Any]: 統計情報
+        """
+        with self._lock:
+            lookups = self.hits + self.misses
+            stats = {
+                "hits": self.hits,
+                "memory_hits": self.memory_hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+                "memory_entries": len(self._memory),
+            }
+            if self._db is not None:
+                count, total = self._db.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM result_cache").fetchone()
+                stats.update(entries=count, bytes=total, max_entries=self.max_entries, max_bytes=self.max_bytes)
+            return stats
+
+    def _remember(self, key: str, value: Any) -> None:
+        self._memory[key] = value
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_entries:
+            self._memory.popitem(last=False)
+
+    def _flush_touched(self) -> None:
+        """
+        メモリでヒットしたキーの最終利用時刻をファイルに反映する（ロック・トランザクション内で呼ぶ）
+        """
+        if self._touched:
+            self._db.executemany(
+                "UPDATE result_cache SET accessed_at = ? WHERE key = ?",
+                [(accessed_at, key) for key, accessed_at in self._touched.items()]
+            )
+            self._touched.clear()
+
+    def _trim(self) -> None:
+        """
+        件数・合計サイズの上限を超えた分を、最後に使われたのが古い順に削除する（ロック・トランザクション内で呼ぶ）
+
+        メモリに載っている値は最近使われているため、それ以外をすべて削除しても上限を超える場合にだけ削除する。
+        """
+        count, total = self._db.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM result_cache").fetchone()
+        if count <= self.max_entries and total <= self.max_bytes:
+            return
+        evicted = []
+        for include_resident in (False, True):
+            for key, size in self._db.execute("SELECT key, size FROM result_cache ORDER BY accessed_at"):
+                if count <= self.max_entries and total <= self.max_bytes:
+                    break
+                if (key in self._memory) != include_resident:
+                    continue
+                evicted.append((key,))
+                count -= 1
+                total -= size
+        self._db.executemany("DELETE FROM result_cache WHERE key = ?", evicted)
+        for (key,) in evicted:
+            self._memory.pop(key, None)
+        self.evictions += len(evicted)
+
+_default_cache: Optional[ResultCache] = None
+_default_cache_lock = threading.Lock()
+
+def get_default_cache() -> ResultCache:
+    """
+    MODEL_CACHE_DIR に保存する、プロセス全体で共有するキャッシュを取得する
+
+    Returns:
+        ResultCache: 共有のキャッシュ
+    """
+    global _default_cache
+    with _default_cache_lock:
+        if _default_cache is None:
+            _default_cache = ResultCache(MODEL_CACHE_DIR / "results.sqlite3")
+        return _default_cache
+
+def cache_result(
+    func: Optional[Callable] = None,
+    *,
+    key_attrs: Iterable[str] = ("model_name",),
+    cache: Optional[ResultCache] = None
+):
+    """
+    関数の結果をキャッシュするデコレータ
+
+    キーは関数名、インスタンスの key_attrs の属性の値、引数（既定値を補った上で self を除いたもの）から作ります。
+    @cache_result のように引数なしでも、@cache_result(key_attrs=...) のように引数付きでも使えます。
+
+    Args:
+        func: キャッシュ対象の関数
+        key_attrs (Iterable[str]): キーに含めるインスタンスの属性（メソッドの場合）
+        cache (Optional[ResultCache]): 使用するキャッシュ（省略時は共有のキャッシュ）
+
+    Returns:
+        デコレートされた関数
+    """
+    def decorator(func):
+        signature = inspect.signature(func)
+        is_method = next(iter(signature.parameters), None) == "self"
+        namespace = func.__qualname__
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            bound = signature.bind(*args, **kwargs)
+            bound.apply_defaults()
+            params = dict(bound.arguments)
+            if is_method:
+                instance = params.pop("self")
+                params["self"] = {attr: getattr(instance, attr, None) for attr in key_attrs}
+            key = make_key(namespace, params)
+
+            result_cache = cache if cache is not None else get_default_cache()
+            missing = object()
+            try:
+                result = result_cache.get(key, missing)
+            except Exception as e:
+                logger.warning(f"キャッシュの読み込みに失敗しました: {e}")
+                result = missing
+            if result is not missing:
+                return result
+
+            result = func(*args, **kwargs)
+            try:
+                result_cache.put(key, result)
+            except Exception as e:
+                logger.warning(f"キャッシュの保存に失敗しました: {e}")
+            return result
+
+        return wrapper
+
+    if func is not None:
+        return decorator(func)
+    return decorator
@@ -11,6 +11,8 @@ Attributes:
     LOG_LEVEL (str): ログレベル
     MAX_RETRIES (int): API呼び出しの最大リトライ回数
     TIMEOUT (int): API呼び出しのタイムアウト時間（秒）
+    MODEL_MEMORY_BUDGET_MB (int): 読み込んだモデルを保持するメモリの上限（MB）
+    MAX_BATCH_TOKENS (int): バッチ生成で1回の generate に含めるトークン数の上限
 """
 
 import os
@@ -29,6 +31,11 @@ BASE_DIR = Path(__file__).parent.parent
 MODEL_CACHE_DIR = BASE_DIR / "cache" / "models"
 MODEL_CACHE_DIR.mkdir(parents=True, exist_ok=True)
 
+# 結果キャッシュの設定（common/cache.py）
+RESULT_CACHE_MAX_ENTRIES = int(os.getenv("RESULT_CACHE_MAX_ENTRIES", 10000))            # ファイルに保存する件数の上限
+RESULT_CACHE_MAX_BYTES = int(os.getenv("RESULT_CACHE_MAX_BYTES", 64 * 1024 * 1024))     # ファイルに保存する合計サイズの上限（バイト）
+RESULT_CACHE_MEMORY_ENTRIES = int(os.getenv("RESULT_CACHE_MEMORY_ENTRIES", 256))        # メモリに保持する件数の上限
+
 # ログ設定
 LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
 
@@ -44,6 +51,10 @@ SUPPORTED_MODELS = {
     "gpt2-large": "gpt2-large",
     "gpt2-xl": "gpt2-xl"
 }
+# 読み込んだモデルを保持するメモリの上限（MB）。超えた場合は最も長く使われていないモデルから解放する
+MODEL_MEMORY_BUDGET_MB = int(os.getenv("MODEL_MEMORY_BUDGET_MB", 8192))
+# バッチ生成で1回の generate に含めるトークン数の上限（バッチ内の件数 × 最長の系列長）
+MAX_BATCH_TOKENS = int(os.getenv("MAX_BATCH_TOKENS", 8192))
 
 # エラーメッセージ
 ERROR_MESSAGES = {
@@ -0,0 +1,56 @@
+"""
+CPU推論モード（02_streamlit_app と 03_FastAPI で共通）
+
+GPUのないノードでは bfloat16 の重みは高速なカーネルが使えないことが多いため、CPUで推論するときは
+- float32 で読み込み、任意でLinear層の重みを動的int8量子化する（重みのメモリが約1/4になり、行列積も速くなる）
+- PyTorchのスレッド数（intra-op / inter-op）を明示的に設定する
+- 任意で model.forward を torch.compile し、generate を torch.inference_mode で包む
+ことで、トークン/秒とメモリ使用量を改善する。
+
+gpt2系列のモデルは注意機構・MLPに Linear ではなく Conv1D を使っているため、量子化されるのは出力層のみになる。
+"""
+
+import torch
+
+
+def configure_threads(intra_op_threads=0, inter_op_threads=0):
+    """PyTorchのスレッド数を設定する（0なら既定値のまま）
+
+    inter-op のスレッド数は、プロセスで最初の並列処理が始まる前にしか変更できないため、
+    モデルを読み込む前（起動時）に呼ぶこと。
+    """
+    if intra_op_threads > 0:
+        torch.set_num_threads(intra_op_threads)
+    if inter_op_threads > 0:
+        try:
+            torch.set_num_interop_threads(inter_op_threads)
+        except RuntimeError as e:
+            print(f"inter-opスレッド数を変更できませんでした（既に並列処理が開始されています）: {e}")
+    print(f"PyTorchのスレッド数: intra-op={torch.get_num_threads()}, inter-op={torch.get_num_interop_threads()}")
+
+
+def cpu_model_kwargs():
+    """CPUで読み込むときの model_kwargs（量子化の有無によらずfloat32。量子化にもfloat32の重みが必要）"""
+    return {"torch_dtype": torch.float32, "low_cpu_mem_usage": True}
+
+
+def optimize_for_cpu(pipe, quantize=True, compile_model=False, inference_mode=True):
+    """読み込んだパイプラインのモデルをCPU推論向けに変換する
+
+    Args:
+        pipe: text-generation パイプライン（cpu_model_kwargs で読み込んだもの）
+        quantize: Linear層を動的int8量子化する
+        compile_model: model.forward を torch.compile する（初回の生成でコンパイル時間がかかる）
+        inference_mode: model.generate を torch.inference_mode で包み、勾配の記録を完全に止める
+    """
+    lm = pipe.model
+    lm.eval()
+    if quantize:
+        lm = torch.ao.quantization.quantize_dynamic(lm, {torch.nn.Linear}, dtype=torch.qint8)
+        pipe.model = lm
+    if compile_model:
+        # デコード中は系列長が1トークンずつ変わるため、動的な形状としてコンパイルする
+        lm.forward = torch.compile(lm.forward, dynamic=True)
+    if inference_mode:
+        lm.generate = torch.inference_mode()(lm.generate)
+    return pipe
@@ -0,0 +1,26 @@
+"""
+レイテンシの集計
+
+このモジュールは、負荷テストやバッチクライアントで計測したレイテンシを集計する関数を提供します。
+"""
+
+from typing import Sequence
+
+def percentile(values: Sequence[float], q: float) -> float:
+    """
+    線形補間によるパーセンタイルを計算する
+
+    Args:
+        values (Sequence[float]): 計測値
+        q (float): パーセンタイル（0〜100）
+
+    Returns:
+        float: パーセンタイルの値（values が空ならNaN）
+    """
+    ordered = sorted(values)
+    if not ordered:
+        return float("nan")
+    rank = (len(ordered) - 1) * q / 100
+    lower = int(rank)
+    upper = min(lower + 1, len(ordered) - 1)
+    return ordered[lower] + (ordered[upper] - ordered[lower]) * (rank - lower)
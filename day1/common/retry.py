@@ -0,0 +1,282 @@
+"""
+リトライ
+
+このモジュールは、失敗した処理をやり直すためのリトライポリシーを提供します。
+
+- 待ち時間は指数関数的に増やし、ジッター（ランダムな揺らぎ）を加えて、同時に失敗した呼び出しが
+  同じタイミングで再試行しないようにします
+- HTTPの応答に Retry-After（秒）があれば、max_delay を上限としてその時間以上待ちます
+- 全体の期限（deadline）を過ぎる場合は、それ以上再試行しません
+- 再試行するかどうかは例外を受け取る関数（retryable）で判定します。既定では接続エラー・タイムアウト・
+  一時的なHTTPステータス（429、5xxなど）だけを再試行し、入力の誤りやメモリ不足のように
+  やり直しても同じ結果になる失敗はすぐに送出します
+- 試行回数・再試行回数・所要時間などの統計を stats() で取得でき、on_attempt で試行ごとに通知を受け取れます
+
+同期関数にはデコレータまたは call()、非同期関数（HTTPクライアントなど）には acall() を使います。
+HTTPクライアントでは、レスポンスのステータスを例外にする（requests / httpx の raise_for_status()）と
+既定の判定がそのまま使えます。
+"""
+
+import asyncio
+import random
+import threading
+import time
+from functools import wraps
+from typing import Any, Callable, Dict, Optional
+
+from .logger import get_logger
+
+logger = get_logger(__name__)
+
+# 時間をおけば成功する可能性があるHTTPステータス
+RETRYABLE_STATUS_CODES = frozenset({408, 425, 429, 500, 502, 503, 504})
+
+# requests / httpx などの接続エラー・タイムアウトの例外クラス名
+# （各ライブラリをインポートせずに判定するため、クラス名で判定する）
+TRANSIENT_ERROR_NAMES = frozenset({
+    "ConnectionError", "ConnectTimeout", "ReadTimeout", "Timeout",
+    "ConnectError", "ReadError", "RemoteProtocolError", "TimeoutException", "PoolTimeout", "NetworkError",
+})
+
+def is_transient_error(error: BaseException) -> bool:
+    """
+    時間をおいて再試行すれば成功する可能性がある例外かどうかを判定する
+
+    Args:
+        error (BaseException): 発生した例外
+
+    Returns:
+        bool: 再試行すべきならTrue
+    """
+    if isinstance(error, (ConnectionError, TimeoutError)):
+        return True
+    # requests.HTTPError / httpx.HTTPStatusError はレスポンスのステータスで判定する
+    status_code = getattr(getattr(error, "response", None), "status_code", None)
+    if status_code is not None:
+        return status_code in RETRYABLE_STATUS_CODES
+    return any(cls.__name__ in TRANSIENT_ERROR_NAMES for cls in type(error).__mro__)
+
+def retry_after_seconds(error: BaseException) -> Optional[float]:
+    """
+    例外のHTTPレスポンスに Retry-After（秒数）があれば、その値を返す
+
+    Args:
+        error (BaseException): 発生した例外
+
+    Returns:
+        Optional[float]: 待つべき秒数（指定がなければNone）
+    """
+    headers = getattr(getattr(error, "response", None), "headers", None)
+    value = headers.get("Retry-After") if headers is not None else None
+    if value is not None and str(value).strip().isdigit():
+        return float(value)
+    return None
+
+class RetryPolicy:
+    """
+    指数バックオフとジッター、全体の期限を持つリトライポリシー
+    """
+
+    def __init__(
+        self,
+        name: str = "retry",
+        max_attempts: int = 3,
+        base_delay: float = 0.5,
+        max_delay: float = 10.0,
+        multiplier: float = 2.0,
+        deadline: Optional[float] = None,
+        retryable: Callable[[BaseException], bool] = is_transient_error,
+        on_attempt: Optional[Callable[[Dict[str, Any]], None]] = None
+    ):
+        """
+        初期化
+
+        Args:
+            name (str): ログと統計に使う名前
+            max_attempts (int): 最初の呼び出しを含む最大試行回数
+            base_delay (float): 最初の再試行までの待ち時間の上限（秒）
+            max_delay (float): 1回の待ち時間の上限（秒）
+            multiplier (float): 再試行のたびに待ち時間の上限を何倍にするか
+            deadline (Optional[float]): 最初の呼び出しからの全体の期限（秒、Noneなら期限なし）
+            retryable (Callable[[BaseException], bool]): 例外を受け取り、再試行すべきならTrueを返す関数
+            on_attempt (Optional[Callable[[Dict[str, Any]], None]]): 試行ごとに結果を受け取るコールバック
+        """
+        self.name = name
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.multiplier = multiplier
+        self.deadline = deadline
+        self.retryable = retryable
+        self.on_attempt = on_attempt
+        self._lock = threading.Lock()
+        self._stats = {
+            "calls": 0,
+            "attempts": 0,
+            "retries": 0,
+            "successes": 0,
+            "failures": 0,
+            "non_retryable": 0,
+            "deadline_exceeded": 0,
+            "total_latency": 0.0,
+            "max_latency": 0.0,
+        }
+
+    def __call__(self, func: Callable) -> Callable:
+        """
+        デコレータとして使う
+
+        Args:
+            func: リトライ対象の関数（同期関数・非同期関数のどちらでもよい）
+
+        Returns:
+            デコレートされた関数
+        """
+        if asyncio.iscoroutinefunction(func):
+            @wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                return await self.acall(func, *args, **kwargs)
+            return async_wrapper
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            return self.call(func, *args, **kwargs)
+        return wrapper
+
+    def backoff(self, retry_number: int) -> float:
+        """
+        再試行前の待ち時間を計算する（上限までの一様乱数を使う「フルジッター」方式）
+
+        Args:
+            retry_number (int): 何回目の再試行か（1から）
+
+        Returns:
+            float: 待ち時間（秒）
+        """
+        ceiling = min(self.max_delay, self.base_delay * self.multiplier ** (retry_number - 1))
+        return random.uniform(0, ceiling)
+
+    def call(self, func: Callable, *args, **kwargs) -> Any:
+        """
+        関数を呼び出し、失敗した場合はポリシーに従って再試行する
+
+        Args:
+            func: 呼び出す関数
+            *args, **kwargs: 関数に渡す引数
+
+        Returns:
+            Any: 関数の戻り値
+        """
+        started_at = time.monotonic()
+        attempt = 0
+        while True:
+            attempt += 1
+            try:
+                result = func(*args, **kwargs)
+            except Exception as e:
+                delay = self._on_failure(e, attempt, started_at)
+                time.sleep(delay)
+                continue
+            self._on_success(attempt, started_at)
+            return result
+
+    async def acall(self, func: Callable, *args, **kwargs) -> Any:
+        """
+        非同期関数を呼び出し、失敗した場合はポリシーに従って再試行する
+
+        Args:
+            func: 呼び出す非同期関数
+            *args, **kwargs: 関数に渡す引数
+
+        Returns:
+            Any: 関数の戻り値
+        """
+        started_at = time.monotonic()
+        attempt = 0
+        while True:
+            attempt += 1
+            try:
+                result = await func(*args, **kwargs)
+            except Exception as e:
+                delay = self._on_failure(e, attempt, started_at)
+                await asyncio.sleep(delay)
+                continue
+            self._on_success(attempt, started_at)
+            return result
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        試行回数や所要時間の統計を取得する
+
+        Returns:
+            Dict[str, Any]: 統計情報
+        """
+        with self._lock:
+            stats = dict(self._stats)
+        stats["name"] = self.name
+        stats["mean_latency"] = stats["total_latency"] / stats["calls"] if stats["calls"] else 0.0
+        stats["attempts_per_call"] = stats["attempts"] / stats["calls"] if stats["calls"] else 0.0
+        return stats
+
+    def _on_success(self, attempt: int, started_at: float) -> None:
+        self._finish(attempt, started_at, "success")
+
+    def _on_failure(self, error: Exception, attempt: int, started_at: float) -> float:
+        """
+        失敗を記録し、再試行する場合は待ち時間を返す（再試行しない場合は例外を送出する）
+        """
+        elapsed = time.monotonic() - started_at
+        if not self.retryable(error):
+            self._finish(attempt, started_at, "non_retryable", error)
+            raise error
+        if attempt >= self.max_attempts:
+            self._finish(attempt, started_at, "failure", error)
+            raise error
+        delay = self.backoff(attempt)
+        retry_after = retry_after_seconds(error)
+        if retry_after is not None:
+            # サーバーが指定した時間より早く再試行しない（ただし max_delay を上限とする）
+            delay = min(max(delay, retry_after), self.max_delay)
+        if self.deadline is not None and elapsed + delay >= self.deadline:
+            self._finish(attempt, started_at, "deadline_exceeded", error)
+            raise error
+
+        with self._lock:
+            self._stats["attempts"] += 1
+            self._stats["retries"] += 1
+        logger.warning(
+            f"{self.name}: リトライ {attempt}/{self.max_attempts - 1}（{delay:.2f}秒後）: {error}"
+        )
+        self._notify(attempt, elapsed, "retry", error)
+        return delay
+
+    def _finish(self, attempt: int, started_at: float, outcome: str, error: Exception = None) -> None:
+        """
+        呼び出し全体の結果を統計に記録する
+        """
+        latency = time.monotonic() - started_at
+        with self._lock:
+            self._stats["calls"] += 1
+            self._stats["attempts"] += 1
+            if outcome == "success":
+                self._stats["successes"] += 1
+            else:
+                self._stats["failures"] += 1
+                if outcome in ("non_retryable", "deadline_exceeded"):
+                    self._stats[outcome] += 1
+            self._stats["total_latency"] += latency
+            self._stats["max_latency"] = max(self._stats["max_latency"], latency)
+        if outcome != "success":
+            logger.error(f"{self.name}: {attempt}回目の試行で失敗しました（{outcome}）: {error}")
+        self._notify(attempt, latency, outcome, error)
+
+    def _notify(self, attempt: int, elapsed: float, outcome: str, error: Optional[Exception]) -> None:
+        if self.on_attempt is None:
+            return
+        self.on_attempt({
+            "name": self.name,
+            "attempt": attempt,
+            "elapsed": elapsed,
+            "outcome": outcome,
+            "error": repr(error) if error is not None else None,
+        })
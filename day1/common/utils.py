@@ -6,85 +6,46 @@
 """
 
 import json
-import hashlib
 from pathlib import Path
-from typing import Any, Dict, Optional
-from functools import wraps
-import time
+from typing import Any, Callable, Dict, Optional
 
-from .config import MODEL_CACHE_DIR, ERROR_MESSAGES
+from .config import ERROR_MESSAGES
 from .logger import get_logger
+from .cache import cache_result  # 互換性のため、従来どおり common.utils からもインポートできるようにする
+from .retry import RetryPolicy, is_transient_error
 
 logger = get_logger(__name__)
 
-def cache_result(func):
-    """
-    関数の結果をキャッシュするデコレータ
-
-    Args:
-        func: キャッシュ対象の関数
-
-    Returns:
-        デコレートされた関数
-    """
-    @wraps(func)
-    def wrapper(*args, **kwargs):
-        # キャッシュキーの生成
-        cache_key = hashlib.md5(
-            f"{func.__name__}{str(args)}{str(kwargs)}".encode()
-        ).hexdigest()
-        
-        cache_file = MODEL_CACHE_DIR / f"{cache_key}.json"
-        
-        # キャッシュが存在する場合は読み込み
-        if cache_file.exists():
-            try:
-                with open(cache_file, "r", encoding="utf-8") as f:
-                    return json.load(f)
-            except Exception as e:
-                logger.warning(f"キャッシュの読み込みに失敗しました: {e}")
-        
-        # 関数の実行
-        result = func(*args, **kwargs)
-        
-        # 結果をキャッシュ
-        try:
-            with open(cache_file, "w", encoding="utf-8") as f:
-                json.dump(result, f, ensure_ascii=False, indent=2)
-        except Exception as e:
-            logger.warning(f"キャッシュの保存に失敗しました: {e}")
-        
-        return result
-    
-    return wrapper
-
-def retry_on_error(max_retries: int = 3, delay: float = 1.0):
+def retry_on_error(
+    max_retries: int = 3,
+    delay: float = 1.0,
+    deadline: Optional[float] = None,
+    retryable: Callable[[BaseException], bool] = is_transient_error
+):
     """
     エラー発生時にリトライするデコレータ
 
+    待ち時間は delay から指数関数的に増やし（ジッター付き）、retryable が True を返す例外だけを再試行します。
+    細かく設定する場合や統計を参照する場合は、common.retry.RetryPolicy を直接使ってください。
+
     Args:
-        max_retries (int): 最大リトライ回数
-        delay (float): リトライ間隔（秒）
+        max_retries (int): 最大試行回数
+        delay (float): 最初の再試行までの待ち時間の上限（秒）
+        deadline (Optional[float]): 全体の期限（秒）
+        retryable (Callable[[BaseException], bool]): 再試行する例外かどうかを判定する関数
 
     Returns:
         デコレートされた関数
     """
     def decorator(func):
-        @wraps(func)
-        def wrapper(*args, **kwargs):
-            last_error = None
-            for attempt in range(max_retries):
-                try:
-                    return func(*args, **kwargs)
-                except Exception as e:
-                    last_error = e
-                    if attempt < max_retries - 1:
-                        logger.warning(
-                            f"リトライ {attempt + 1}/{max_retries}: {str(e)}"
-                        )
-                        time.sleep(delay)
-            raise last_error
-        return wrapper
+        policy = RetryPolicy(
+            name=func.__qualname__,
+            max_attempts=max_retries,
+            base_delay=delay,
+            deadline=deadline,
+            retryable=retryable
+        )
+        return policy(func)
     return decorator
 
 def format_error_message(error_type: str, **kwargs) -> str:
@@ -0,0 +1,142 @@
+# benchmark_lambda.py
+"""
+Lambdaハンドラーのコールドスタート/ウォームスタートのベンチマーク
+
+API Gatewayと同じ形式の合成イベントで lambda/index.py の lambda_handler を呼び出し、
+- 初期化（モジュールの読み込み）にかかる時間
+- 初回の呼び出し（コールドスタート直後。遅延読み込みするモジュールや最初の接続を含む）
+- 2回目以降の呼び出し（ウォームスタート）
+を計測する。コールドスタートを再現するため、計測は毎回新しいPythonプロセスで行う。
+上流のFastAPIの代わりにローカルのスタブサーバーを起動するため、ネットワークや推論の時間は含まれない。
+
+計測する呼び出し:
+    invalid : メッセージがなく、上流に接続せずに400を返す（ハンドラー自体のオーバーヘッド）
+    full    : プロンプトを組み立ててスタブサーバーにPOSTし、200を返す
+
+使い方:
+    python benchmark_lambda.py --cold-runs 10 --warm-invokes 200
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+LAMBDA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'lambda')
+
+
+class StubFastAPIHandler(BaseHTTPRequestHandler):
+    """すぐに固定の応答を返す /generate のスタブ"""
+
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True  # ヘッダーと本文を別々に送るため、遅延ACKで待たされないようにする
+    body = json.dumps({'generated_text': 'こんにちは。ご用件をどうぞ。'}).encode('utf-8')
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers['Content-Length']))
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(self.body)))
+        self.end_headers()
+        self.wfile.write(self.body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def make_event(message, history_turns=4):
+    """API Gatewayのプロキシ統合と同じ形式のイベント"""
+    history = []
+    for i in range(history_turns):
+        history.append({'role': 'user', 'content': f'{i}番目の質問です。'})
+        history.append({'role': 'assistant', 'content': f'{i}番目の回答です。'})
+    return {
+        'resource': '/chat',
+        'path': '/chat',
+        'httpMethod': 'POST',
+        'headers': {'Content-Type': 'application/json', 'Authorization': 'dummy-token'},
+        'requestContext': {'resourcePath': '/chat', 'httpMethod': 'POST', 'stage': 'prod'},
+        'body': json.dumps({'message': message, 'conversationHistory': history}),
+        'isBase64Encoded': False,
+    }
+
+
+class FakeContext:
+    """Lambdaコンテキストの代わり（残り時間は常に30秒）"""
+
+    function_name = 'benchmark'
+    invoked_function_arn = 'arn:aws:lambda:us-east-1:123456789012:function:benchmark'
+
+    def get_remaining_time_in_millis(self):
+        return 30000
+
+
+def run_child(kind, warm_invokes):
+    """新しいプロセスの中で、初期化・初回・2回目以降の呼び出しを計測する"""
+    # 標準出力は結果のJSONに使うため、ハンドラーのログは捨てる
+    log_sink = open(os.devnull, 'w')
+    real_stdout = sys.stdout
+    sys.stdout = log_sink
+
+    started_at = time.perf_counter()
+    sys.path.insert(0, LAMBDA_DIR)
+    import index
+    init_time = time.perf_counter() - started_at
+
+    event = make_event('' if kind == 'invalid' else 'こんにちは')
+    context = FakeContext()
+    expected_status = 400 if kind == 'invalid' else 200
+
+    started_at = time.perf_counter()
+    result = index.lambda_handler(event, context)
+    first_invoke = time.perf_counter() - started_at
+    assert result['statusCode'] == expected_status, result
+
+    warm = []
+    for _ in range(warm_invokes):
+        started_at = time.perf_counter()
+        index.lambda_handler(event, context)
+        warm.append(time.perf_counter() - started_at)
+
+    sys.stdout = real_stdout
+    print(json.dumps({'init': init_time, 'first_invoke': first_invoke, 'warm': warm}))
+
+
+def run_benchmark(cold_runs, warm_invokes):
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StubFastAPIHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    env = dict(os.environ, FASTAPI_URL=f"http://127.0.0.1:{server.server_port}/generate")
+
+    print(f"{'invoke':<8} {'init p50':>9} {'init max':>9} {'1st p50':>9} {'warm p50':>10} {'warm p95':>10}")
+    for kind in ('invalid', 'full'):
+        results = []
+        for _ in range(cold_runs):
+            completed = subprocess.run(
+                [sys.executable, __file__, '--child', kind, '--warm-invokes', str(warm_invokes)],
+                capture_output=True, text=True, env=env, check=True,
+            )
+            results.append(json.loads(completed.stdout.strip().splitlines()[-1]))
+        inits = [r['init'] * 1000 for r in results]
+        firsts = [r['first_invoke'] * 1000 for r in results]
+        warm = [t * 1000 for r in results for t in r['warm']]
+        quantiles = statistics.quantiles(warm, n=100, method='inclusive')  # [49] が p50、[94] が p95
+        print(f"{kind:<8} {statistics.median(inits):>7.2f}ms {max(inits):>7.2f}ms "
+              f"{statistics.median(firsts):>7.2f}ms {quantiles[49]:>8.3f}ms {quantiles[94]:>8.3f}ms")
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Lambdaハンドラーのコールドスタート/ウォームスタートのベンチマーク')
+    parser.add_argument('--cold-runs', type=int, default=10, help='コールドスタートを計測する回数（プロセス数）')
+    parser.add_argument('--warm-invokes', type=int, default=200, help='1プロセスあたりのウォームスタートの呼び出し回数')
+    parser.add_argument('--child', choices=['invalid', 'full'], help=argparse.SUPPRESS)  # 子プロセス用
+    args = parser.parse_args()
+
+    if args.child:
+        run_child(args.child, args.warm_invokes)
+    else:
+        run_benchmark(args.cold_runs, args.warm_invokes)
@@ -30,6 +30,9 @@ const loadConfig = () => {
 // 設定を取得
 const config = loadConfig();
 
+// APIに送る会話履歴の最大件数（Lambda側でもプロンプトの文字数と返す履歴の件数を制限している）
+const MAX_HISTORY_MESSAGES = 20;
+
 // Amplify設定
 Amplify.configure({
   Auth: {
@@ -74,7 +77,8 @@ function ChatInterface({ signOut, user }) {
 
       const response = await axios.post(config.apiEndpoint, {
         message: userMessage,
-        conversationHistory: messages
+        // リクエストのサイズが会話の長さに比例して増えないよう、直近の履歴だけを送る
+        conversationHistory: messages.slice(-MAX_HISTORY_MESSAGES)
       }, {
         headers: {
           'Authorization': idToken,
@@ -5,19 +5,29 @@ FastAPIで実装した推論APIに接続して推論を行う
 
 主な機能:
 - API Gatewayからのリクエストを受け取り、FastAPIエンドポイントに転送
-- 会話履歴の管理と更新
+  （接続はモジュールレベルのプールで保持し、ウォームスタート時はTCP/TLSのハンドシェイクを省略する）
+- 会話履歴の管理と更新（文字数の上限内で直近の履歴からプロンプトを組み立て、返す履歴の件数も制限する）
 - エラーハンドリングと適切なレスポンスの返却
 
 制限事項:
 - リクエストボディには'message'と'conversationHistory'が必要
 - FastAPIエンドポイントのURLは環境変数で設定可能
+
+コールドスタートを短くするため、設定・正規表現・ヘッダー・固定のエラー応答はモジュールの読み込み時に
+一度だけ用意し、上流への接続にしか使わないモジュール（http.client とそれが読み込む ssl など）は
+最初に必要になった時点で読み込む。
 """
 
+import functools
 import json
-import urllib.request
-import urllib.parse
+import time
 import re
 import os
+from types import MappingProxyType
+
+
+# ARN 形式: arn:aws:lambda:region:account-id:function:function-name
+ARN_REGION_PATTERN = re.compile(r'arn:aws:lambda:([^:]+):')
 
 
 def extract_region_from_arn(arn):
@@ -30,8 +40,7 @@ def extract_region_from_arn(arn):
     Returns:
         str: リージョン名（デフォルト: us-east-1）
     """
-    # ARN 形式: arn:aws:lambda:region:account-id:function:function-name
-    match = re.search('arn:aws:lambda:([^:]+):', arn)
+    match = ARN_REGION_PATTERN.search(arn)
     if match:
         return match.group(1)
     return "us-east-1"  # デフォルト値
@@ -41,6 +50,395 @@ def extract_region_from_arn(arn):
 FASTAPI_URL = os.environ.get('FASTAPI_URL', 'https://f515-34-145-165-103.ngrok-free.app/generate')
 
 
+# ストリーミング版のハンドラーが使う、Server-Sent Eventsで応答を返すエンドポイント
+FASTAPI_STREAM_URL = os.environ.get('FASTAPI_STREAM_URL', FASTAPI_URL.rstrip('/') + '/stream')
+
+# 生成のパラメータ（プロンプト以外）
+GENERATION_PARAMS = {
+    "max_new_tokens": 512,
+    "do_sample": True,
+    "temperature": 0.7,
+    "top_p": 0.9
+}
+
+# プロンプトの文字数の上限（日本語ではおおよそトークン数に相当する）。超える分は古い会話から省略する
+PROMPT_MAX_CHARS = int(os.environ.get('PROMPT_MAX_CHARS', '6000'))
+# プロンプトに含める履歴のメッセージ1件あたりの最大文字数（超えた分は省略する）
+HISTORY_MESSAGE_MAX_CHARS = int(os.environ.get('HISTORY_MESSAGE_MAX_CHARS', '1000'))
+# 応答で返す会話履歴の最大件数（直近のものを残す）
+RESPONSE_HISTORY_MAX_MESSAGES = int(os.environ.get('RESPONSE_HISTORY_MAX_MESSAGES', '20'))
+ROLE_LABELS = {'user': 'ユーザー', 'assistant': 'アシスタント'}
+OMITTED_HISTORY_NOTE = '（これより前の会話は省略されています）\n'
+# モデルが次のユーザーの発言まで続けて生成した場合に、応答を打ち切る位置
+NEXT_TURN_MARKER = f"\n{ROLE_LABELS['user']}:"
+# 新しいメッセージの最大文字数（超える場合は400を返す）。ラベルと省略の注記を含めてもプロンプトの上限に収まるようにする
+MESSAGE_MAX_CHARS = min(
+    int(os.environ.get('MESSAGE_MAX_CHARS', '4000')),
+    PROMPT_MAX_CHARS - len(f"{ROLE_LABELS['user']}: \n{ROLE_LABELS['assistant']}: ") - len(OMITTED_HISTORY_NOTE),
+)
+
+# 応答ヘッダー（すべての応答で共通のため、読み込み時に一度だけ作る）
+CORS_HEADERS = MappingProxyType({
+    "Access-Control-Allow-Origin": "*",
+    "Access-Control-Allow-Headers": (
+        "Content-Type,X-Amz-Date,Authorization,"
+        "X-Api-Key,X-Amz-Security-Token"
+    ),
+    "Access-Control-Allow-Methods": "OPTIONS,POST"
+})
+JSON_HEADERS = MappingProxyType({"Content-Type": "application/json", **CORS_HEADERS})
+
+# 入力の誤りなど、内容が変わらないエラー応答の本文（シリアライズ済み）
+ERROR_MESSAGES = MappingProxyType({
+    'missing_message': 'メッセージが指定されていません',
+    'invalid_json': 'リクエストボディのJSON形式が不正です',
+    'message_too_long': f'メッセージが長すぎます（{MESSAGE_MAX_CHARS}文字まで）',
+})
+ERROR_BODIES = MappingProxyType({
+    key: json.dumps({'success': False, 'error': message}) for key, message in ERROR_MESSAGES.items()
+})
+
+# 接続のタイムアウト（秒）。読み込みのタイムアウトはLambdaの残り時間から決める
+CONNECT_TIMEOUT = float(os.environ.get('FASTAPI_CONNECT_TIMEOUT', '3'))
+# 応答を返すために残しておく時間（秒）
+TIMEOUT_MARGIN = float(os.environ.get('FASTAPI_TIMEOUT_MARGIN', '1'))
+# 接続エラー時の最大試行回数と、最初の再試行までの待ち時間（秒）
+MAX_ATTEMPTS = int(os.environ.get('FASTAPI_MAX_ATTEMPTS', '3'))
+RETRY_BASE_DELAY = float(os.environ.get('FASTAPI_RETRY_BASE_DELAY', '0.2'))
+# contextがない場合（ローカル実行など）の全体の時間（秒）
+DEFAULT_TIME_BUDGET = 30.0
+
+
+class UpstreamError(Exception):
+    """
+    FastAPIエンドポイントへのリクエストの失敗（codeはクライアントに返すステータスコード）
+    """
+
+    def __init__(self, code, message):
+        super().__init__(message)
+        self.code = code
+
+
+class ConnectionPool:
+    """
+    ホストごとにHTTP(S)接続を保持し、ウォームスタートの呼び出しで再利用する接続プール
+
+    Lambdaの実行環境は1度に1つのリクエストしか処理しないため、ホストごとに少数の接続を保持すれば十分。
+    """
+
+    def __init__(self, max_idle_per_host=2):
+        self.max_idle_per_host = max_idle_per_host
+        self._idle = {}
+
+    def acquire(self, scheme, host, port, connect_timeout):
+        """
+        接続を取り出す（保持している接続がなければ新しく接続する）
+
+        Returns:
+            tuple: (接続, 再利用したか, ハンドシェイクにかかった時間（秒）)
+        """
+        key = (scheme, host, port)
+        idle = self._idle.get(key)
+        if idle:
+            return idle.pop(), True, 0.0
+
+        import http.client  # ssl の読み込みを含むため、最初の接続まで遅らせる
+        connection_class = http.client.HTTPSConnection if scheme == 'https' else http.client.HTTPConnection
+        conn = connection_class(host, port, timeout=connect_timeout)
+        started_at = time.perf_counter()
+        conn.connect()  # TCP接続とTLSハンドシェイク
+        return conn, False, time.perf_counter() - started_at
+
+    def release(self, scheme, host, port, conn):
+        """
+        使い終わった接続を返す（サーバーが接続を閉じる場合や、保持数の上限を超える場合は閉じる）
+        """
+        idle = self._idle.setdefault((scheme, host, port), [])
+        if len(idle) < self.max_idle_per_host:
+            idle.append(conn)
+        else:
+            conn.close()
+
+
+# ウォームスタートの呼び出しで再利用するため、モジュールレベルで保持する
+connection_pool = ConnectionPool()
+
+
+def remaining_seconds(context):
+    """
+    Lambdaの残り時間（秒）から、応答を返すための余裕を引いた時間
+    """
+    if context is not None and hasattr(context, 'get_remaining_time_in_millis'):
+        return context.get_remaining_time_in_millis() / 1000 - TIMEOUT_MARGIN
+    return DEFAULT_TIME_BUDGET - TIMEOUT_MARGIN
+
+
+def retry_delay(attempt, context, error):
+    """
+    接続エラー後、再試行までの待ち時間（秒）を返す（指数バックオフ + ジッター）
+
+    Raises:
+        UpstreamError: 試行回数の上限に達した、または再試行する時間が残っていない
+    """
+    import random
+    delay = random.uniform(0, RETRY_BASE_DELAY * 2 ** (attempt - 1))
+    if attempt >= MAX_ATTEMPTS or remaining_seconds(context) <= delay:
+        raise UpstreamError(502, f"FastAPIエンドポイントに接続できませんでした: {error}")
+    print(f"FastAPIエンドポイントへの接続に失敗しました（{attempt}/{MAX_ATTEMPTS}回目、{delay:.2f}秒後に再試行）: {error!r}")
+    return delay
+
+
+# 上流へのリクエストヘッダー
+REQUEST_HEADERS = MappingProxyType({'Content-Type': 'application/json', 'Connection': 'keep-alive'})
+
+
+@functools.lru_cache(maxsize=8)
+def parse_target(url):
+    """
+    URLを (スキーム, ホスト, ポート, パス) に分解する（URLは設定で決まるため、結果を再利用する）
+    """
+    import urllib.parse
+    parsed = urllib.parse.urlsplit(url)
+    scheme = parsed.scheme or 'http'
+    port = parsed.port or (443 if scheme == 'https' else 80)
+    path = parsed.path or '/'
+    if parsed.query:
+        path += '?' + parsed.query
+    return scheme, parsed.hostname, port, path
+
+
+def send_request(url, payload, context):
+    """
+    JSONをPOSTし、応答のヘッダーまでを受け取る（本文は呼び出し側で読む）
+
+    - 接続は connection_pool から取り出す。本文を読み終えたら finish_request で戻す
+    - 接続のタイムアウトは CONNECT_TIMEOUT、読み込みのタイムアウトはLambdaの残り時間
+    - 接続エラー（再利用した接続が切れていた場合を含む）は、残り時間の範囲で指数バックオフして再試行する
+    - 応答の待ち時間がタイムアウトした場合は、推論が終わっていない可能性が高いため再試行しない
+
+    Returns:
+        tuple: (接続, 応答, 接続とログの情報の辞書)
+
+    Raises:
+        UpstreamError: 接続・応答の待ち時間がタイムアウトした、または接続できなかった
+    """
+    import http.client
+    scheme, host, port, path = parse_target(url)
+    body = json.dumps(payload).encode('utf-8')
+
+    attempt = 0
+    while True:
+        attempt += 1
+        budget = remaining_seconds(context)
+        if budget <= 0:
+            raise UpstreamError(504, 'FastAPIエンドポイントへのリクエストに使える時間が残っていません')
+
+        try:
+            conn, reused, handshake_time = connection_pool.acquire(
+                scheme, host, port, min(CONNECT_TIMEOUT, budget)
+            )
+        except (OSError, http.client.HTTPException) as e:
+            time.sleep(retry_delay(attempt, context, e))
+            continue
+
+        try:
+            # 接続後は、残り時間を応答の待ち時間の上限にする
+            conn.sock.settimeout(max(remaining_seconds(context), 0.001))
+            started_at = time.perf_counter()
+            conn.request('POST', path, body=body, headers=REQUEST_HEADERS)
+            response = conn.getresponse()
+        except TimeoutError:  # Python 3.10以降は socket.timeout と同じ
+            conn.close()
+            raise UpstreamError(504, 'FastAPIエンドポイントの応答がタイムアウトしました')
+        except (OSError, http.client.HTTPException) as e:
+            conn.close()
+            if reused:
+                # 保持していた接続がサーバー側で閉じられていた場合は、待たずに新しい接続でやり直す
+                print(f"再利用した接続が切断されていたため、再接続します: {e!r}")
+            else:
+                time.sleep(retry_delay(attempt, context, e))
+            continue
+
+        return conn, response, {
+            'pool_key': (scheme, host, port),
+            'attempt': attempt,
+            'connection_reused': reused,
+            'handshake_time': handshake_time,
+            'started_at': started_at,
+        }
+
+
+def finish_request(conn, response, info):
+    """
+    本文を読み終えた接続をプールに戻し、ハンドシェイク時間と上流のレイテンシをログに出力する
+    """
+    print(json.dumps({
+        'event': 'upstream_call',
+        'status': response.status,
+        'attempt': info['attempt'],
+        'connection_reused': info['connection_reused'],
+        'handshake_ms': round(info['handshake_time'] * 1000, 1),
+        'upstream_latency_ms': round((time.perf_counter() - info['started_at']) * 1000, 1),
+    }))
+    if response.will_close:
+        conn.close()
+    else:
+        connection_pool.release(*info['pool_key'], conn)
+
+
+def check_status(response):
+    """
+    エラーのステータスが返された場合は UpstreamError を送出する
+    """
+    if response.status >= 400:
+        raise UpstreamError(
+            response.status,
+            f"FastAPIエンドポイントへのリクエストに失敗しました: HTTP {response.status} {response.reason}"
+        )
+
+
+def post_json(url, payload, context):
+    """
+    JSONをPOSTし、応答のJSONを返す
+
+    Raises:
+        UpstreamError: エラーのステータスが返された、または接続・応答の待ち時間がタイムアウトした
+    """
+    import http.client
+    conn, response, info = send_request(url, payload, context)
+    try:
+        response_body = response.read()
+    except (OSError, http.client.HTTPException) as e:
+        conn.close()
+        if isinstance(e, TimeoutError):
+            raise UpstreamError(504, 'FastAPIエンドポイントの応答がタイムアウトしました')
+        raise UpstreamError(502, f"FastAPIエンドポイントの応答を読み込めませんでした: {e}")
+    finish_request(conn, response, info)
+    check_status(response)
+    return json.loads(response_body.decode('utf-8'))
+
+
+def iter_sse_events(url, payload, context):
+    """
+    JSONをPOSTし、Server-Sent Eventsの応答をイベント（dataのJSON）ごとに順次返すジェネレーター
+
+    1行ずつ読み込むため、上流が送ったトークンはすぐに呼び出し側に渡る。
+
+    Raises:
+        UpstreamError: エラーのステータスが返された、または接続・応答の待ち時間がタイムアウトした
+    """
+    import http.client
+    conn, response, info = send_request(url, payload, context)
+    if response.status >= 400:
+        response.read()
+        finish_request(conn, response, info)
+        check_status(response)
+
+    data_lines = []
+    try:
+        while True:
+            # 1行ごとに、Lambdaの残り時間を読み込みのタイムアウトにする
+            conn.sock.settimeout(max(remaining_seconds(context), 0.001))
+            line = response.readline()
+            if not line:
+                break
+            line = line.decode('utf-8').rstrip('\r\n')
+            if line.startswith('data:'):
+                data_lines.append(line[5:].lstrip())
+            elif not line and data_lines:
+                # 空行でイベントが終わる
+                yield json.loads('\n'.join(data_lines))
+                data_lines = []
+    except (OSError, http.client.HTTPException) as e:
+        conn.close()
+        if isinstance(e, TimeoutError):
+            raise UpstreamError(504, 'FastAPIエンドポイントの応答がタイムアウトしました')
+        raise UpstreamError(502, f"FastAPIエンドポイントの応答を読み込めませんでした: {e}")
+    except GeneratorExit:
+        # 呼び出し側が途中で読むのをやめた場合、読み残しのある接続は再利用できない
+        conn.close()
+        raise
+    finish_request(conn, response, info)
+
+
+def normalize_history(conversation_history):
+    """
+    会話履歴から不正な項目を除き、各メッセージを HISTORY_MESSAGE_MAX_CHARS 文字までに切り詰める
+
+    Returns:
+        list: {"role", "content"} だけを持つ辞書のリスト（古い順）
+    """
+    history = []
+    for item in conversation_history:
+        if not (isinstance(item, dict) and item.get('role') in ROLE_LABELS and item.get('content')):
+            continue
+        content = str(item['content']).strip()
+        if len(content) > HISTORY_MESSAGE_MAX_CHARS:
+            content = content[:HISTORY_MESSAGE_MAX_CHARS] + '…'
+        history.append({'role': item['role'], 'content': content})
+    return history
+
+
+def build_prompt(message, conversation_history):
+    """
+    会話履歴と新しいメッセージからプロンプトを組み立てる
+
+    新しいメッセージは必ず含め、残りの文字数に収まる範囲で直近の履歴から順に含める。
+    メッセージが MESSAGE_MAX_CHARS 以下であれば、プロンプトは PROMPT_MAX_CHARS 以下になる（超えるメッセージは呼び出し側で400にする）。
+    収まらない古い履歴はユーザーの発言とアシスタントの応答の組（ターン）単位で省略する。
+
+    Args:
+        message (str): 新しいユーザーのメッセージ
+        conversation_history (list): {"role", "content"} の辞書のリスト（古い順）
+
+    Returns:
+        tuple: (プロンプト, プロンプトに含めた履歴の件数, 省略した履歴の件数)
+    """
+    history = normalize_history(conversation_history)
+    tail = f"{ROLE_LABELS['user']}: {message}\n{ROLE_LABELS['assistant']}: "
+    budget = PROMPT_MAX_CHARS - len(tail) - len(OMITTED_HISTORY_NOTE)
+
+    lines = []
+    for item in reversed(history):
+        line = f"{ROLE_LABELS[item['role']]}: {item['content']}\n"
+        if len(line) > budget:
+            break
+        lines.append((item['role'], line))
+        budget -= len(line)
+    # 途中のターンから始まらないよう、先頭がアシスタントの応答なら省略する
+    while lines and lines[-1][0] != 'user':
+        lines.pop()
+
+    omitted = len(history) - len(lines)
+    prompt = (OMITTED_HISTORY_NOTE if omitted else '') + ''.join(line for _, line in reversed(lines)) + tail
+    return prompt, len(lines), omitted
+
+
+def append_turn(conversation_history, message, assistant_response):
+    """
+    会話履歴にユーザーのメッセージとアシスタントの応答を追加する
+
+    応答の大きさが上限を持つよう、プロンプトと同じく不正な項目を除いて各メッセージを切り詰め、
+    直近の RESPONSE_HISTORY_MAX_MESSAGES 件までを返す。
+    """
+    messages = conversation_history[-RESPONSE_HISTORY_MAX_MESSAGES:] + [
+        {"role": "user", "content": message},
+        {"role": "assistant", "content": assistant_response},
+    ]
+    return normalize_history(messages)[-RESPONSE_HISTORY_MAX_MESSAGES:]
+
+
+def json_response(status_code, body):
+    """
+    API Gatewayのレスポンス形式の応答（bodyはシリアライズ済みのJSON文字列）
+    """
+    return {
+        'statusCode': status_code,
+        'headers': dict(JSON_HEADERS),
+        'body': body
+    }
+
+
 def lambda_handler(event, context):
     """
     Lambda関数のハンドラー
@@ -58,129 +456,175 @@ def lambda_handler(event, context):
         body = json.loads(event['body'])
         message = body.get('message', '')
         conversation_history = body.get('conversationHistory', [])
+        if not isinstance(conversation_history, list):
+            conversation_history = []
         
         if not message:
-            return {
-                'statusCode': 400,
-                'headers': {
-                    "Content-Type": "application/json",
-                    "Access-Control-Allow-Origin": "*",
-                    "Access-Control-Allow-Headers": (
-                        "Content-Type,X-Amz-Date,Authorization,"
-                        "X-Api-Key,X-Amz-Security-Token"
-                    ),
-                    "Access-Control-Allow-Methods": "OPTIONS,POST"
-                },
-                'body': json.dumps({
-                    'success': False,
-                    'error': 'メッセージが指定されていません'
-                })
-            }
+            return json_response(400, ERROR_BODIES['missing_message'])
+        if len(message) > MESSAGE_MAX_CHARS:
+            return json_response(400, ERROR_BODIES['message_too_long'])
         
-        # リクエストデータの準備
-        request_data = {
-            "prompt": message,
-            "max_new_tokens": 512,
-            "do_sample": True,
-            "temperature": 0.7,
-            "top_p": 0.9
-        }
+        # 会話履歴を含めたプロンプトの組み立て（文字数の上限を超える古い会話は省略）
+        prompt, history_used, history_omitted = build_prompt(message, conversation_history)
+        print(json.dumps({
+            'event': 'prompt_built',
+            'prompt_chars': len(prompt),
+            'history_messages': history_used,
+            'history_omitted': history_omitted,
+        }))
         
-        # リクエストの送信
-        req = urllib.request.Request(
-            FASTAPI_URL,
-            data=json.dumps(request_data).encode('utf-8'),
-            headers={'Content-Type': 'application/json'},
-            method='POST'
-        )
+        # リクエストデータの準備
+        request_data = {"prompt": prompt, **GENERATION_PARAMS}
         
+        # リクエストの送信（接続はプールから再利用し、タイムアウトはLambdaの残り時間から決める）
         try:
-            with urllib.request.urlopen(req) as response:
-                response_data = json.loads(response.read().decode('utf-8'))
-                
-                # アシスタントの応答を会話履歴に追加
-                messages = conversation_history.copy()
-                messages.append({
-                    "role": "user",
-                    "content": message
-                })
-                messages.append({
-                    "role": "assistant",
-                    "content": response_data['generated_text']
-                })
-                
-                return {
-                    'statusCode': 200,
-                    'headers': {
-                        "Content-Type": "application/json",
-                        "Access-Control-Allow-Origin": "*",
-                        "Access-Control-Allow-Headers": (
-                            "Content-Type,X-Amz-Date,Authorization,"
-                            "X-Api-Key,X-Amz-Security-Token"
-                        ),
-                        "Access-Control-Allow-Methods": "OPTIONS,POST"
-                    },
-                    'body': json.dumps({
-                        'success': True,
-                        'response': response_data['generated_text'],
-                        'conversationHistory': messages
-                    })
-                }
-                
-        except urllib.error.HTTPError as e:
-            error_message = f"FastAPIエンドポイントへのリクエストに失敗しました: {str(e)}"
+            response_data = post_json(FASTAPI_URL, request_data, context)
+            # モデルが次のユーザーの発言まで続けて生成した場合は、その手前までを応答とする
+            assistant_response = response_data['generated_text'].split(NEXT_TURN_MARKER, 1)[0].strip()
+            # アシスタントの応答を会話履歴に追加（返す履歴は直近の RESPONSE_HISTORY_MAX_MESSAGES 件まで）
+            messages = append_turn(conversation_history, message, assistant_response)
+            
+            return json_response(200, json.dumps({
+                'success': True,
+                'response': assistant_response,
+                'conversationHistory': messages
+            }))
+            
+        except UpstreamError as e:
+            error_message = str(e)
             print(error_message)
-            return {
-                'statusCode': e.code,
-                'headers': {
-                    "Content-Type": "application/json",
-                    "Access-Control-Allow-Origin": "*",
-                    "Access-Control-Allow-Headers": (
-                        "Content-Type,X-Amz-Date,Authorization,"
-                        "X-Api-Key,X-Amz-Security-Token"
-                    ),
-                    "Access-Control-Allow-Methods": "OPTIONS,POST"
-                },
-                'body': json.dumps({
-                    'success': False,
-                    'error': error_message
-                })
-            }
+            return json_response(e.code, json.dumps({
+                'success': False,
+                'error': error_message
+            }))
             
     except json.JSONDecodeError:
-        return {
-            'statusCode': 400,
-            'headers': {
-                "Content-Type": "application/json",
-                "Access-Control-Allow-Origin": "*",
-                "Access-Control-Allow-Headers": (
-                    "Content-Type,X-Amz-Date,Authorization,"
-                    "X-Api-Key,X-Amz-Security-Token"
-                ),
-                "Access-Control-Allow-Methods": "OPTIONS,POST"
-            },
-            'body': json.dumps({
-                'success': False,
-                'error': 'リクエストボディのJSON形式が不正です'
-            })
-        }
+        return json_response(400, ERROR_BODIES['invalid_json'])
             
     except Exception as error:
         print("Error:", str(error))
         
-        return {
-            'statusCode': 500,
-            'headers': {
-                "Content-Type": "application/json",
-                "Access-Control-Allow-Origin": "*",
-                "Access-Control-Allow-Headers": (
-                    "Content-Type,X-Amz-Date,Authorization,"
-                    "X-Api-Key,X-Amz-Security-Token"
-                ),
-                "Access-Control-Allow-Methods": "OPTIONS,POST"
-            },
-            'body': json.dumps({
-                'success': False,
-                'error': str(error)
-            })
-        }
+        return json_response(500, json.dumps({
+            'success': False,
+            'error': str(error)
+        }))
+
+
+def sse_event(data):
+    """
+    Server-Sent Events の1イベント（dataはJSON）
+    """
+    return f"data: {json.dumps(data, ensure_ascii=False)}\n\n".encode('utf-8')
+
+
+# ストリーミング版のハンドラーの応答ヘッダーと、固定のエラーイベント（エンコード済み）
+STREAM_HEADERS = MappingProxyType({
+    "Content-Type": "text/event-stream; charset=utf-8",
+    "Cache-Control": "no-cache",
+    **CORS_HEADERS
+})
+ERROR_EVENTS = MappingProxyType({
+    key: sse_event({'success': False, 'error': message}) for key, message in ERROR_MESSAGES.items()
+})
+
+
+def relay_stream(message, conversation_history, prompt, context):
+    """
+    上流の /generate/stream のトークンを届いた順にSSEのイベントとして返すジェネレーター
+
+    最後のイベントには、応答全体と更新した会話履歴を含める（done: true）。
+    モデルが次のユーザーの発言まで続けて生成した場合は、その手前で打ち切る。
+    マーカーが複数のトークンにまたがる場合に備え、マーカーの先頭と一致する末尾は次のトークンまで保留する。
+    """
+    started_at = time.perf_counter()
+    first_token_time = None
+    sent = []
+    pending = ''
+    events = iter_sse_events(FASTAPI_STREAM_URL, {"prompt": prompt, **GENERATION_PARAMS}, context)
+    try:
+        for data in events:
+            if 'error' in data:
+                yield sse_event({'success': False, 'error': data['error']})
+                return
+            if 'text' not in data:
+                continue
+            pending += data['text']
+            marker_index = pending.find(NEXT_TURN_MARKER)
+            if marker_index != -1:
+                pending = pending[:marker_index]
+                break
+            hold = next(
+                (k for k in range(min(len(NEXT_TURN_MARKER) - 1, len(pending)), 0, -1)
+                 if pending.endswith(NEXT_TURN_MARKER[:k])),
+                0
+            )
+            text, pending = pending[:len(pending) - hold], pending[len(pending) - hold:]
+            if text:
+                if first_token_time is None:
+                    first_token_time = time.perf_counter() - started_at
+                sent.append(text)
+                yield sse_event({'text': text})
+    except UpstreamError as e:
+        print(str(e))
+        yield sse_event({'success': False, 'error': str(e)})
+        return
+    finally:
+        # 打ち切った場合は上流の接続を閉じ、生成を止めさせる
+        events.close()
+
+    if pending:
+        sent.append(pending)
+        yield sse_event({'text': pending})
+    assistant_response = ''.join(sent).strip()
+    print(json.dumps({
+        'event': 'stream_completed',
+        'first_token_ms': round(first_token_time * 1000, 1) if first_token_time is not None else None,
+        'total_ms': round((time.perf_counter() - started_at) * 1000, 1),
+    }))
+    yield sse_event({
+        'done': True,
+        'success': True,
+        'response': assistant_response,
+        'conversationHistory': append_turn(conversation_history, message, assistant_response)
+    })
+
+
+def stream_handler(event, context):
+    """
+    ストリーミング版のハンドラー
+    FastAPIの /generate/stream に接続し、生成されたトークンを届いた順に返す
+
+    PythonのLambdaはレスポンスストリーミングに直接対応していないため、Lambda Web Adapter などで
+    HTTPサーバー（stream_server.py）として動かし、関数URL（InvokeMode: RESPONSE_STREAM）から呼び出す。
+    API Gateway から呼び出す通常のハンドラーは、これまでどおり lambda_handler を使う。
+
+    Args:
+        event (dict): 'body' にリクエストボディ（JSON文字列）を含むイベント
+        context (object): Lambdaコンテキスト（残り時間が分からない場合はNone）
+
+    Returns:
+        dict: statusCode, headers と、SSEのイベント（bytes）を順に返す body のイテレーター
+    """
+    try:
+        body = json.loads(event['body'])
+    except (json.JSONDecodeError, KeyError, TypeError):
+        return {'statusCode': 400, 'headers': STREAM_HEADERS, 'body': iter([ERROR_EVENTS['invalid_json']])}
+
+    message = body.get('message', '')
+    conversation_history = body.get('conversationHistory', [])
+    if not isinstance(conversation_history, list):
+        conversation_history = []
+    if not message:
+        return {'statusCode': 400, 'headers': STREAM_HEADERS, 'body': iter([ERROR_EVENTS['missing_message']])}
+    if len(message) > MESSAGE_MAX_CHARS:
+        return {'statusCode': 400, 'headers': STREAM_HEADERS, 'body': iter([ERROR_EVENTS['message_too_long']])}
+
+    prompt, history_used, history_omitted = build_prompt(message, conversation_history)
+    print(json.dumps({
+        'event': 'prompt_built',
+        'prompt_chars': len(prompt),
+        'history_messages': history_used,
+        'history_omitted': history_omitted,
+    }))
+    return {'statusCode': 200, 'headers': STREAM_HEADERS,
+            'body': relay_stream(message, conversation_history, prompt, context)}
@@ -0,0 +1,86 @@
+# lambda/stream_server.py
+"""
+ストリーミング版ハンドラーのHTTPサーバー
+
+PythonのLambdaはレスポンスストリーミングに直接対応していないため、Lambda Web Adapter を使い、
+このHTTPサーバーを関数URL（InvokeMode: RESPONSE_STREAM）の背後で動かす。
+POSTされたリクエストを index.stream_handler に渡し、返されたSSEのイベントをチャンク転送で順次書き出す。
+
+Lambda Web Adapter の設定例:
+- レイヤー: arn:aws:lambda:<region>:753240598075:layer:LambdaAdapterLayerX86:<version>
+- 環境変数: AWS_LAMBDA_EXEC_WRAPPER=/opt/bootstrap, AWS_LWA_INVOKE_MODE=response_stream, PORT=8080
+- ハンドラー: run.sh（内容: exec python stream_server.py）
+
+ローカルでは `python stream_server.py` で起動できる。
+"""
+
+import json
+import os
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from index import stream_handler
+
+
+class HeaderContext:
+    """
+    Lambda Web Adapter が渡す x-amzn-lambda-context ヘッダーから、Lambdaの残り時間を返すコンテキスト
+    """
+
+    def __init__(self, header):
+        try:
+            self.deadline_ms = json.loads(header).get('deadline') if header else None
+        except json.JSONDecodeError:
+            self.deadline_ms = None
+
+    def get_remaining_time_in_millis(self):
+        if self.deadline_ms is None:
+            return 30000
+        return self.deadline_ms - time.time() * 1000
+
+
+class StreamRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True  # トークンを小さなチャンクで送るため、Nagleアルゴリズムで遅らせない
+
+    def do_GET(self):
+        # Lambda Web Adapter の起動確認用
+        self.send_response(200)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        event = {'body': self.rfile.read(length).decode('utf-8')}
+        result = stream_handler(event, HeaderContext(self.headers.get('x-amzn-lambda-context')))
+
+        self.send_response(result['statusCode'])
+        for name, value in result['headers'].items():
+            self.send_header(name, value)
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        body = result['body']
+        try:
+            for chunk in body:
+                self.wfile.write(f"{len(chunk):X}\r\n".encode('ascii') + chunk + b"\r\n")
+                self.wfile.flush()
+            self.wfile.write(b"0\r\n\r\n")
+        except (BrokenPipeError, ConnectionResetError):
+            # クライアントが切断した場合は、上流への接続も閉じて生成を止めさせる
+            print('クライアントが切断したため、ストリーミングを中止します')
+        finally:
+            if hasattr(body, 'close'):
+                body.close()
+
+    def log_message(self, format, *args):
+        print(format % args)
+
+
+def create_server(port):
+    return ThreadingHTTPServer(('0.0.0.0', port), StreamRequestHandler)
+
+
+if __name__ == '__main__':
+    port = int(os.environ.get('PORT', '8080'))
+    print(f"ストリーミングサーバーを起動します: port={port}")
+    create_server(port).serve_forever()
@@ -0,0 +1,211 @@
+"""
+Lambdaのストリーミング版ハンドラーのテスト
+
+FastAPIの代わりにローカルのスタブサーバーを起動し、/generate/stream のトークンが
+届いた順に中継されること、通常のハンドラー（lambda_handler）が従来どおり動くことを確認する。
+
+実行方法: simplechat ディレクトリで `python -m pytest tests`
+"""
+
+import http.client
+import json
+import os
+import sys
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'lambda'))
+
+import index  # noqa: E402
+import stream_server  # noqa: E402
+
+
+class StubFastAPIHandler(BaseHTTPRequestHandler):
+    """
+    /generate と /generate/stream を模したスタブ
+
+    server.tokens のトークンを1つずつSSEで送る。server.release が設定されている場合は、
+    最初のトークンを送った後、release がセットされるまで残りを送らない。
+    """
+
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def do_POST(self):
+        payload = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        self.server.prompts.append(payload['prompt'])
+        if self.server.status != 200:
+            self._send_json(self.server.status, {'detail': 'error'})
+        elif self.path == '/generate':
+            self._send_json(200, {'generated_text': ''.join(self.server.tokens)})
+        elif self.path == '/generate/stream':
+            self._send_stream()
+        else:
+            self._send_json(404, {'detail': 'Not Found'})
+
+    def _send_json(self, status, data):
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_stream(self):
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        for i, token in enumerate(self.server.tokens):
+            if i == 1 and self.server.release is not None:
+                self.server.release.wait(timeout=5)
+            self._write_chunk(f"data: {json.dumps({'text': token}, ensure_ascii=False)}\n\n")
+        self._write_chunk(f"data: {json.dumps({'done': True})}\n\n")
+        self.wfile.write(b"0\r\n\r\n")
+
+    def _write_chunk(self, text):
+        data = text.encode('utf-8')
+        self.wfile.write(f"{len(data):X}\r\n".encode('ascii') + data + b"\r\n")
+        self.wfile.flush()
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def upstream(monkeypatch):
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StubFastAPIHandler)
+    server.tokens = ['こんにちは', '、', '元気です', '。']
+    server.status = 200
+    server.release = None
+    server.prompts = []
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    base_url = f"http://127.0.0.1:{server.server_port}"
+    monkeypatch.setattr(index, 'FASTAPI_URL', base_url + '/generate')
+    monkeypatch.setattr(index, 'FASTAPI_STREAM_URL', base_url + '/generate/stream')
+    monkeypatch.setattr(index, 'connection_pool', index.ConnectionPool())
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def make_event(message, history=None):
+    return {'body': json.dumps({'message': message, 'conversationHistory': history or []})}
+
+
+def parse_events(chunks):
+    return [json.loads(chunk.decode('utf-8')[len('data: '):]) for chunk in chunks]
+
+
+def test_stream_handler_relays_tokens_and_final_history(upstream):
+    history = [{'role': 'user', 'content': '前の質問'}, {'role': 'assistant', 'content': '前の回答'}]
+    result = index.stream_handler(make_event('調子はどう？', history), None)
+
+    assert result['statusCode'] == 200
+    assert result['headers']['Content-Type'].startswith('text/event-stream')
+    events = parse_events(result['body'])
+    assert [e['text'] for e in events if 'text' in e] == upstream.tokens
+    final = events[-1]
+    assert final['done'] and final['success']
+    assert final['response'] == 'こんにちは、元気です。'
+    assert final['conversationHistory'][-2:] == [
+        {'role': 'user', 'content': '調子はどう？'},
+        {'role': 'assistant', 'content': 'こんにちは、元気です。'},
+    ]
+    # 会話履歴を含めたプロンプトが上流に送られる
+    assert '前の質問' in upstream.prompts[0]
+
+
+def test_stream_handler_yields_first_token_before_upstream_finishes(upstream):
+    upstream.release = threading.Event()
+    body = index.stream_handler(make_event('こんにちは'), None)['body']
+
+    # 上流が2つ目以降のトークンを送る前に、最初のトークンを受け取れる
+    first = parse_events([next(body)])[0]
+    assert first == {'text': 'こんにちは'}
+    upstream.release.set()
+    rest = parse_events(list(body))
+    assert rest[-1]['response'] == 'こんにちは、元気です。'
+
+
+def test_stream_handler_stops_at_next_user_turn(upstream):
+    upstream.tokens = ['はい', '\nユー', 'ザー: 続き']
+    events = parse_events(index.stream_handler(make_event('質問'), None)['body'])
+
+    assert ''.join(e['text'] for e in events if 'text' in e) == 'はい'
+    assert events[-1]['response'] == 'はい'
+
+
+def test_stream_handler_reports_upstream_error(upstream):
+    upstream.status = 503
+    events = parse_events(index.stream_handler(make_event('質問'), None)['body'])
+
+    assert len(events) == 1
+    assert events[0]['success'] is False
+    assert '503' in events[0]['error']
+
+
+def test_stream_handler_rejects_missing_message(upstream):
+    result = index.stream_handler(make_event(''), None)
+
+    assert result['statusCode'] == 400
+    assert parse_events(result['body'])[0]['success'] is False
+    assert upstream.prompts == []
+
+
+def test_handlers_reject_too_long_message(upstream):
+    message = 'あ' * (index.MESSAGE_MAX_CHARS + 1)
+
+    assert index.lambda_handler(make_event(message), None)['statusCode'] == 400
+    result = index.stream_handler(make_event(message), None)
+    assert result['statusCode'] == 400
+    assert parse_events(result['body'])[0]['success'] is False
+    assert upstream.prompts == []
+
+
+def test_build_prompt_stays_within_limit():
+    history = [{'role': 'user', 'content': 'い' * 800}, {'role': 'assistant', 'content': 'う' * 800}] * 10
+    prompt, _, omitted = index.build_prompt('あ' * index.MESSAGE_MAX_CHARS, history)
+
+    assert len(prompt) <= index.PROMPT_MAX_CHARS
+    assert omitted > 0
+
+
+def test_returned_history_is_filtered_and_truncated(upstream):
+    history = ['junk', {'role': 'system', 'content': 'x'}, {'role': 'user', 'content': 'い' * 5000}]
+    result = index.lambda_handler(make_event('質問', history), None)
+
+    returned = json.loads(result['body'])['conversationHistory']
+    assert [item['role'] for item in returned] == ['user', 'user', 'assistant']
+    assert len(returned[0]['content']) == index.HISTORY_MESSAGE_MAX_CHARS + 1
+
+
+def test_buffered_handler_remains_default(upstream):
+    result = index.lambda_handler(make_event('質問'), None)
+
+    assert result['statusCode'] == 200
+    body = json.loads(result['body'])
+    assert body['success'] and body['response'] == 'こんにちは、元気です。'
+
+
+def test_stream_server_writes_chunked_events(upstream):
+    server = stream_server.create_server(0)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        conn = http.client.HTTPConnection('127.0.0.1', server.server_port, timeout=5)
+        conn.request('POST', '/', body=make_event('質問')['body'].encode('utf-8'),
+                     headers={'Content-Type': 'application/json'})
+        response = conn.getresponse()
+        assert response.status == 200
+        assert response.getheader('Transfer-Encoding') == 'chunked'
+        lines = [line for line in response.read().decode('utf-8').split('\n\n') if line]
+        events = [json.loads(line[len('data: '):]) for line in lines]
+        assert events[-1]['response'] == 'こんにちは、元気です。'
+        conn.close()
+    finally:
+        server.shutdown()
+        server.server_close()